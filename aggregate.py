@@ -0,0 +1,267 @@
+import logging
+import threading
+from datetime import datetime as dt, timedelta
+import numpy as np
+
+
+# signals aggregated per sensor and day, in the order of the median columns of the dailytable
+DAILY_SIGNALS = ['Temp', 'Zvel', 'Zacc', 'Xvel', 'Xacc']
+
+# statistics stored next to the medians, as columns <signal><statistic> (e.g. Zvelp95)
+DAILY_STATISTICS = ['min', 'max', 'mean', 'p05', 'p95']
+
+DAILY_STATISTIC_COLUMNS = [_signal + _statistic for _signal in DAILY_SIGNALS for _statistic in DAILY_STATISTICS]
+
+# statistics of the time bucket aggregates of the API next to the percentiles p<q> (e.g. p95), see group_statistics
+BUCKET_STATISTICS = ['count', 'mean', 'min', 'max', 'rms']
+
+# bucket lengths of the time bucket aggregates, as <number><unit> (e.g. 5m, 1w) in minutes
+BUCKET_UNITS = {'m': 1, 'h': 60, 'd': 1440, 'w': 10080}
+
+
+def bucket_minutes(bucket):
+    """
+    Return the length in minutes of a bucket given as <number><unit> with the unit m, h, d or w (e.g. 5m, 1h, 1w),
+    raises ValueError for an invalid bucket
+    """
+    if len(bucket) < 2 or bucket[-1] not in BUCKET_UNITS or not bucket[:-1].isdigit() or int(bucket[:-1]) == 0:
+        raise ValueError(f'Invalid bucket {bucket}')
+    return int(bucket[:-1]) * BUCKET_UNITS[bucket[-1]]
+
+
+def percentile_of(statistic):
+    # the percentile of a statistic p<q> (e.g. p95), None for the other statistics
+    if statistic[:1] == 'p':
+        try:
+            _percentile = float(statistic[1:])
+        except ValueError:
+            return None
+        if 0 <= _percentile <= 100:
+            return _percentile
+    return None
+
+
+def group_statistics(values, starts, statistics):
+    """
+    Return {statistic: array (groups, k)} of the statistics (see BUCKET_STATISTICS and percentile_of) of the k columns
+    of values (n, k) in the groups of consecutive rows that start at the row indices starts, without NaN (NULL) values.
+    The percentiles interpolate linearly between the sorted values of a group, as np.percentile does
+    """
+    _valid = ~np.isnan(values)
+    _filled = np.where(_valid, values, 0.0)
+    _counts = np.add.reduceat(_valid, starts, axis = 0)
+    _sorted = None
+    _statistics = {}
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        for _statistic in statistics:
+            if _statistic == 'count':
+                _statistics[_statistic] = _counts
+            elif _statistic == 'mean':
+                _statistics[_statistic] = np.add.reduceat(_filled, starts, axis = 0) / _counts
+            elif _statistic == 'rms':
+                _statistics[_statistic] = np.sqrt(np.add.reduceat(_filled**2, starts, axis = 0) / _counts)
+            elif _statistic == 'min':
+                _statistics[_statistic] = np.fmin.reduceat(values, starts, axis = 0)
+            elif _statistic == 'max':
+                _statistics[_statistic] = np.fmax.reduceat(values, starts, axis = 0)
+            else:
+                if _sorted is None:
+                    # the values of each column sorted within their group, the NaN values last
+                    _groups = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(values))))
+                    _sorted = np.stack([values[np.lexsort((values[:, x], _groups)), x] for x in range(values.shape[1])],
+                                       axis = 1)
+                _position = starts[:, None] + np.maximum(_counts - 1, 0) * percentile_of(_statistic) / 100
+                _below = np.floor(_position).astype(np.int64)
+                _above = np.ceil(_position).astype(np.int64)
+                _columns = np.arange(values.shape[1])
+                _low, _high = _sorted[_below, _columns], _sorted[_above, _columns]
+                _percentile = _low + (_high - _low) * (_position - _below)
+                _statistics[_statistic] = np.where(_counts > 0, _percentile, np.nan)
+
+    return _statistics
+
+
+class _DayBuffer:
+    # the readings of one sensor and day, in a growing array with amortized O(1) appends
+
+    def __init__(self):
+        self._values = np.empty((256, len(DAILY_SIGNALS)), dtype = np.float64)
+        self._count = 0
+
+    def append(self, values):
+        if self._count == len(self._values):
+            self._values = np.concatenate([self._values, np.empty_like(self._values)])
+        self._values[self._count] = values
+        self._count += 1
+        return None
+
+    def aggregates(self):
+        # (medians in the order of DAILY_SIGNALS, statistics in the order of DAILY_STATISTIC_COLUMNS, samples)
+        _values = self._values[:self._count]
+        _p05, _median, _p95 = np.percentile(_values, [5, 50, 95], axis = 0)
+        _statistics = np.stack([_values.min(axis = 0), _values.max(axis = 0), _values.mean(axis = 0), _p05, _p95],
+                               axis = 1)
+        return _median.tolist(), _statistics.ravel().tolist(), self._count
+
+
+class DailyAggregator:
+
+    def __init__(self, database_load):
+        self._database_load = database_load
+        self._upsert_interval = 60.0
+        self._max_days = 7
+        self._change_listener = None
+        self._columns_added = False
+        self._lock = threading.Lock()
+        self._buffers = {}
+        self._changed = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set_upsert_interval(self, upsert_interval):
+        """
+        Set the time (seconds) between two upserts of the changed daily aggregates to the dailytable
+        """
+        self._upsert_interval = upsert_interval
+        return None
+
+    def set_max_days(self, max_days):
+        """
+        Set the past days whose aggregates are kept while their upserts fail, the changes of older days are dropped
+        """
+        self._max_days = max_days
+        return None
+
+    def set_change_listener(self, listener):
+        """
+        Call listener(tables) after every committed upsert (see CacheInvalidator in cache.py)
+        """
+        self._change_listener = listener
+        return None
+
+    def bootstrap(self, spool = None, day = None):
+        """
+        Fill the buffers of a day (default today) with the readings already loaded to the machinedatatable and the
+        cycles still waiting in the spool, so a restart of the ETL continues the aggregates of the running day. Only the
+        loaded rows are known after a restart, the readings the deadband suppressed (see DeadbandFilter in transform.py)
+        are missing from the aggregates of the day
+        """
+        _day = dt.now().date() if day is None else day
+        _readings = []
+        try:
+            # the spool is read first, a cycle the drainer loads meanwhile is then found in the machinedatatable
+            if spool is not None:
+                for _seq, _kind, _data in spool.peek(max(1, spool.pending_rows())):
+                    if _kind == 'cycle':
+                        _data = _data[_data['time_log'].astype('M8[D]') == np.datetime64(_day, 'D')]
+                        _readings.extend(zip(_data['sensorID'].tolist(), _data['time_log'].tolist(),
+                                             *(_data[_signal].tolist() for _signal in DAILY_SIGNALS)))
+            if not self._database_load._connected:
+                self._database_load.connect_to_database()
+            _readings.extend(self._database_load.fetch_daily_readings(_day))
+        except Exception as e:
+            logging.warning(f'Failed to read the readings of {_day} due to {str(e)}, the daily aggregates start empty')
+            return None
+
+        # a spooled cycle that is loaded already is read twice
+        _seen = set()
+        with self._lock:
+            for _sensor_id, _time_log, *_values in _readings:
+                if (int(_sensor_id), _time_log) in _seen:
+                    continue
+                _seen.add((int(_sensor_id), _time_log))
+                self._append(int(_sensor_id), _time_log.date(), _values)
+        logging.info(f'Bootstrapped the daily aggregates of {_day} with {len(_seen)} readings')
+        return None
+
+    def _append(self, sensor_id, day, values):
+        _key = (sensor_id, day)
+        if _key not in self._buffers:
+            self._buffers[_key] = _DayBuffer()
+        self._buffers[_key].append(values)
+        self._changed.add(_key)
+        return None
+
+    def append_cycle(self, cycle_frame):
+        """
+        Add the readings of a cycle frame to the buffers of their sensor and day, in memory only, the changed aggregates
+        are upserted on the background thread (see start)
+        """
+        if len(cycle_frame):
+            _days = cycle_frame['time_log'].astype('M8[D]').tolist()
+            _values = np.stack([cycle_frame[_signal] for _signal in DAILY_SIGNALS], axis = 1)
+            with self._lock:
+                for _sensor_id, _day, _row in zip(cycle_frame['sensorID'].tolist(), _days, _values):
+                    self._append(_sensor_id, _day, _row)
+
+        return None
+
+    def start(self):
+        """
+        Upsert the changed aggregates every upsert interval on a background thread, so a slow or unavailable database
+        never holds up the cycles
+        """
+        self._thread = threading.Thread(target = self._run, name = 'daily-aggregator', daemon = True)
+        self._thread.start()
+        return None
+
+    def _run(self):
+        while not self._stop.wait(self._upsert_interval):
+            self.upsert()
+
+        return None
+
+    def upsert(self):
+        """
+        Write the aggregates of all sensors and days that received readings since the last upsert to the dailytable.
+        The changes are kept for the next upsert while the database is unavailable, at most max days. The previous days
+        are upserted a last time and dropped once a newer day started. The statistics columns are added to the dailytable
+        before the first upsert (see add_daily_statistics_columns in load.py)
+        """
+        with self._lock:
+            _changed, self._changed = self._changed, set()
+            _rows = [(_sensor_id, _day.isoformat(), *self._buffers[(_sensor_id, _day)].aggregates())
+                     for _sensor_id, _day in sorted(_changed)]
+        if not _rows:
+            return None
+
+        try:
+            if not self._database_load._connected:
+                self._database_load.connect_to_database()
+        except Exception as e:
+            logging.warning(f'Failed to connect to database due to {str(e)}, the daily aggregates are upserted later')
+        if self._database_load._connected and not self._columns_added:
+            self._database_load.add_daily_statistics_columns()
+            self._columns_added = self._database_load._connected
+        if self._database_load._connected:
+            self._database_load.upsert_daily_aggregates(_rows)
+        _upserted = self._database_load._connected
+
+        if _upserted and self._change_listener is not None:
+            self._change_listener(['dailytable'])
+        with self._lock:
+            if not _upserted:
+                self._changed |= _changed
+            _latest_day = max(_day for _sensor_id, _day in self._buffers)
+            # the buffers do not grow without limit while the upserts fail
+            _dropped = sorted(x for x in self._changed if x[1] < _latest_day - timedelta(days = self._max_days))
+            if _dropped:
+                logging.warning(f'Dropped the daily aggregates of {len(_dropped)} sensor days up to {max(x[1] for x in _dropped)} '
+                                f'that were not upserted', extra = {'event': 'daily_aggregates_dropped'})
+                self._changed.difference_update(_dropped)
+            # the aggregates of a day are final once a newer day started
+            for _key in [x for x in self._buffers if x[1] < _latest_day and x not in self._changed]:
+                del self._buffers[_key]
+
+        return None
+
+    def close(self, timeout = None):
+        """
+        Stop the background thread, upsert the remaining changes and close the database connection
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.upsert()
+        self._database_load.close_connection()
+        return None
@@ -1,27 +1,351 @@
-import pyodbc
+from storage import SQLServerStorage, ConnectionPool
+from rollup import ROLLUP_TIERS, rollup_view, DENORMALIZED_COLUMNS, ADDITIONAL_VIBRATION_COLUMNS
+from downsample import downsample_rows
+from aggregate import BUCKET_STATISTICS, bucket_minutes, percentile_of, group_statistics
+from transform import FIELD_SPEC, SAMPLED_FIELDS
+import numpy as np
 from io import StringIO
 import csv
-from datetime import datetime as dt
+import json
+import base64
+from datetime import datetime as dt, timedelta
+
+# pyarrow is only needed for the Arrow and Parquet exports
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+# the kinds of raw data queries: the view they read (or its rollup tier), the format of their start and end dates,
+# their default fields, and the rows they read (None for all rows). The additional vibration data are only in the rows
+# of the cycles that sampled them (see SAMPLED_FIELDS in transform.py)
+RAW_DATA_KINDS = {'machine_data': ('denormalizedview', '%Y-%m-%d %H:%M:%S', DENORMALIZED_COLUMNS[:-1], None),
+                  'additional_vibration_data': ('additional_vibration_data', '%Y-%m-%d',
+                                                ADDITIONAL_VIBRATION_COLUMNS[:-1], f'{SAMPLED_FIELDS[0]} IS NOT NULL'),
+                  'motor_run_data': ('additional_vibration_data', '%Y-%m-%d', ['MotorRunFlag'], None)}
+
+# the columns every raw data row starts with, followed by its fields
+RAW_DATA_KEY_COLUMNS = ['measurementID', 'machineID', 'machineName', 'machineLoc', 'sensorID', 'sensorName', 'time_log']
+
+# the signals among the fields of each kind of raw data query that the downsampling preserves
+DOWNSAMPLE_SIGNALS = {'machine_data': ['Zvel', 'Zacc', 'Xvel', 'Xacc', 'Temp'],
+                      'additional_vibration_data': ADDITIONAL_VIBRATION_COLUMNS[:-1],
+                      'motor_run_data': ['MotorRunFlag']}
+
+# the machinedatatable (d) with its sensors (s) and machines (m)
+MACHINE_DATA_SOURCE = ('MachineDataTable d JOIN SensorDataTable s ON s.sensorID = d.sensorID '
+                       'JOIN MachineTable m ON m.machineID = s.machineID')
+
+# columns of the denormalizedview and additional_vibration_data the time bucket aggregates are computed of, and the
+# default columns and statistics
+AGGREGATE_COLUMNS = list(dict.fromkeys(DENORMALIZED_COLUMNS + ADDITIONAL_VIBRATION_COLUMNS))
+AGGREGATE_DEFAULT_COLUMNS = ['Zvel', 'Zacc', 'Xvel', 'Xacc', 'Temp']
+AGGREGATE_DEFAULT_STATISTICS = ['count', 'mean', 'min', 'max']
+
+# the statistics the database aggregates, rms is completed from the mean square
+AGGREGATE_SQL = {'count': 'COUNT({0})', 'mean': 'AVG({0})', 'min': 'MIN({0})', 'max': 'MAX({0})',
+                 'rms': 'SUM({0}*{0}) / NULLIF(COUNT({0}), 0)'}
+
+# columns of the bulk export and their expressions in the query of the machinedatatable (see _machine_data_query),
+# followed by the columns of the views
+EXPORT_KEY_COLUMNS = {'measurementID': 'd.measurementID', 'machineID': 'm.machineID', 'machineName': 'm.machineName',
+                      'machineLoc': 'm.machineLoc', 'sensorID': 'd.sensorID', 'sensorName': 's.sensorName',
+                      'time_log': 'd.time_log'}
+EXPORT_COLUMNS = list(EXPORT_KEY_COLUMNS) + AGGREGATE_COLUMNS
+EXPORT_FORMATS = ['csv', 'arrow', 'parquet']
+
+
+class _ExportSink:
+    # write-only file object that hands out the bytes written since the last take(), while the position keeps counting
+    # (the Parquet footer refers to the row groups by their position)
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        return None
+
+    def close(self):
+        self.closed = True
+        return None
+
+    def take(self):
+        _data = b''.join(self._chunks)
+        self._chunks = []
+        return _data
+
+
+def _export_type(column):
+    # the Arrow type of an export column
+    if column in ('measurementID', 'machineID', 'sensorID'):
+        return pa.int64()
+    if column == 'time_log':
+        return pa.timestamp('us')
+    if column in EXPORT_KEY_COLUMNS:
+        return pa.string()
+    return pa.from_numpy_dtype(np.dtype(dict((x[0], x[4]) for x in FIELD_SPEC)[column]))
+
+
+def export_chunks(columns, batches, export_format):
+    """
+    Write batches of row tuples with the given columns as CSV (with a header), an Arrow IPC stream or a Parquet file,
+    and return a generator of the text or bytes written per batch. The rows are converted column by column, each batch
+    is a record batch of the stream or a row group of the Parquet file
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format {export_format}')
+    if export_format != 'csv' and pa is None:
+        raise ImportError('The Arrow and Parquet exports require the pyarrow package')
+    return _csv_chunks(columns, batches) if export_format == 'csv' else _arrow_chunks(columns, batches, export_format)
+
+
+def _csv_chunks(columns, batches):
+    _buffer = StringIO()
+    _writer = csv.writer(_buffer)
+    _writer.writerow(columns)
+    try:
+        for _rows in batches:
+            _writer.writerows(_rows)
+            yield _buffer.getvalue()
+            _buffer.seek(0)
+            _buffer.truncate()
+        if _buffer.tell():
+            yield _buffer.getvalue()
+    finally:
+        batches.close()
+
+
+def _arrow_chunks(columns, batches, export_format):
+    _schema = pa.schema([(x, _export_type(x)) for x in columns])
+    _sink = _ExportSink()
+    _file = pa.PythonFile(_sink, mode = 'w')
+    if export_format == 'arrow':
+        _writer = pa.ipc.new_stream(_file, _schema)
+    else:
+        _writer = pq.ParquetWriter(_file, _schema, compression = 'zstd')
+    try:
+        for _rows in batches:
+            _arrays = [pa.array(_values, type = _type) for _values, _type in zip(zip(*_rows), _schema.types)]
+            _batch = pa.RecordBatch.from_arrays(_arrays, schema = _schema)
+            if export_format == 'arrow':
+                _writer.write_batch(_batch)
+            else:
+                _writer.write_table(pa.Table.from_batches([_batch]))
+            yield _sink.take()
+        _writer.close()
+        yield _sink.take()
+    finally:
+        batches.close()
+
+
+def encode_cursor(time_log, measurement_id):
+    """
+    Return the opaque page cursor of the row with the given time_log and measurementID
+    """
+    return base64.urlsafe_b64encode(json.dumps([time_log.isoformat(' '), measurement_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Return the (time_log, measurementID) of a page cursor, raises ValueError for an invalid cursor
+    """
+    try:
+        _time_log, _measurement_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return dt.fromisoformat(_time_log), int(_measurement_id)
+    except Exception:
+        raise ValueError(f'Invalid page cursor {cursor}')
 
 
 class compressor_extract_class:
 
     def __init__(self):
-        self._server = None
-        self._database = None
+        self._storage = None
+        self._pool = None
         self._connection = None
         self._cursor = None
         self._connected = False
+        self._rollup_enabled = False
+        self._max_points = 5000
+        self._retention_days = {}
+        self._raw_period = 10
+        self._heartbeat = None
     
     def set_database_credentials(self, server, database):
-        self._server = server
-        self._database = database
+        self.set_storage(SQLServerStorage(server, database))
+
+    def set_storage(self, storage):
+        """
+        Set the storage backend (see storage.py) to query the data from, the queries share a pool of connections to it
+        """
+        self._storage = storage
+        self._pool = ConnectionPool(storage)
+
+    def set_connection_pool(self, min_size, max_size, health_check_after, idle_timeout):
+        """
+        Set the size of the connection pool, and when idle connections are checked and closed (see ConnectionPool)
+        """
+        self._pool.set_pool_size(min_size, max_size)
+        self._pool.set_idle_policy(health_check_after, idle_timeout)
+
+    def cursor(self):
+        """
+        Lend a pooled connection for a with block, as a cursor scoped to the block
+        """
+        return self._pool.cursor()
+
+    def set_rollup_policy(self, max_points, retention_days, raw_period):
+        """
+        Read the rollup tiers (see rollup.py) for long time ranges: the finest tier with at most max_points points per
+        sensor whose retention {tier: days} still covers the start of the range. raw_period is the sampling period
+        (seconds) of the raw rows
+        """
+        self._rollup_enabled = True
+        self._max_points = max_points
+        self._retention_days = retention_days
+        self._raw_period = raw_period
+
+    def set_deadband_heartbeat(self, heartbeat):
+        """
+        The ETL suppresses unchanged rows (see DeadbandFilter in transform.py) and loads a row of every sensor at least
+        every heartbeat seconds. The raw queries then also return the last row of each sensor before the start date,
+        the value that holds at the start of the step-wise series
+        """
+        self._heartbeat = timedelta(seconds = heartbeat)
+
+    def _carry_in(self, tier):
+        # how far before the start date the raw rows are read, to find the row that holds at the start date
+        return self._heartbeat if self._heartbeat is not None and tier == 'raw' else timedelta(0)
+
+    def _step_start(self, data, tier, start):
+        # drop the rows read before the start date, except the last one of each sensor
+        if not start or not self._carry_in(tier):
+            return data
+        _carried = {}
+        for _row in data:
+            if _row[6] < start and (_row[4] not in _carried or _row[6] > _carried[_row[4]][6]):
+                _carried[_row[4]] = _row
+        return list(_carried.values()) + [x for x in data if x[6] >= start]
+
+    def _downsample(self, data, kind, fields, max_points, method):
+        # reduce the rows of each sensor to max_points rows by the signals among their fields (all fields when there
+        # are none), see downsample_rows
+        if not max_points:
+            return data
+        _columns = [7 + x for x, _field in enumerate(fields) if _field in DOWNSAMPLE_SIGNALS[kind]]
+        return downsample_rows(data, _columns or list(range(7, 7 + len(fields))), max_points, method)
+
+    def _stream_rows(self, query, params, tier, start, batch_size):
+        # fetch the rows of a query ordered by time_log in batches, with the rows before the start date reduced to the
+        # last one of each sensor as in _step_start
+        with self.cursor() as cursor:
+            cursor.execute(query, tuple(params))
+            _carried = {} if start and self._carry_in(tier) else None
+            while True:
+                _rows = cursor.fetchmany(batch_size)
+                if not _rows:
+                    break
+                if _carried is not None:
+                    _before = [x for x in _rows if x[6] < start]
+                    for _row in _before:
+                        _carried[_row[4]] = _row
+                    _rows = _rows[len(_before):]
+                    if not _rows:
+                        continue
+                    yield list(_carried.values())
+                    _carried = None
+                yield _rows
+
+            if _carried:
+                yield list(_carried.values())
+
+    def query_page(self, kind, machine_ids, sensor_ids, start_date, end_date, resolution = 'auto', after = None,
+                   limit = 1000, fields = None):
+        """
+        Return a page of at most limit rows of the raw data ('machine_data'), the additional vibration data
+        ('additional_vibration_data') or the motor status ('motor_run_data') with the fields (see resolve_fields)
+        ordered by (time_log, measurementID), starting after the page cursor after (None for the first page), and the cursor of the next page (None after the
+        last page). The position is a keyset predicate, so every page is an index range scan
+        """
+        query, params, _tier, _start = self._raw_data_query(kind, machine_ids, sensor_ids, start_date, end_date,
+                                                            resolution, fields)
+        if after:
+            _time_log, _measurement_id = decode_cursor(after)
+            query += ''' AND (time_log > ? OR (time_log = ? AND measurementID > ?))'''
+            params.extend([_time_log, _time_log, _measurement_id])
+        query += ' ORDER BY time_log, measurementID ' + self._storage.limit_clause(limit)
+
+        with self.cursor() as cursor:
+            cursor.execute(query, tuple(params))
+            data =  cursor.fetchall()
+
+        _next = encode_cursor(data[-1][6], data[-1][0]) if len(data) == limit else None
+        if after:
+            # the rows before the start date were carried into the first page already
+            return [x for x in data if not _start or x[6] >= _start], _next
+        return self._step_start(data, _tier, _start), _next
+
+    def query_validator(self, kind, machine_ids, sensor_ids, start_date, end_date, resolution = 'auto'):
+        """
+        Return a validator of the rows of kind (see query_page) with the given filters, that changes whenever the rows
+        change: the highest measurementID, the number of rows and the latest time_log, and on a rollup tier the rollup
+        watermark, since merged buckets keep their id. A single aggregate over the index range of the filters
+        """
+        query, params, _tier, _start = self._raw_data_query(kind, machine_ids, sensor_ids, start_date, end_date,
+                                                            resolution)
+        with self.cursor() as cursor:
+            cursor.execute(f'SELECT MAX(measurementID), COUNT(*), MAX(time_log) FROM ({query}) q', tuple(params))
+            _max_id, _count, _latest = cursor.fetchone()
+            _watermark = None
+            if _tier != 'raw':
+                cursor.execute("SELECT measurementID FROM RollupWatermark WHERE name = 'machinedata'")
+                _row = cursor.fetchone()
+                _watermark = _row and _row[0]
+
+        # the type of an aggregate of a view column is lost on SQLite
+        if isinstance(_latest, str):
+            _latest = dt.fromisoformat(_latest)
+        return _max_id, _count, _latest, _watermark
+
+    def select_tier(self, resolution, start_date, end_date):
+        """
+        Return the tier ('raw' or a tier of ROLLUP_TIERS) to read for the resolution 'raw', 'auto' or a tier name, and
+        the requested range from start_date to end_date (datetimes, or None when not given)
+        """
+        if resolution != 'auto':
+            if resolution != 'raw' and resolution not in dict(ROLLUP_TIERS):
+                raise ValueError(f'Unknown resolution {resolution}')
+            return resolution
+        if not self._rollup_enabled or start_date is None:
+            return 'raw'
+
+        _now = dt.now()
+        _span = ((end_date or _now) - start_date).total_seconds()
+        for _tier, _seconds in [('raw', self._raw_period)] + [(x, 60*y) for x, y in ROLLUP_TIERS]:
+            _retention = self._retention_days.get(_tier)
+            if _retention is not None and start_date < _now - timedelta(days = _retention):
+                continue
+            if _span/_seconds <= self._max_points:
+                return _tier
+
+        return ROLLUP_TIERS[-1][0]
 
     def connect_to_database(self):
-        if self._server is not None and self._database is not None:
-            _conn_str = 'DRIVER={SQL Server};SERVER='+self._server+';DATABASE='+self._database+';Trusted_Connection=True'
-            self._connection = pyodbc.connect(_conn_str)
-            self._cursor = self._conn.cursor()
+        if self._storage is not None:
+            self._connection = self._storage.connect()
+            self._cursor = self._connection.cursor()
             self._connected = True
         else:
             self._connected = False
@@ -30,223 +354,284 @@ class compressor_extract_class:
     
     def close_connection(self):
         try:
-            self._cursor().close()
+            self._cursor.close()
             self._connection.close()
             self._connected = False
         except:
             self._connected = False
 
-    def query_machine_data(self, machine_ids, sensor_ids, start_date, end_date):
-        
-        self.connect_to_database()
-        if self._connected:
-            query = '''
-            SELECT * FROM denormalizedview WHERE measurementid > 1
-            '''
-            params = []
-            
-            if machine_ids:
-                _machine_ids = machine_ids.split(',')
-                query += f''' AND machineID IN ({','.join(['?']*len(_machine_ids))})'''
-                params.extend(_machine_ids)
-
-            if sensor_ids:
-                _sensor_ids = sensor_ids.split(',')
-                query += f''' AND sensorID IN ({','.join(['?']*len(_sensor_ids))})'''
-                params.extend(_sensor_ids)
-                
-            if start_date and end_date:
-                _start_date = dt.strptime(start_date, "%Y-%m-%d %H:%M:%S")
-                _end_date = dt.strptime(end_date, "%Y-%m-%d %H:%M:%S")
-                query += ''' AND time_log BETWEEN ? AND ?'''
-                params.append(_start_date)
-                params.append(_end_date)
-                
-            if start_date:
-                _start_date = dt.strptime(start_date, "%Y-%m-%d %H:%M:%S")
-                query += ''' AND time_log >= ?'''
-                params.append(_start_date)
-
-            self._cursor.execute(query, tuple(params))
-            data =  self._cursor.fetchall()
-            
-            self.close_connection()
-
-            return data
+    def _build_query(self, columns, source, machine_ids = None, sensor_ids = None, start = None, end = None,
+                     where = None, machine_column = 'machineID', sensor_column = 'sensorID', date_column = 'time_log'):
+        """
+        Return the parameterized SELECT of the columns from source with the filters of the API, the comma separated
+        machine_ids and sensor_ids, the range start <= date_column <= end (None for an open end) and a where clause, and
+        its parameters. The SQL text only depends on which filters are given and on the number of ids rounded up to a
+        power of two, so the database reuses the plans of the queries
+        """
+        query = f"SELECT {', '.join(columns)} FROM {source} WHERE 1=1"
+        params = []
+
+        if where:
+            query += f' AND {where}'
+
+        for _column, _ids in [(machine_column, machine_ids), (sensor_column, sensor_ids)]:
+            if _ids:
+                _ids = _ids.split(',')
+                # repeat the last id up to the next power of two
+                _ids += _ids[-1:] * ((1 << (len(_ids) - 1).bit_length()) - len(_ids))
+                query += f" AND {_column} IN ({', '.join(['?']*len(_ids))})"
+                params.extend(_ids)
+
+        if start is not None:
+            query += f' AND {date_column} >= ?'
+            params.append(start)
+
+        if end is not None:
+            query += f' AND {date_column} <= ?'
+            params.append(end)
+
+        return query, params
+
+    def resolve_fields(self, kind, fields = None):
+        """
+        Return the fields of the rows of a raw data query of kind (see RAW_DATA_KINDS), the columns that follow the key
+        columns RAW_DATA_KEY_COLUMNS. fields is a list or a comma separated string of columns of the view of the kind,
+        None for the default fields of the kind. Raises ValueError for an unknown column
+        """
+        _view, _date_format, _default_fields, _where = RAW_DATA_KINDS[kind]
+        if not fields:
+            return _default_fields
+        _fields = fields.split(',') if isinstance(fields, str) else list(fields)
+        _columns = DENORMALIZED_COLUMNS if _view == 'denormalizedview' else ADDITIONAL_VIBRATION_COLUMNS
+        for _field in _fields:
+            if _field not in _columns:
+                raise ValueError(f'Unknown field {_field}')
+        return _fields
+
+    def _raw_data_query(self, kind, machine_ids, sensor_ids, start_date, end_date, resolution, fields = None):
+        # the query and parameters of a raw data query of kind, the tier it reads and the start of the requested range
+        _view, _date_format, _default_fields, _where = RAW_DATA_KINDS[kind]
+        _start = dt.strptime(start_date, _date_format) if start_date else None
+        _end = dt.strptime(end_date, _date_format) if end_date else None
+        _tier = self.select_tier(resolution, _start, _end)
+        # the raw views leave out the first measurement, as they always did
+        _where = ' AND '.join(x for x in ['measurementID > 1' if _tier == 'raw' else None, _where] if x)
+        query, params = self._build_query(RAW_DATA_KEY_COLUMNS + self.resolve_fields(kind, fields),
+                                          rollup_view(_view, _tier), machine_ids, sensor_ids,
+                                          _start and _start - self._carry_in(_tier), _end,
+                                          where = _where or None)
+        return query, params, _tier, _start
+
+    def query_raw_data(self, kind, machine_ids, sensor_ids, start_date, end_date, resolution = 'auto', max_points = None,
+                       downsample = 'lttb', fields = None):
+        """
+        Return the rows of the raw data ('machine_data'), the additional vibration data ('additional_vibration_data') or
+        the motor status ('motor_run_data') of the tier of the resolution, the key columns followed by the fields (see
+        resolve_fields). With max_points, the rows of each sensor are downsampled to at most max_points rows (see
+        downsample.py) with the method downsample ('lttb' or 'minmax')
+        """
+        query, params, _tier, _start = self._raw_data_query(kind, machine_ids, sensor_ids, start_date, end_date,
+                                                            resolution, fields)
+        with self.cursor() as cursor:
+            cursor.execute(query, tuple(params))
+            data =  cursor.fetchall()
+
+        return self._downsample(self._step_start(data, _tier, _start), kind, self.resolve_fields(kind, fields),
+                                max_points, downsample)
+
+    def stream_raw_data(self, kind, machine_ids, sensor_ids, start_date, end_date, resolution = 'auto',
+                        batch_size = 5000, max_points = None, downsample = 'lttb', fields = None):
+        """
+        Return the rows of query_raw_data ordered by time_log, as a generator of batches of rows fetched one batch at a
+        time. The pooled connection is held until the generator is exhausted or closed. Downsampled rows are read at
+        once and returned as a single batch
+        """
+        if max_points:
+            return iter([self.query_raw_data(kind, machine_ids, sensor_ids, start_date, end_date, resolution,
+                                             max_points, downsample, fields)])
+        query, params, _tier, _start = self._raw_data_query(kind, machine_ids, sensor_ids, start_date, end_date,
+                                                            resolution, fields)
+        return self._stream_rows(query + ' ORDER BY time_log, measurementID', params, _tier, _start, batch_size)
+
+    def query_machine_data(self, machine_ids, sensor_ids, start_date, end_date, resolution = 'auto', max_points = None,
+                           downsample = 'lttb', fields = None):
+        return self.query_raw_data('machine_data', machine_ids, sensor_ids, start_date, end_date, resolution,
+                                   max_points, downsample, fields)
+
+    def stream_machine_data(self, machine_ids, sensor_ids, start_date, end_date, resolution = 'auto',
+                            batch_size = 5000, max_points = None, downsample = 'lttb', fields = None):
+        return self.stream_raw_data('machine_data', machine_ids, sensor_ids, start_date, end_date, resolution,
+                                    batch_size, max_points, downsample, fields)
+
+    def query_additional_vibration_data(self, machine_ids, sensor_ids, start_date, end_date, resolution = 'auto',
+                                        max_points = None, downsample = 'lttb', fields = None):
+        return self.query_raw_data('additional_vibration_data', machine_ids, sensor_ids, start_date, end_date,
+                                   resolution, max_points, downsample, fields)
+
+    def stream_additional_vibration_data(self, machine_ids, sensor_ids, start_date, end_date, resolution = 'auto',
+                                         batch_size = 5000, max_points = None, downsample = 'lttb', fields = None):
+        return self.stream_raw_data('additional_vibration_data', machine_ids, sensor_ids, start_date, end_date,
+                                    resolution, batch_size, max_points, downsample, fields)
+
+    def query_motor_run_data(self, machine_ids, sensor_ids, start_date, end_date, resolution = 'auto', max_points = None,
+                             downsample = 'lttb', fields = None):
+        return self.query_raw_data('motor_run_data', machine_ids, sensor_ids, start_date, end_date, resolution,
+                                   max_points, downsample, fields)
+
+    def stream_motor_run_data(self, machine_ids, sensor_ids, start_date, end_date, resolution = 'auto',
+                              batch_size = 5000, max_points = None, downsample = 'lttb', fields = None):
+        return self.stream_raw_data('motor_run_data', machine_ids, sensor_ids, start_date, end_date, resolution,
+                                    batch_size, max_points, downsample, fields)
 
     def query_daily_data(self, machine_ids, sensor_ids, start_date, end_date):
-       
-        self.connect_to_database()
-        if self._connected:
-            query = '''
-            SELECT * FROM dailytable WHERE 1=1
-            '''
-            params = []
-            if machine_ids:
-                _machine_ids = machine_ids.split(',')
-                query += f''' AND machineID IN ({','.join(['?']*len(_machine_ids))})'''
-                params.extend(_machine_ids)
-                
-            if sensor_ids:
-                _sensor_ids = sensor_ids.split(',')
-                query += f''' AND sensorID IN ({','.join(['?']*len(_sensor_ids))})'''
-                params.extend(_sensor_ids)
-                
-            if start_date and end_date:
-                _start_date = dt.strptime(start_date, "%Y-%m-%d")
-                _end_date = dt.strptime(end_date, "%Y-%m-%d")
-                query += ''' AND DATE BETWEEN ? AND ?'''
-                params.append(_start_date)
-                params.append(_end_date)
-                
-            if start_date:
-                _start_date = dt.strptime(start_date, "%Y-%m-%d")
-                query += ''' AND DATE >= ?'''
-                params.append(_start_date)
-
-            self._cursor.execute(query, tuple(params))
-            data =  self._cursor.fetchall()
-
-            self.close_connection()
+        # the dailytable is maintained on the server, its rows are read whole and by position as they always were
+        _start = dt.strptime(start_date, "%Y-%m-%d").date() if start_date else None
+        _end = dt.strptime(end_date, "%Y-%m-%d").date() if end_date else None
+        query, params = self._build_query(['*'], 'dailytable', machine_ids, sensor_ids, _start, _end,
+                                          date_column = 'date')
+        with self.cursor() as cursor:
+            cursor.execute(query, tuple(params))
+            data =  cursor.fetchall()
 
             return data
 
+    def _machine_data_query(self, columns, machine_ids, sensor_ids, start_date, end_date):
+        # the query and parameters of the columns (expressions) of the machinedatatable (d) joined with its sensors (s)
+        # and machines (m), start_date and end_date are ISO dates or datetimes
+        return self._build_query(columns, MACHINE_DATA_SOURCE, machine_ids, sensor_ids,
+                                 dt.fromisoformat(start_date) if start_date else None,
+                                 dt.fromisoformat(end_date) if end_date else None,
+                                 machine_column = 'm.machineID', sensor_column = 'd.sensorID', date_column = 'd.time_log')
+
+    def stream_export(self, machine_ids, sensor_ids, start_date, end_date, columns = None, batch_size = 50000):
+        """
+        Return the columns (default EXPORT_COLUMNS) and the raw data rows with these columns ordered by time_log, as a
+        generator of batches of row tuples, see stream_machine_data and export_chunks. start_date and end_date are ISO
+        dates or datetimes
+        """
+        _columns = columns or EXPORT_COLUMNS
+        for _column in _columns:
+            if _column not in EXPORT_COLUMNS:
+                raise ValueError(f'Unknown column {_column}')
+
+        query, params = self._machine_data_query([EXPORT_KEY_COLUMNS.get(x, 'd.' + x) for x in _columns], machine_ids,
+                                                 sensor_ids, start_date, end_date)
+        return _columns, self._stream_rows(query + ' ORDER BY d.time_log, d.measurementID', params, 'raw', None,
+                                           batch_size)
+
+    def query_aggregate_data(self, machine_ids, sensor_ids, start_date, end_date, bucket = '1h', columns = None,
+                             statistics = None):
+        """
+        Return the statistics of columns of the raw data per sensor and time bucket (e.g. 5m, 1h, 1d, 1w, see
+        bucket_minutes) as rows (machineID, machineName, machineLoc, sensorID, sensorName, start of the bucket,
+        {column: {statistic: value}}) ordered by sensor and bucket. start_date and end_date are ISO dates or datetimes.
+        Without percentiles the database aggregates the buckets, with percentiles the readings are fetched and
+        aggregated with numpy (see group_statistics)
+        """
+        _minutes = bucket_minutes(bucket)
+        _columns = columns or AGGREGATE_DEFAULT_COLUMNS
+        _statistics = statistics or AGGREGATE_DEFAULT_STATISTICS
+        for _column in _columns:
+            if _column not in AGGREGATE_COLUMNS:
+                raise ValueError(f'Unknown column {_column}')
+        for _statistic in _statistics:
+            if _statistic not in BUCKET_STATISTICS and percentile_of(_statistic) is None:
+                raise ValueError(f'Unknown statistic {_statistic}')
+
+        _bucket = self._storage.bucket_expr('d.time_log', _minutes)
+        _keys = ['m.machineID', 'm.machineName', 'm.machineLoc', 's.sensorID', 's.sensorName', _bucket]
+        _values = [f'CAST(d.{x} AS FLOAT)' for x in _columns]
+
+        _percentiles = any(percentile_of(x) is not None for x in _statistics)
+        if _percentiles:
+            query, params = self._machine_data_query(_keys + _values, machine_ids, sensor_ids, start_date, end_date)
+        else:
+            _aggregates = [AGGREGATE_SQL[_statistic].format(_value) for _statistic in _statistics for _value in _values]
+            query, params = self._machine_data_query(_keys + _aggregates, machine_ids, sensor_ids, start_date, end_date)
+            query += f" GROUP BY {', '.join(_keys)}"
+        query += f' ORDER BY s.sensorID, {_bucket}'
+
+        with self.cursor() as cursor:
+            cursor.execute(query, tuple(params))
+            data = cursor.fetchall()
+
+        if not data:
+            return []
+
+        if _percentiles:
+            _sensors = np.array([x[3] for x in data])
+            _buckets = np.array([x[5] for x in data])
+            _starts = np.flatnonzero(np.concatenate([[True], (_sensors[1:] != _sensors[:-1]) |
+                                                     (_buckets[1:] != _buckets[:-1])]))
+            _results = group_statistics(np.array([x[6:] for x in data], dtype = np.float64), _starts, _statistics)
+            _groups = [data[x][:6] for x in _starts.tolist()]
+        else:
+            _aggregated = np.array([x[6:] for x in data], dtype = np.float64).reshape(len(data), len(_statistics),
+                                                                                      len(_columns))
+            _results = {_statistic: _aggregated[:, x] for x, _statistic in enumerate(_statistics)}
+            if 'rms' in _results:
+                _results['rms'] = np.sqrt(_results['rms'])
+            _groups = [x[:6] for x in data]
+
+        # NaN are buckets without values of a column
+        _results = {_statistic: [[None if _value != _value else int(_value) if _statistic == 'count' else _value
+                                  for _value in _row] for _row in _result.tolist()]
+                    for _statistic, _result in _results.items()}
+        return [(*_group[:5], dt.fromisoformat(_group[5]) if isinstance(_group[5], str) else _group[5],
+                 {_column: {_statistic: _results[_statistic][_index][_position] for _statistic in _statistics}
+                  for _position, _column in enumerate(_columns)})
+                for _index, _group in enumerate(_groups)]
+
 
     def query_compressor_data(self):
 
-        self.connect_to_database()
-        if self._connected:
+        with self.cursor() as cursor:
             query = '''
             SELECT machineID, machineName, machineLoc FROM MachineTable
             '''
             
-            self._cursor.execute(query)
-
-            data = self._cursor.fetchall()
+            cursor.execute(query)
 
-            self.close_connection()
+            data = cursor.fetchall()
 
             return data
 
     def query_sensor_data(self):
 
-        self.connect_to_database()
-        if self._connected:
+        with self.cursor() as cursor:
             query = '''
             SELECT sensorID, machineID, sensorName, sensorType FROM SensorDataTable
             '''
             
-            self._cursor.execute(query)
-
-            data = self._cursor.fetchall()
-
-            self.close_connection()
-
-            return data
+            cursor.execute(query)
 
-    def query_additional_vibration_data(self, machine_ids, sensor_ids, start_date, end_date):
-        
-        self.connect_to_database()
-        if self._connected:
-            query = '''
-            SELECT measurementID, machineID, machineName, machineLoc, sensorID, sensorName, 
-            time_log, ZpeakAcc, XpeakAcc, ZpeakVel, XpeakVel, ZRMSlowAcc,
-            XRMSlowAcc, Zkurtosis, Xkurtosis, Zcrestfac, Xcrestfac
-            FROM additional_vibration_data WHERE measurementid > 1
-            '''
-            params = []
-            
-            if machine_ids:
-                _machine_ids = machine_ids.split(',')
-                query += f''' AND machineID IN ({','.join(['?']*len(_machine_ids))})'''
-                params.extend(_machine_ids)
-
-            if sensor_ids:
-                _sensor_ids = sensor_ids.split(',')
-                query += f''' AND sensorID IN ({','.join(['?']*len(_sensor_ids))})'''
-                params.extend(_sensor_ids)
-                
-            if start_date:
-                _start_date = dt.strptime(start_date, "%Y-%m-%d")
-                query += ''' AND time_log >= ?'''
-                params.append(_start_date)
-                
-            if end_date:
-                _end_date = dt.strptime(end_date, "%Y-%m-%d")
-                query += ''' AND time_log <= ?'''
-                params.append(_end_date)
-
-            self._cursor.execute(query, tuple(params))
-            data =  self._cursor.fetchall()
-
-            self.close_connection()
+            data = cursor.fetchall()
 
             return data
 
-
-    def query_motor_run_data(self, machine_ids, sensor_ids, start_date, end_date):
-        
-        self.connect_to_database()
-
-        if self._connected:
+    def query_sensor_names(self):
+        """
+        Return the names of the sensors {sensorID: (machineID, machineName, machineLoc, sensorName)}, of the sensors the
+        raw data views join
+        """
+        with self.cursor() as cursor:
             query = '''
-            SELECT measurementID, machineID, machineName, machineLoc, sensorID, sensorName, time_log,
-            MotorRunFlag FROM additional_vibration_data WHERE measurementid > 1
+            SELECT s.sensorID, m.machineID, m.machineName, m.machineLoc, s.sensorName FROM SensorDataTable s
+            JOIN MachineTable m ON m.machineID = s.machineID
             '''
-            params = []
-            
-            if machine_ids:
-                _machine_ids = machine_ids.split(',')
-                query += f''' AND machineID IN ({','.join(['?']*len(_machine_ids))})'''
-                params.extend(_machine_ids)
-
-            if sensor_ids:
-                _sensor_ids = sensor_ids.split(',')
-                query += f''' AND sensorID IN ({','.join(['?']*len(_sensor_ids))})'''
-                params.extend(_sensor_ids)
-                
-            if start_date:
-                _start_date = dt.strptime(start_date, "%Y-%m-%d")
-                query += ''' AND time_log >= ? '''
-                params.append(_start_date)
-                
-            if end_date:
-                _end_date = dt.strptime(end_date, "%Y-%m-%d")
-                query += ''' AND time_log <= ?'''
-                params.append(_end_date)
-
-            self._cursor.execute(query, tuple(params))
-            data =  self._cursor.fetchall()
-
-            self.close_connection()
 
-            return data
+            cursor.execute(query)
 
+            return {x[0]: tuple(x[1:]) for x in cursor.fetchall()}
 
     def query_latest_median_data(self, sensor_ids):
 
-        self.connect_to_database()
-
-        if self._connected:
-            query = '''
-            SELECT * FROM dailytable WHERE date = (SELECT MAX(date) FROM dailytable)
-            '''
-            params = []
-            
-            if sensor_ids:
-                _sensor_ids = sensor_ids.split(',')
-                query += f''' AND sensorID IN ({','.join(['?']*len(_sensor_ids))})'''
-                params.extend(_sensor_ids)
-                
-            query += ''' ORDER BY sensorID '''
-
-
-            self._cursor.execute(query, tuple(params))
-
-            data =  self._cursor.fetchall()
+        query, params = self._build_query(['*'], 'dailytable', sensor_ids = sensor_ids,
+                                          where = 'date = (SELECT MAX(date) FROM dailytable)')
+        query += ' ORDER BY sensorID'
+        with self.cursor() as cursor:
+            cursor.execute(query, tuple(params))
 
-            self.close_connection()
+            data =  cursor.fetchall()
 
             return data
-        
-        
\ No newline at end of file
@@ -1,70 +1,198 @@
+import logging
 from read import CBMDataExtractor
 from load import LoadSensorData
-from datetime import datetime as dt
-from config import SERVER_IP, SENSOR_COUNT, SERVER, DATABASE
-import logging
-from time import sleep
+from poller import MultiPLCPoller
+from scheduler import CycleScheduler
+from spool import CycleSpool, SpoolDrainer
+from pipeline import ETLPipeline, CycleItem
+from transform import validate_cycle_frame, DeadbandFilter
+from aggregate import DailyAggregator
+from rollup import RollupManager
+from storage import create_storage
+from cache import CacheInvalidator
+from live import LiveBuffer, LivePublisher
+from config import PLC_SERVERS, PLC_POLL_TIMEOUT, SERVER, DATABASE, STORAGE_BACKEND, SQLITE_PATH
+from config import PLC_TIMEOUT, PLC_KEEPALIVE_INTERVAL, PLC_RECONNECT_BASE_DELAY, PLC_RECONNECT_MAX_DELAY
+from config import SAMPLING_PERIODS, SETPOINT_CHECKSUM_REGISTER
+from config import SPOOL_PATH, SPOOL_BATCH_ROWS, SPOOL_RETRY_INTERVAL
+from config import PIPELINE_QUEUE_SIZE, PIPELINE_REPORT_INTERVAL
+from config import ARCHIVE_DIR, ARCHIVE_FLUSH_INTERVAL, ARCHIVE_COMPACT_INTERVAL
+from config import DAILY_UPSERT_INTERVAL, DAILY_MAX_DAYS
+from config import ROLLUP_ENABLED, ROLLUP_INTERVAL, ROLLUP_CHUNK_ROWS, ROLLUP_RETENTION_DAYS
+from config import DEADBAND_ENABLED, DEADBAND_BANDS, DEADBAND_HEARTBEAT, DEADBAND_IDLE_ONLY
+from logconfig import setup_logging
+from config import LOG_PATH, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_WHEN, LOG_RATE_LIMIT, LOG_RATE_INTERVAL
+from config import LOG_SAMPLE_EVERY
+from config import API_CACHE_ENABLED, API_CACHE_INVALIDATE_URL, API_CACHE_INVALIDATE_INTERVAL
+from config import API_CACHE_INVALIDATE_TOKEN
+from config import LIVE_ENABLED, LIVE_ADDRESS, LIVE_AUTHKEY, LIVE_WINDOW_HOURS, LIVE_MAX_ROWS, LIVE_QUEUE_SIZE
 
 
 def main():
-    cbm_extractor = CBMDataExtractor()
-    cbm_extractor.set_server_ip(SERVER_IP)
+    plc_poller = MultiPLCPoller()
+    plc_poller.set_poll_timeout(PLC_POLL_TIMEOUT)
+    for plc in PLC_SERVERS:
+        cbm_extractor = CBMDataExtractor()
+        cbm_extractor.set_server_ip(plc['server_ip'])
+        cbm_extractor.set_sensor_id_offset(plc['sensor_id_offset'])
+        cbm_extractor.set_reconnect_policy(PLC_RECONNECT_BASE_DELAY, PLC_RECONNECT_MAX_DELAY, PLC_TIMEOUT,
+                                           PLC_KEEPALIVE_INTERVAL)
+        cbm_extractor.set_setpoint_refresh(SAMPLING_PERIODS['setpoints'], SETPOINT_CHECKSUM_REGISTER)
+        plc_poller.add_plc(plc['server_ip'], cbm_extractor, plc['sensor_count'])
 
+    database_storage = create_storage(STORAGE_BACKEND, SERVER, DATABASE, SQLITE_PATH)
     database_load = LoadSensorData()
-    database_load.set_database_credentials(SERVER,DATABASE)
+    database_load.set_storage(database_storage)
+
+    log_listener = setup_logging(LOG_PATH, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_WHEN, LOG_RATE_LIMIT,
+                                 LOG_RATE_INTERVAL, LOG_SAMPLE_EVERY)
+
+    # the embedded database is created on the first start, the SQL Server schema is maintained on the server
+    if STORAGE_BACKEND == 'sqlite':
+        database_load.connect_to_database()
+        database_load.create_schema()
+        database_load.close_connection()
+
+    # every cycle is written to the local spool first, the drainer replays the spool to the database in the background
+    # and keeps the backlog while the database is unavailable
+    # the API caches its responses, and drops those of the tables the ETL changed after each load
+    cache_invalidator = None
+    if API_CACHE_ENABLED and API_CACHE_INVALIDATE_URL is not None:
+        cache_invalidator = CacheInvalidator(API_CACHE_INVALIDATE_URL, API_CACHE_INVALIDATE_TOKEN)
+        cache_invalidator.set_interval(API_CACHE_INVALIDATE_INTERVAL)
+        try:
+            cache_invalidator.start()
+        except ValueError as e:
+            logging.warning(f'Failed to notify the API of the changed tables due to {str(e)}')
+            cache_invalidator = None
+
+    cycle_spool = CycleSpool()
+    cycle_spool.set_spool_path(SPOOL_PATH)
+    cycle_spool.open()
+
+    spool_drainer = SpoolDrainer(cycle_spool, database_load)
+    spool_drainer.set_drain_policy(SPOOL_BATCH_ROWS, SPOOL_RETRY_INTERVAL)
+    if cache_invalidator is not None:
+        spool_drainer.set_change_listener(cache_invalidator.tables_changed)
+    spool_drainer.start()
+
+    # optional columnar archive of all cycles for the analytics, next to the database
+    archive_sink = None
+    if ARCHIVE_DIR is not None:
+        from archive import ParquetArchiveSink
+        archive_sink = ParquetArchiveSink()
+        archive_sink.set_archive_dir(ARCHIVE_DIR)
+        archive_sink.set_archive_policy(ARCHIVE_FLUSH_INTERVAL, ARCHIVE_COMPACT_INTERVAL)
+
+    # the daily aggregates are updated with every cycle and upserted to the dailytable on their own connection and
+    # thread, they continue from the readings of today already in the database or the spool
+    aggregate_load = LoadSensorData()
+    aggregate_load.set_storage(database_storage)
+    daily_aggregator = DailyAggregator(aggregate_load)
+    daily_aggregator.set_upsert_interval(DAILY_UPSERT_INTERVAL)
+    daily_aggregator.set_max_days(DAILY_MAX_DAYS)
+    if cache_invalidator is not None:
+        daily_aggregator.set_change_listener(cache_invalidator.tables_changed)
+    daily_aggregator.bootstrap(cycle_spool)
+    if DEADBAND_ENABLED:
+        logging.warning('The daily aggregates of today only include the readings loaded before the start, the readings '
+                        'the deadband suppressed are not in the database', extra = {'event': 'daily_bootstrap_partial'})
+    daily_aggregator.start()
 
-    logging.basicConfig(filename = 'applog.log', level=logging.INFO, format = '%(asctime)s-%(levelname)s-%(message)s')
+    # the rollup tiers and the retention of the raw rows are maintained in the background on their own connection
+    rollup_manager = None
+    if ROLLUP_ENABLED:
+        rollup_manager = RollupManager(database_storage)
+        rollup_manager.set_rollup_policy(ROLLUP_INTERVAL, ROLLUP_CHUNK_ROWS, ROLLUP_RETENTION_DAYS)
+        if cache_invalidator is not None:
+            rollup_manager.set_change_listener(cache_invalidator.tables_changed)
+        rollup_manager.start()
 
-    while True:
-        # create a connection to the host PLC and database
+    # the latest readings are published to the API with every cycle, so the live dashboards do not poll the database
+    live_publisher = None
+    if LIVE_ENABLED:
+        live_buffer = LiveBuffer()
+        live_buffer.set_window(LIVE_WINDOW_HOURS, LIVE_MAX_ROWS)
+        live_publisher = LivePublisher(live_buffer, LIVE_ADDRESS, LIVE_AUTHKEY)
+        live_publisher.set_queue_size(LIVE_QUEUE_SIZE)
         try:
-            cbm_extractor.connect_plc() 
-            database_load.connect_to_database()
-
-            for i in range(SENSOR_COUNT):
-                # check if connected to PLC before requesting data
-                if cbm_extractor._connected:
-                    # query data from the PLC
-
-                    sensor_data = cbm_extractor.extract_sensor_data(i)
-                    thres_data = cbm_extractor.extract_threshold_data(i)
-                    temp_warn = cbm_extractor.extract_temp_warning_data(i)
-                    temp_alarm = cbm_extractor.extract_temp_alarm_data(i)
-                    motor_data = cbm_extractor.extract_motor_status(i)
-                    add_vibration_data = cbm_extractor.extract_additional_data(i)
-
-                    raw_data = []
-                    raw_data.extend(sensor_data)
-                    raw_data.extend(thres_data)
-                    raw_data.append(temp_warn)
-                    raw_data.append(temp_alarm)
-                    raw_data.append(motor_data)
-                    raw_data.extend(add_vibration_data)
-
-                    # check if there is connection to the database
-                    if database_load._connected:
-                        # load the data to the database
-                        database_load.load_sensor_data(raw_data)
-                    else:
-                        # break the extraction procedure when connection to database is lost
-                        break
-
-                else:
-                    # if the PLC connection is lost, end the data extraction process
-                    print(f'Lost connection to PLC at {dt.now()}')
-                    break
-
-            if cbm_extractor._connected:
-                cbm_extractor.close_connection()
-            if database_load._connected:
-                database_load.close_connection()
-
-            sleep(300)
-            
-        except KeyboardInterrupt:
-            cbm_extractor.close_connection()
-            database_load.close_connection()
-            break
+            live_publisher.start()
+        except (OSError, ValueError) as e:
+            logging.warning(f'Failed to publish the live readings due to {str(e)}')
+            live_publisher = None
+
+    deadband_filter = None
+    if DEADBAND_ENABLED:
+        deadband_filter = DeadbandFilter()
+        deadband_filter.set_bands(DEADBAND_BANDS)
+        deadband_filter.set_heartbeat(DEADBAND_HEARTBEAT)
+        deadband_filter.set_idle_only(DEADBAND_IDLE_ONLY)
+
+    cycle_scheduler = CycleScheduler()
+    for signal_group, period in SAMPLING_PERIODS.items():
+        cycle_scheduler.add_signal_group(signal_group, period)
+
+    # the PLC reading runs on the scheduler (main) thread, the transform/validation, the daily aggregation and the
+    # writing to the spool each run on their own worker thread, connected by bounded queues
+    def transform_cycle(item):
+        item.cycle_frame = validate_cycle_frame(item.cycle_frame)
+        return item
+
+    def aggregate_cycle(item):
+        # the daily aggregates see every reading, the deadband only reduces the rows that are loaded
+        daily_aggregator.append_cycle(item.cycle_frame)
+        if deadband_filter is not None:
+            item.cycle_frame = deadband_filter.filter_cycle_frame(item.cycle_frame)
+        return item
+
+    def write_cycle(item):
+        # spool the cycle, including the setpoints that changed, and let the drainer load it to the database
+        cycle_spool.append_cycle(item.cycle_frame, item.setpoint_changes)
+        spool_drainer.wake()
+        # the live readings are the rows that are loaded, as the raw data endpoints return them
+        if live_publisher is not None:
+            live_publisher.publish(item.cycle_frame)
+        return item if archive_sink is not None else None
+
+    def archive_cycle(item):
+        archive_sink.append_cycle(item.cycle_frame)
+
+    etl_pipeline = ETLPipeline()
+    etl_pipeline.set_queue_size(PIPELINE_QUEUE_SIZE)
+    etl_pipeline.add_stage('transform', transform_cycle)
+    etl_pipeline.add_stage('aggregate', aggregate_cycle)
+    etl_pipeline.add_stage('write', write_cycle)
+    if archive_sink is not None:
+        etl_pipeline.add_stage('archive', archive_cycle)
+    etl_pipeline.add_gauge('read overruns', cycle_scheduler.overrun_count)
+    etl_pipeline.add_gauge('spooled rows', cycle_spool.pending_rows)
+    etl_pipeline.start(PIPELINE_REPORT_INTERVAL)
+
+    def run_cycle(time_log, signal_groups):
+        # query the due signal groups of all sensors from all PLCs in parallel into one cycle frame, the sessions to
+        # the PLCs stay open across cycles (reconnects with backoff). Blocks while the transform queue is full
+        cycle_frame, setpoint_changes = plc_poller.poll_cycle(time_log, signal_groups)
+        etl_pipeline.submit(CycleItem(time_log, cycle_frame, setpoint_changes))
+
+    try:
+        # the cycles run on wall-clock aligned ticks, all rows of a cycle are logged with the time of its tick
+        cycle_scheduler.run(run_cycle)
+
+    except KeyboardInterrupt:
+        plc_poller.close_connections()
+        etl_pipeline.shutdown(timeout = 60)
+        daily_aggregator.close(timeout = 60)
+        if archive_sink is not None:
+            archive_sink.flush()
+        spool_drainer.stop(timeout = 60)
+        if rollup_manager is not None:
+            rollup_manager.stop(timeout = 60)
+        if cache_invalidator is not None:
+            cache_invalidator.stop(timeout = 10)
+        if live_publisher is not None:
+            live_publisher.stop(timeout = 10)
+        cycle_spool.close()
+        log_listener.stop()
 
 
 if __name__ == '__main__':
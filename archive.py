@@ -0,0 +1,140 @@
+import os
+import logging
+import uuid
+from datetime import datetime as dt
+from time import monotonic
+import numpy as np
+from transform import empty_cycle_frame
+
+# pyarrow is only needed when the parquet archive is enabled
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+# columns that rarely change between rows, dictionary encoding stores each distinct value once per row group
+DICTIONARY_COLUMNS = ['Zvelbase', 'Zaccbase', 'Xvelbase', 'Xaccbase',
+                      'Zvelwarn', 'Zaccwarn', 'Xvelwarn', 'Xaccwarn',
+                      'Zvelalarm', 'Zaccalarm', 'Xvelalarm', 'Xaccalarm',
+                      'Tempwarn', 'Tempalarm', 'MotorRunFlag']
+
+
+class ParquetArchiveSink:
+
+    def __init__(self):
+        if pa is None:
+            raise ImportError('The parquet archive requires the pyarrow package')
+
+        self._archive_dir = None
+        self._flush_interval = 900.0
+        self._compact_interval = 86400.0
+        self._buffer = []
+        self._flushed_at = monotonic()
+        self._compacted_at = None
+
+    def set_archive_dir(self, archive_dir):
+        """
+        Set the root directory of the archive, the files are partitioned as <archive_dir>/date=YYYY-MM-DD/sensorID=<id>/
+        """
+        self._archive_dir = archive_dir
+        return None
+
+    def set_archive_policy(self, flush_interval, compact_interval):
+        """
+        Set the time (seconds) cycles are buffered before they are written to the archive, and the time between two
+        compactions of the small files of past days
+        """
+        self._flush_interval = flush_interval
+        self._compact_interval = compact_interval
+        return None
+
+    def append_cycle(self, cycle_frame):
+        """
+        Append a cycle frame to the archive. The cycles are buffered and written every flush interval, and the past days
+        are compacted every compact interval
+        """
+        if len(cycle_frame):
+            self._buffer.append(cycle_frame)
+
+        if monotonic() - self._flushed_at >= self._flush_interval:
+            self.flush()
+
+        if self._compacted_at is None or monotonic() - self._compacted_at >= self._compact_interval:
+            self.compact()
+
+        return None
+
+    def _write_table(self, table, path):
+        # write to a temporary file first, so readers never see a partially written file
+        _tmp_path = path + '.tmp'
+        pq.write_table(table, _tmp_path, compression = 'zstd',
+                       use_dictionary = DICTIONARY_COLUMNS,
+                       column_encoding = {'time_log': 'DELTA_BINARY_PACKED'})
+        os.replace(_tmp_path, path)
+        return None
+
+    def flush(self):
+        """
+        Write the buffered cycles to the archive, one file per date and sensorID partition
+        """
+        _frame = np.concatenate([empty_cycle_frame()] + self._buffer)
+        self._buffer = []
+        self._flushed_at = monotonic()
+        if not len(_frame):
+            return None
+
+        _frame = _frame[np.lexsort((_frame['time_log'], _frame['sensorID']))]
+        _dates = _frame['time_log'].astype('M8[D]')
+        _columns = [x for x in _frame.dtype.names if x != 'sensorID']
+
+        # the rows of a partition are contiguous after sorting by date and sensorID
+        _keys = np.stack([_dates.astype(np.int64), _frame['sensorID'].astype(np.int64)], axis = 1)
+        _starts = np.flatnonzero(np.r_[True, (_keys[1:] != _keys[:-1]).any(axis = 1)])
+        for _start, _end in zip(_starts, np.r_[_starts[1:], len(_frame)]):
+            _partition = _frame[_start:_end]
+            _partition_dir = os.path.join(self._archive_dir, f'date={_dates[_start]}',
+                                          f"sensorID={_partition['sensorID'][0]}")
+            os.makedirs(_partition_dir, exist_ok = True)
+
+            # the partition columns are stored in the directory names only
+            _table = pa.table({_name: np.ascontiguousarray(_partition[_name]) for _name in _columns})
+            self._write_table(_table, os.path.join(_partition_dir, f'part-{uuid.uuid4().hex}.parquet'))
+
+        logging.info(f'Archived {len(_frame)} rows in {len(_starts)} partitions')
+        return None
+
+    def compact(self):
+        """
+        Merge the files of every partition of a past day into a single file sorted by time_log
+        """
+        self._compacted_at = monotonic()
+        if self._archive_dir is None or not os.path.isdir(self._archive_dir):
+            return None
+
+        _today = f'date={dt.now().date()}'
+        for _date_dir in sorted(os.listdir(self._archive_dir)):
+            if not _date_dir.startswith('date=') or _date_dir >= _today:
+                continue
+
+            for _sensor_dir in sorted(os.listdir(os.path.join(self._archive_dir, _date_dir))):
+                _partition_dir = os.path.join(self._archive_dir, _date_dir, _sensor_dir)
+                _files = sorted(x for x in os.listdir(_partition_dir) if x.endswith('.parquet'))
+                if len(_files) < 2:
+                    continue
+
+                try:
+                    _table = pa.concat_tables([pq.read_table(os.path.join(_partition_dir, x)) for x in _files])
+                    # drop repeated rows, e.g. of a compaction that was interrupted before it removed its input files
+                    _table = _table.sort_by('time_log')
+                    _time_log = _table['time_log'].to_numpy()
+                    _table = _table.filter(pa.array(np.r_[True, _time_log[1:] != _time_log[:-1]]))
+                    self._write_table(_table, os.path.join(_partition_dir, f'part-{uuid.uuid4().hex}.parquet'))
+                    for _file in _files:
+                        os.remove(os.path.join(_partition_dir, _file))
+                except Exception as e:
+                    logging.warning(f'Failed to compact archive partition {_partition_dir} due to {str(e)}')
+
+        return None
@@ -0,0 +1,253 @@
+import logging
+import threading
+import json
+from collections import OrderedDict
+from time import monotonic
+from urllib import request as urlrequest
+from urllib.parse import urlencode
+
+
+def normalize_args(args):
+    """
+    Return the query parameters of a request as a hashable key, independent of their order, empty parameters and the
+    order and duplicates of the ids of the *_ids parameters
+    """
+    _items = []
+    for _name, _value in args.items(multi = True):
+        _value = _value.strip()
+        if not _value:
+            continue
+        if _name.endswith('_ids'):
+            _ids = set(x.strip() for x in _value.split(',')) - {''}
+            _value = ','.join(sorted(_ids, key = lambda x: (len(x), x)))
+        _items.append((_name, _value))
+    return tuple(sorted(_items))
+
+
+class ResponseCache:
+
+    def __init__(self):
+        self._ttls = {}
+        self._max_bytes = 64*1024*1024
+        self._lock = threading.Lock()
+        # {(endpoint, args): (expires at, tables, body, status, headers)}, least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def set_ttls(self, ttls):
+        """
+        Set the time (seconds) the responses of each endpoint are cached {endpoint: ttl}, endpoints without a ttl are not
+        cached
+        """
+        self._ttls = ttls
+        return None
+
+    def set_max_bytes(self, max_bytes):
+        """
+        Set the memory (bytes of the response bodies) of all cached responses, the least recently used responses are
+        dropped first when it is exceeded
+        """
+        self._max_bytes = max_bytes
+        return None
+
+    def cacheable(self, endpoint):
+        return endpoint in self._ttls
+
+    def get(self, endpoint, args):
+        """
+        Return the cached (body, status, headers) of an endpoint and normalized query parameters, None when there is no
+        response or it expired
+        """
+        _key = (endpoint, args)
+        with self._lock:
+            _entry = self._entries.get(_key)
+            if _entry is None or _entry[0] <= monotonic():
+                if _entry is not None:
+                    self._drop(_key)
+                return None
+            self._entries.move_to_end(_key)
+            return _entry[2:]
+
+    def put(self, endpoint, args, tables, body, status, headers):
+        """
+        Cache the response of an endpoint and normalized query parameters, it is dropped when one of tables changes
+        (see invalidate). Responses larger than a quarter of the memory are not cached
+        """
+        if endpoint not in self._ttls or len(body) > self._max_bytes // 4:
+            return None
+
+        _key = (endpoint, args)
+        with self._lock:
+            if _key in self._entries:
+                self._drop(_key)
+            self._entries[_key] = (monotonic() + self._ttls[endpoint], frozenset(x.lower() for x in tables), body,
+                                   status, headers)
+            self._bytes += len(body)
+            while self._bytes > self._max_bytes:
+                self._drop(next(iter(self._entries)))
+
+        return None
+
+    def _drop(self, key):
+        self._bytes -= len(self._entries.pop(key)[2])
+        return None
+
+    def invalidate(self, tables = None):
+        """
+        Drop the cached responses that depend on one of the tables, all responses when tables is None. Return the number
+        of responses dropped
+        """
+        _tables = None if tables is None else set(x.lower() for x in tables)
+        with self._lock:
+            _keys = [_key for _key, _entry in self._entries.items() if _tables is None or _entry[1] & _tables]
+            for _key in _keys:
+                self._drop(_key)
+
+        return len(_keys)
+
+
+class ValidatorCache:
+    """
+    The validators of the conditional GETs (see conditional in flaskapp.py) per endpoint and normalized query
+    parameters, kept as long as the responses of the endpoint (see ResponseCache) and dropped with them when one of
+    their tables changes. At most max_entries validators, the least recently used are dropped first
+    """
+
+    def __init__(self):
+        self._ttls = {}
+        self._max_entries = 10000
+        self._lock = threading.Lock()
+        # {(endpoint, args): (expires at, tables, validator)}, least recently used first
+        self._entries = OrderedDict()
+
+    def set_ttls(self, ttls):
+        """
+        Set the time (seconds) the validators of each endpoint are cached {endpoint: ttl}, see ResponseCache.set_ttls
+        """
+        self._ttls = ttls
+        return None
+
+    def get(self, endpoint, args):
+        """
+        Return the cached validator of an endpoint and normalized query parameters, None when there is none or it expired
+        """
+        _key = (endpoint, args)
+        with self._lock:
+            _entry = self._entries.get(_key)
+            if _entry is None or _entry[0] <= monotonic():
+                self._entries.pop(_key, None)
+                return None
+            self._entries.move_to_end(_key)
+            return _entry[2]
+
+    def put(self, endpoint, args, tables, validator):
+        """
+        Cache the validator of an endpoint and normalized query parameters, it is dropped when one of tables changes
+        """
+        if endpoint not in self._ttls:
+            return None
+
+        _key = (endpoint, args)
+        with self._lock:
+            self._entries.pop(_key, None)
+            self._entries[_key] = (monotonic() + self._ttls[endpoint], frozenset(x.lower() for x in tables), validator)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last = False)
+
+        return None
+
+    def invalidate(self, tables = None):
+        """
+        Drop the validators that depend on one of the tables, all validators when tables is None
+        """
+        _tables = None if tables is None else set(x.lower() for x in tables)
+        with self._lock:
+            for _key in [_key for _key, _entry in self._entries.items() if _tables is None or _entry[1] & _tables]:
+                del self._entries[_key]
+
+        return None
+
+
+class CacheInvalidator:
+    """
+    Tell the API which tables the ETL changed, so it drops the cached responses of those tables. The changes are
+    collected and posted to the invalidation endpoint of the API on a background thread, at most once per interval, so
+    the loading never waits for the API
+    """
+
+    def __init__(self, url, token):
+        self._url = url
+        self._token = token
+        self._interval = 1.0
+        self._timeout = 2.0
+        self._lock = threading.Lock()
+        self._tables = set()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set_interval(self, interval):
+        """
+        Set the shortest time (seconds) between two posts to the API
+        """
+        self._interval = interval
+        return None
+
+    def start(self):
+        """
+        Post the changes on a background thread. Raise ValueError without a token
+        """
+        if not self._token:
+            raise ValueError('The API is not notified without a token')
+        self._thread = threading.Thread(target = self._run, name = 'cache-invalidator', daemon = True)
+        self._thread.start()
+        return None
+
+    def stop(self, timeout = None):
+        """
+        Post the remaining changes and stop
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return None
+
+    def tables_changed(self, tables):
+        """
+        Record that the ETL committed changes to the tables
+        """
+        with self._lock:
+            self._tables.update(tables)
+        self._wakeup.set()
+        return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self._post()
+            self._stop.wait(self._interval)
+
+        self._post()
+        return None
+
+    def _post(self):
+        with self._lock:
+            _tables, self._tables = self._tables, set()
+        if not _tables:
+            return None
+
+        try:
+            _data = urlencode({'tables': ','.join(sorted(_tables))}).encode()
+            _request = urlrequest.Request(self._url, data = _data, headers = {'X-Cache-Token': self._token})
+            with urlrequest.urlopen(_request, timeout = self._timeout) as _response:
+                _dropped = json.loads(_response.read()).get('dropped')
+            logging.debug('Invalidated %s cached API responses of %s', _dropped, sorted(_tables),
+                          extra = {'event': 'cache_invalidated'})
+        except Exception as e:
+            # the API is not running or not reachable, its responses expire by their ttl
+            logging.debug(f'Failed to invalidate the cached API responses due to {str(e)}',
+                          extra = {'event': 'cache_invalidate_failed', 'tables': sorted(_tables)})
+
+        return None
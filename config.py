@@ -1,4 +1,103 @@
+import os
+
 SERVER_IP = '172.31.73.89'
 SENSOR_COUNT = 25
 SERVER = 'PBI11305\SQLEXPRESS'
-DATABASE = 'conditionbasedmonitoring'
\ No newline at end of file
+DATABASE = 'conditionbasedmonitoring'
+STORAGE_BACKEND = 'sqlserver'       # 'sqlserver' (SERVER and DATABASE) or the embedded 'sqlite' database (SQLITE_PATH)
+SQLITE_PATH = 'conditionbasedmonitoring.db'
+PLC_TIMEOUT = 5.0                   # seconds
+PLC_KEEPALIVE_INTERVAL = 60.0       # seconds of idle time before the PLC session is probed
+PLC_RECONNECT_BASE_DELAY = 1.0      # seconds
+PLC_RECONNECT_MAX_DELAY = 120.0     # seconds
+SETPOINT_CHECKSUM_REGISTER = None   # register that changes with any setpoint change, re-read the setpoints on change
+
+# PLCs polled in parallel by the ETL, the sensors of a PLC are stored with sensorIDs starting at its sensor_id_offset
+PLC_SERVERS = [
+    {'server_ip': SERVER_IP, 'sensor_count': SENSOR_COUNT, 'sensor_id_offset': 0},
+]
+PLC_POLL_TIMEOUT = 8.0              # seconds a PLC gets to deliver its data in a polling cycle
+
+# sampling period (whole seconds) of each signal group, the cycles fire on ticks aligned to the wall clock
+SAMPLING_PERIODS = {
+    'live': 10,                     # vibration, temperature and motor run flag
+    'additional': 60,               # additional vibration statistics
+    'setpoints': 3600,              # vibration thresholds and temperature setpoints
+}
+
+SPOOL_PATH = 'cyclespool.db'        # local store-and-forward spool of the cycles that are not loaded to the database yet
+SPOOL_BATCH_ROWS = 5000             # rows replayed from the spool per database transaction
+SPOOL_RETRY_INTERVAL = 30.0         # seconds to wait before the database is tried again after a failure
+
+PIPELINE_QUEUE_SIZE = 16            # cycles queued between the ETL stages before the stage feeding the queue blocks
+PIPELINE_REPORT_INTERVAL = 300.0    # seconds between the logged queue depth and throughput statistics of the stages
+
+ARCHIVE_DIR = None                  # root directory of the parquet archive of all cycles, None to disable the archive
+ARCHIVE_FLUSH_INTERVAL = 900.0      # seconds the cycles are buffered before they are written to the archive
+ARCHIVE_COMPACT_INTERVAL = 86400.0  # seconds between compactions of the archive files of past days
+
+# daily aggregates (medians and statistics per sensor and day) the ETL maintains in the dailytable
+DAILY_UPSERT_INTERVAL = 60.0        # seconds between two upserts of the changed aggregates
+DAILY_MAX_DAYS = 7                  # past days kept while their upserts fail, older days are dropped
+
+# rollup tiers (1m, 1h, 1d means per sensor, see rollup.py) of the machinedatatable, and the days each tier keeps its
+# rows ('raw' is the machinedatatable itself, None keeps the rows forever)
+ROLLUP_ENABLED = True
+ROLLUP_INTERVAL = 60.0              # seconds between two rollup runs
+ROLLUP_CHUNK_ROWS = 50000           # raw rows rolled up or purged per transaction
+ROLLUP_RETENTION_DAYS = {'raw': None, '1m': 180, '1h': 730, '1d': None}
+ROLLUP_MAX_POINTS = 5000            # the API reads the finest tier with at most this many points per sensor
+
+# optional change-based write suppression (see DeadbandFilter in transform.py), the rows of a sensor are only loaded
+# when a signal moved past its band {column: (absolute band, relative band)}, the motor or a setpoint changed, or the
+# heartbeat passed. The daily aggregates are computed before the suppression
+DEADBAND_ENABLED = False
+DEADBAND_BANDS = {'Zvel': (0.05, 0.05), 'Zacc': (0.005, 0.05), 'Xvel': (0.05, 0.05), 'Xacc': (0.005, 0.05),
+                  'Temp': (0.5, 0.0), 'ZpeakAcc': (0.01, 0.05), 'XpeakAcc': (0.01, 0.05), 'ZpeakVel': (0.1, 0.05),
+                  'XpeakVel': (0.1, 0.05), 'ZRMSlowAcc': (0.005, 0.05), 'XRMSlowAcc': (0.005, 0.05)}
+DEADBAND_HEARTBEAT = 300.0          # seconds, longest time between two loaded rows of a sensor
+DEADBAND_IDLE_ONLY = True           # only suppress rows of stopped motors
+
+# the ETL logs JSON lines (see logconfig.py), written on a background thread to a rotating file
+LOG_PATH = 'applog.log'
+LOG_MAX_BYTES = 10*1024*1024        # size of a log file before it is rotated
+LOG_BACKUP_COUNT = 10               # rotated log files that are kept
+LOG_ROTATE_WHEN = None              # rotate by time instead of size, e.g. 'midnight'
+LOG_RATE_LIMIT = 20                 # records per event and LOG_RATE_INTERVAL, the rest is counted and dropped
+LOG_RATE_INTERVAL = 60.0
+LOG_SAMPLE_EVERY = {'row_loaded': 100, 'batch_loaded': 100}     # only every n-th record of these success events
+
+# connection pool of the API (see ConnectionPool in storage.py)
+API_POOL_MIN_SIZE = 1               # connections kept open when idle
+API_POOL_MAX_SIZE = 8               # connections open at once, further requests wait for a free one
+API_POOL_HEALTH_CHECK_AFTER = 30.0  # seconds idle after which a connection is probed before it is used
+API_POOL_IDLE_TIMEOUT = 600.0       # seconds idle after which connections above the minimum are closed
+API_STREAM_BATCH_ROWS = 5000        # rows fetched per batch of the streamed (format=ndjson) responses
+API_EXPORT_BATCH_ROWS = 50000       # rows per chunk of the exports (/cbmdata/export), a record batch or a row group
+
+# response cache of the API (see ResponseCache in cache.py) {endpoint: seconds a response is cached}, the ETL posts the
+# tables it changed to the invalidation endpoint of the API, which drops the cached responses of those tables
+API_CACHE_ENABLED = True
+API_CACHE_MAX_BYTES = 64*1024*1024  # bytes of all cached responses, the least recently used are dropped first
+API_CACHE_TTLS = {'compressorlist': 3600.0, 'sensorlist': 3600.0, 'dailydata': 300.0, 'dailydata/latest': 300.0,
+                  'rawdata': 10.0, 'addvibdata': 10.0, 'motorstatus': 10.0, 'aggregate': 60.0}
+API_CACHE_INVALIDATE_URL = 'http://127.0.0.1:5000/cbmdata/cache/invalidate'  # None to not notify the API
+API_CACHE_INVALIDATE_INTERVAL = 1.0 # shortest time (seconds) between two notifications
+# shared by the ETL and the API, set on deployment in the environment, the API accepts no notifications without it
+API_CACHE_INVALIDATE_TOKEN = os.environ.get('CBM_CACHE_INVALIDATE_TOKEN') or None
+
+# compression of the API responses, negotiated with the Accept-Encoding of the client (brotli needs the brotli package)
+API_COMPRESSION_MIN_BYTES = 1024    # smaller responses are sent uncompressed
+API_GZIP_LEVEL = 6
+API_BROTLI_QUALITY = 5
+
+# live readings (see live.py), the ETL keeps the latest readings of each sensor in memory and publishes every cycle to
+# the API over a local socket, the API serves its copy as an event stream and a recent window without the database
+LIVE_ENABLED = False
+LIVE_ADDRESS = ('127.0.0.1', 6001)  # address the ETL listens on for the API, a file path for a Unix socket
+# shared by the ETL and the API, set on deployment in the environment, the live readings are not started without it
+LIVE_AUTHKEY = os.environ['CBM_LIVE_AUTHKEY'].encode() if os.environ.get('CBM_LIVE_AUTHKEY') else None
+LIVE_WINDOW_HOURS = 6.0             # hours of readings kept of each sensor
+LIVE_MAX_ROWS = 4096                # readings kept at most of each sensor
+LIVE_QUEUE_SIZE = 100               # cycles queued for an API process before it is disconnected
+LIVE_KEEPALIVE = 15.0               # seconds between the keepalives of an idle event stream
\ No newline at end of file
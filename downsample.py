@@ -0,0 +1,118 @@
+import numpy as np
+
+
+DOWNSAMPLE_METHODS = ['lttb', 'minmax']
+
+
+def lttb_indices(x, y, max_points):
+    """
+    Return the indices of the max_points points of a series that Largest-Triangle-Three-Buckets keeps, x (n,) ordered
+    and y (n, k) with the k signals of each point normalized to a common range. The first and the last point are kept,
+    the inner points are split into max_points - 2 buckets of equal count, and of each bucket the point that spans the
+    largest triangle (summed over the signals) with the point kept of the previous bucket and the mean of the next
+    bucket is kept. The buckets depend on each other through the kept point, so they are walked one by one with the
+    areas of a bucket computed at once
+    """
+    _n = len(x)
+    if _n <= max_points:
+        return np.arange(_n)
+
+    # bucket i holds the points _edges[i] <= index < _edges[i + 1]
+    _edges = np.linspace(1, _n - 1, max_points - 1).astype(np.int64)
+    _counts = np.diff(_edges)
+    _mean_x = np.add.reduceat(x[:_n - 1], _edges[:-1]) / _counts
+    # the mean of each signal without its missing (NaN) values
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        _mean_y = (np.add.reduceat(np.nan_to_num(y[:_n - 1]), _edges[:-1], axis = 0)
+                   / np.add.reduceat(~np.isnan(y[:_n - 1]), _edges[:-1], axis = 0))
+    # the third point of a bucket is the mean of the next bucket, the last point for the last bucket
+    _next_x = np.append(_mean_x[1:], x[-1])
+    _next_y = np.vstack([_mean_y[1:], y[-1:]])
+
+    _indices = np.empty(max_points, dtype = np.int64)
+    _indices[0] = 0
+    _indices[-1] = _n - 1
+    _a = 0
+    for _bucket in range(max_points - 2):
+        _first, _last = _edges[_bucket], _edges[_bucket + 1]
+        _areas = np.abs((x[_a] - _next_x[_bucket]) * (y[_first:_last] - y[_a])
+                        - (x[_a] - x[_first:_last, None]) * (_next_y[_bucket] - y[_a]))
+        # a missing signal does not count towards the area
+        _a = _first + int(np.argmax(np.nansum(_areas, axis = 1)))
+        _indices[_bucket + 1] = _a
+
+    return _indices
+
+
+def minmax_indices(y, max_points):
+    """
+    Return the indices of the points of a series with the minimum and the maximum of each of the k signals of y (n, k)
+    in buckets of equal count, and the first and the last point, at most max_points indices. Keeps every peak of the
+    series at the resolution of the buckets. With fewer than 2k + 2 points, the buckets keep the lowest and the highest
+    point of all signals normalized to a common range instead
+    """
+    _n, _k = y.shape
+    if _n <= max_points:
+        return np.arange(_n)
+
+    _low = _high = y
+    if 2*_k > max_points - 2:
+        _min, _max = np.fmin.reduce(y, axis = 0), np.fmax.reduce(y, axis = 0)
+        _scaled = (y - _min) / np.where(_max > _min, _max - _min, 1.0)
+        _low, _high = np.fmin.reduce(_scaled, axis = 1)[:, None], np.fmax.reduce(_scaled, axis = 1)[:, None]
+    # a single point between the first and the last is the highest of its bucket
+    _extrema = 2 if max_points >= 4 else 1
+
+    _buckets = max(1, (max_points - 2) // (_extrema*_low.shape[1]))
+    _edges = np.linspace(0, _n, _buckets + 1).astype(np.int64)
+    # the indices of the points of each bucket as rows of a matrix, the shorter buckets padded with their last point
+    _index = _edges[:-1, None] + np.arange(np.diff(_edges).max())
+    _index = np.minimum(_index, _edges[1:, None] - 1)
+    _rows = np.arange(_buckets)[:, None]
+    _maxima = _index[_rows, np.where(np.isnan(_high[_index]), -np.inf, _high[_index]).argmax(axis = 1)]
+    _minima = _index[_rows, np.where(np.isnan(_low[_index]), np.inf, _low[_index]).argmin(axis = 1)]
+    if _extrema == 1:
+        _minima = _minima[:0]
+
+    return np.unique(np.concatenate([[0, _n - 1], _minima.ravel(), _maxima.ravel()]))
+
+
+def downsample_rows(rows, columns, max_points, method = 'lttb'):
+    """
+    Reduce the rows of each sensor (row[4]) of a raw data query to at most max_points rows with the method 'lttb' (see
+    lttb_indices) or 'minmax' (see minmax_indices), by the time_log (row[6]) and the signals in the given columns of the
+    rows. Return the kept rows ordered by time_log
+    """
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f'Unknown downsample method {method}')
+    if max_points < 3:
+        raise ValueError('max_points must be at least 3')
+
+    _sensors = {}
+    for _row in rows:
+        _sensors.setdefault(_row[4], []).append(_row)
+
+    _kept = []
+    for _rows in _sensors.values():
+        if len(_rows) <= max_points:
+            _kept.extend(_rows)
+            continue
+
+        _rows.sort(key = lambda x: (x[6], x[0]))
+        _x = np.array([x[6].timestamp() for x in _rows])
+        _y = np.array([[x[_column] for _column in columns] for x in _rows], dtype = np.float64)
+        if method == 'lttb':
+            # the rows without any signal are never kept, as in minmax_indices
+            _valid = np.flatnonzero(~np.isnan(_y).all(axis = 1))
+            if not len(_valid):
+                _valid = np.array([0, len(_rows) - 1])
+            # the signals are weighted equally, whatever their unit
+            _low, _high = np.fmin.reduce(_y[_valid], axis = 0), np.fmax.reduce(_y[_valid], axis = 0)
+            _span = np.where(_high > _low, _high - _low, 1.0)
+            _indices = _valid[lttb_indices(_x[_valid] - _x[_valid[0]], (_y[_valid] - _low) / _span, max_points)]
+        else:
+            _indices = minmax_indices(_y, max_points)
+        _kept.extend(_rows[x] for x in _indices.tolist())
+
+    _kept.sort(key = lambda x: x[6])
+    return _kept
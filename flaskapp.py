@@ -1,69 +1,374 @@
-from flask import Flask, request, jsonify, make_response, send_file
-from apibackend import compressor_extract_class
-from datetime import datetime as dt
-from config import SERVER, DATABASE
+from flask import Flask, request, jsonify, make_response, send_file, Response, g
+from apibackend import compressor_extract_class, export_chunks
+from datetime import datetime as dt, timezone
+from itertools import chain, groupby
+from functools import wraps
+import logging
+import json
+import gzip
+import zlib
+import hashlib
+import hmac
+import numpy as np
+from storage import create_storage
+from cache import ResponseCache, ValidatorCache, normalize_args
+from live import LiveBuffer, LiveSubscriber, SensorNames
+from rollup import ROLLUP_TIERS, rollup_table
+from config import SERVER, DATABASE, STORAGE_BACKEND, SQLITE_PATH
+from config import ROLLUP_ENABLED, ROLLUP_RETENTION_DAYS, ROLLUP_MAX_POINTS, SAMPLING_PERIODS
+from config import DEADBAND_ENABLED, DEADBAND_HEARTBEAT
+from config import API_POOL_MIN_SIZE, API_POOL_MAX_SIZE, API_POOL_HEALTH_CHECK_AFTER, API_POOL_IDLE_TIMEOUT
+from config import API_STREAM_BATCH_ROWS, API_EXPORT_BATCH_ROWS
+from config import API_CACHE_ENABLED, API_CACHE_MAX_BYTES, API_CACHE_TTLS, API_CACHE_INVALIDATE_TOKEN
+from config import API_COMPRESSION_MIN_BYTES, API_GZIP_LEVEL, API_BROTLI_QUALITY
+from config import LIVE_ENABLED, LIVE_ADDRESS, LIVE_AUTHKEY, LIVE_WINDOW_HOURS, LIVE_MAX_ROWS, LIVE_KEEPALIVE
+
+# brotli is only offered to the clients when the brotli package is installed, gzip always
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 
 db_instance = compressor_extract_class()
-db_instance.set_database_credentials(SERVER, DATABASE)
+db_instance.set_storage(create_storage(STORAGE_BACKEND, SERVER, DATABASE, SQLITE_PATH))
+db_instance.set_connection_pool(API_POOL_MIN_SIZE, API_POOL_MAX_SIZE, API_POOL_HEALTH_CHECK_AFTER,
+                                API_POOL_IDLE_TIMEOUT)
+if ROLLUP_ENABLED:
+    db_instance.set_rollup_policy(ROLLUP_MAX_POINTS, ROLLUP_RETENTION_DAYS, SAMPLING_PERIODS['live'])
+if DEADBAND_ENABLED:
+    db_instance.set_deadband_heartbeat(DEADBAND_HEARTBEAT)
+
+response_cache = ResponseCache()
+if API_CACHE_ENABLED:
+    response_cache.set_ttls(API_CACHE_TTLS)
+    response_cache.set_max_bytes(API_CACHE_MAX_BYTES)
+
+# the validators of the raw data routes (see conditional), cached and dropped like their responses so a cached response
+# costs no query
+validator_cache = ValidatorCache()
+if API_CACHE_ENABLED:
+    validator_cache.set_ttls(API_CACHE_TTLS)
+
+# the live readings are kept in step with the ETL (see live.py), every worker process of the API has its own copy.
+# None while the live readings are disabled or not subscribed to (see live_only)
+live_buffer = None
+sensor_names = None
+if LIVE_ENABLED:
+    live_buffer = LiveBuffer()
+    live_buffer.set_window(LIVE_WINDOW_HOURS, LIVE_MAX_ROWS)
+    live_subscriber = LiveSubscriber(live_buffer, LIVE_ADDRESS, LIVE_AUTHKEY)
+    try:
+        live_subscriber.start()
+        sensor_names = SensorNames(db_instance.query_sensor_names)
+    except ValueError as e:
+        logging.warning(f'Failed to subscribe to the live readings due to {str(e)}')
+        live_buffer = None
+
+# tables the raw data endpoints read, depending on the resolution
+RAW_DATA_TABLES = ['machinedatatable'] + [rollup_table(x) for x, _minutes in ROLLUP_TIERS]
+
+# responses that are compressed, Parquet files are compressed already
+COMPRESSED_MIMETYPES = ['application/json', 'application/x-ndjson', 'text/csv', 'application/vnd.apache.arrow.stream']
+
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'arrow': 'application/vnd.apache.arrow.stream',
+                    'parquet': 'application/vnd.apache.parquet'}
+
+
+def error_response(error, status = 200):
+    """
+    Return the {'error': ...} response of a failed request with the status, marked so it is not cached (see cached)
+    """
+    g.no_cache = True
+    return jsonify({'error': error}), status
+
+def cached(endpoint, tables):
+    """
+    Serve the responses of a route from the response cache, keyed on the normalized query parameters, until they expire
+    or one of the tables changes. Streamed responses and errors (see error_response) are not cached
+    """
+    def decorator(route):
+        @wraps(route)
+        def cached_route():
+            if not response_cache.cacheable(endpoint):
+                return route()
+
+            # the validator of the rows (see conditional) is part of the key, a changed validator is a new response
+            _args = (normalize_args(request.args), g.get('validator'))
+            _cached = response_cache.get(endpoint, _args)
+            if _cached is not None:
+                return Response(*_cached)
+
+            _response = make_response(route())
+            if _response.status_code == 200 and not _response.is_streamed and not g.get('no_cache'):
+                response_cache.put(endpoint, _args, tables, _response.get_data(), _response.status_code,
+                                   list(_response.headers))
+            return _response
+
+        return cached_route
+    return decorator
+
+def conditional(kind, endpoint):
+    """
+    Answer conditional GETs (If-None-Match, If-Modified-Since) of a raw data route from the validator of its rows (see
+    query_validator) with 304 Not Modified before the rows are read, and send the ETag and Last-Modified of the
+    validator with the full responses. The validator is cached like the responses of the endpoint
+    """
+    def decorator(route):
+        @wraps(route)
+        def conditional_route():
+            _args = normalize_args(request.args)
+            _validator = validator_cache.get(endpoint, _args)
+            if _validator is None:
+                try:
+                    _validator = db_instance.query_validator(kind, request.args.get('compressor_ids'),
+                                                             request.args.get('sensor_ids'),
+                                                             request.args.get('start_date'),
+                                                             request.args.get('end_date'),
+                                                             request.args.get('resolution', 'auto'))
+                except ValueError as e:
+                    # invalid parameters
+                    return error_response(str(e), 400)
+                validator_cache.put(endpoint, _args, RAW_DATA_TABLES, _validator)
+
+            # weak, the compressed bodies of a response differ by their encoding
+            _etag = hashlib.sha1(repr((_validator, _args)).encode()).hexdigest()
+            g.validator = _etag
+            # the time_log is logged in local time. Rows loaded late from the spool may be older than the latest
+            # time_log, the ETag (which also counts the rows) takes precedence when the client sends both
+            _last_modified = _validator[2] and _validator[2].astimezone(timezone.utc)
+            if request.if_none_match:
+                _not_modified = request.if_none_match.contains_weak(_etag)
+            else:
+                _not_modified = bool(request.if_modified_since and _last_modified
+                                     and _last_modified.replace(microsecond = 0) <= request.if_modified_since)
+
+            _response = Response(status = 304) if _not_modified else make_response(route())
+            if _response.status_code in (200, 304):
+                _response.set_etag(_etag, weak = True)
+                if _last_modified:
+                    _response.last_modified = _last_modified
+            return _response
+
+        return conditional_route
+    return decorator
+
+def live_only(route):
+    """
+    Answer a live route with 503 Service Unavailable while the live readings are disabled or not subscribed to
+    """
+    @wraps(route)
+    def live_route():
+        if live_buffer is None:
+            return error_response('error503', 503)
+        return route()
+
+    return live_route
+
+def compress_chunks(chunks, encoding):
+    # compress the chunks of a streamed response, every chunk is flushed so the client can decode it right away
+    if encoding == 'br':
+        _compressor = brotli.Compressor(quality = API_BROTLI_QUALITY)
+        _compress, _flush, _finish = _compressor.process, _compressor.flush, _compressor.finish
+    else:
+        # wbits 31 writes the gzip header and trailer
+        _compressor = zlib.compressobj(API_GZIP_LEVEL, zlib.DEFLATED, 31)
+        _compress, _finish = _compressor.compress, _compressor.flush
+        _flush = lambda: _compressor.flush(zlib.Z_SYNC_FLUSH)
+    try:
+        for _chunk in chunks:
+            yield _compress(_chunk.encode() if isinstance(_chunk, str) else _chunk) + _flush()
+        yield _finish()
+    finally:
+        # release the pooled connection of a streamed query when the client disconnects
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+@app.after_request
+def compress_response(response):
+    """
+    Compress the JSON, NDJSON, CSV and Arrow responses with the encoding the client accepts, brotli preferred over gzip. Streamed
+    responses are compressed chunk by chunk, small responses are sent as they are
+    """
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSED_MIMETYPES):
+        return response
+
+    _encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+    if _encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, _encoding)
+    else:
+        _body = response.get_data()
+        if len(_body) < API_COMPRESSION_MIN_BYTES:
+            return response
+        if _encoding == 'br':
+            response.set_data(brotli.compress(_body, quality = API_BROTLI_QUALITY))
+        else:
+            response.set_data(gzip.compress(_body, compresslevel = API_GZIP_LEVEL, mtime = 0))
+    response.headers['Content-Encoding'] = _encoding
+    return response
+
+# labels of the fields of the raw data rows in the readings
+FIELD_LABELS = {
+    "Zvel": "z-vel",
+    "Zacc": "z-acc",
+    "Xvel": "x-vel",
+    "Xacc": "x-acc",
+    "Temp": "temp",
+    "Zvelbase": "z-vel-baseline",
+    "Zaccbase": "z-acc-baseline",
+    "Xvelbase": "x-vel-baseline",
+    "Xaccbase": "x-acc-baseline",
+    "Zvelwarn": "z-vel-warning",
+    "Zaccwarn": "z-acc-warning",
+    "Xvelwarn": "x-vel-warning",
+    "Xaccwarn": "x-acc-warning",
+    "Tempwarn": "temp-warning",
+    "Zvelalarm": "z-vel-alarm",
+    "Zaccalarm": "z-acc-alarm",
+    "Xvelalarm": "x-vel-alarm",
+    "Xaccalarm": "x-acc-alarm",
+    "Tempalarm": "temp-alarm",
+    "ZpeakAcc": "z-peak-acc",
+    "XpeakAcc": "x-peak-acc",
+    "ZpeakVel": "z-peak-vel",
+    "XpeakVel": "x-peak-vel",
+    "ZRMSlowAcc": "z-rms-low-acc",
+    "XRMSlowAcc": "x-rms-low-acc",
+    "Zkurtosis": "z-kurtosis",
+    "Xkurtosis": "x-kurtosis",
+    "Zcrestfac": "z-crest-factor",
+    "Xcrestfac": "x-crest-factor",
+    "MotorRunFlag": "motor-run-flag"
+}
+
+def field_reading(fields):
+    # reading of the raw data rows with the given fields after the key columns (see resolve_fields)
+    _labels = [FIELD_LABELS[x] for x in fields]
+
+    def reading(data):
+        _reading = {"timestamp": dt.strftime(data[6], "%Y-%m-%d %H:%M:%S")}
+        _reading.update(zip(_labels, data[7:]))
+        return _reading
+
+    return reading
+
+def flat_reading(data, reading):
+    # reading of a raw data row with its compressor and sensor
+    return {'compressorid': data[1], 'compressorname': data[2], 'loc': data[3], 'sensorid': data[4],
+            'asensorname': data[5], **reading(data)}
+
+def ndjson_response(batches, reading):
+    """
+    Stream batches of rows as NDJSON, one reading per line with its compressor and sensor, while the next batch is
+    fetched. The first batch is fetched before the response starts, so a failing query still returns an error
+    """
+    _first = next(batches, None)
+
+    def generate():
+        for rows in chain([_first] if _first is not None else [], batches):
+            yield ''.join(json.dumps(flat_reading(data, reading)) + '\n' for data in rows)
+
+    return Response(generate(), mimetype = 'application/x-ndjson')
+
+def grouped_response(machine_data, reading):
+    # group the readings of rows of the raw data views by compressor and sensor
+    response = {}
+
+    for data in machine_data:
+        machine_id = data[1]
+        sensor_id = data[4]
+
+        if machine_id not in response:
+            response[machine_id] = {
+                                    'compressorname': data[2],
+                                    'loc': data[3],
+                                    'sensors': {}
+                                   }
+        if sensor_id not in response[machine_id]['sensors']:
+            response[machine_id]['sensors'][sensor_id] = {
+                                                            'asensorname': data[5],
+                                                            'data': []
+                                                        }
+        response[machine_id]['sensors'][sensor_id]["data"].append(reading(data))
+
+    return response
+
+def parse_ids(ids):
+    # the ids of a comma separated *_ids parameter as a set of integers, None for all
+    return set(int(x) for x in ids.split(',') if x.strip()) if ids else None
+
+def live_rows(frame, fields, compressor_ids = None):
+    """
+    Return the readings of the live buffer (a cycle frame) as rows of the raw data views (see RAW_DATA_KEY_COLUMNS in
+    apibackend.py) with the given fields, of the compressors (all when None) and the sensors in the SensorDataTable
+    """
+    _names = sensor_names.get(set(frame['sensorID'].tolist()))
+    rows = []
+    for _row in frame[['sensorID', 'time_log'] + list(fields)].tolist():
+        _sensor = _names[_row[0]]
+        if _sensor is None or (compressor_ids is not None and _sensor[0] not in compressor_ids):
+            continue
+        # missing signals are NaN in the cycle frames and NULL in the database
+        rows.append((None, *_sensor[:3], _row[0], _sensor[3], _row[1], *(None if x != x else x for x in _row[2:])))
+    return rows
+
+def page_response(machine_data, next_cursor, reading):
+    """
+    Respond with a page of rows (see query_page) as grouped JSON or NDJSON. The cursor of the next page is sent in the
+    X-Next-Cursor header, and next to the grouped readings in the JSON response
+    """
+    if request.args.get('format') == 'ndjson':
+        _response = ndjson_response(iter([machine_data]), reading)
+    else:
+        _response = jsonify({'data': grouped_response(machine_data, reading), 'next_cursor': next_cursor})
+    if next_cursor is not None:
+        _response.headers['X-Next-Cursor'] = next_cursor
+    return _response
 
 @app.route('/cbmdata/rawdata', methods = ['GET'])
-def get_sensor_data(db_instance):
+@conditional('machine_data', 'rawdata')
+@cached('rawdata', RAW_DATA_TABLES)
+def get_sensor_data():
     compressor_ids = request.args.get('compressor_ids')
     sensor_ids = request.args.get('sensor_ids')
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
+    resolution = request.args.get('resolution', 'auto')
+    limit = request.args.get('limit', type = int)
+    max_points = request.args.get('max_points', type = int)
+    downsample = request.args.get('downsample', 'lttb')
+    fields = request.args.get('fields')
     try:
-        machine_data = db_instance.query_machine_data(compressor_ids, sensor_ids, start_date, end_date)
-        
-        machine_data = sorted(machine_data, key = lambda x: x[6])
-        response = {}
+        raw_reading = field_reading(db_instance.resolve_fields('machine_data', fields))
+        if limit:
+            machine_data, next_cursor = db_instance.query_page('machine_data', compressor_ids, sensor_ids, start_date,
+                                                               end_date, resolution, request.args.get('after'), limit,
+                                                               fields)
+            return page_response(machine_data, next_cursor, raw_reading)
 
-        for data in machine_data:
-            machine_id = data[1]
-            sensor_id = data[4]
+        if request.args.get('format') == 'ndjson':
+            return ndjson_response(db_instance.stream_machine_data(compressor_ids, sensor_ids, start_date, end_date,
+                                                                   resolution, API_STREAM_BATCH_ROWS, max_points,
+                                                                   downsample, fields), raw_reading)
 
-            if machine_id not in response:
-                response[machine_id] = {
-                                        'compressorname': data[2],
-                                        'loc': data[3],
-                                        'sensors': {}
-                                       }
-            if sensor_id not in response[machine_id]['sensors']:
-                response[machine_id]['sensors'][sensor_id] = {
-                                                                'asensorname': data[5],
-                                                                'data': []
-                                                            }
-            response[machine_id]['sensors'][sensor_id]["data"].append({
-                "timestamp": dt.strftime(data[6], "%Y-%m-%d %H:%M:%S"),
-                "z-vel": data[7],
-                "z-acc": data[8],
-                "x-vel": data[9],
-                "x-acc": data[10],
-                "temp": data[11],
-                "z-vel-baseline": data[12],
-                'z-acc-baseline': data[13],
-                "x-vel-baseline": data[14],
-                "x-acc-baseline": data[15],
-                "z-vel-warning": data[16],
-                "z-acc-warning": data[17],
-                "x-vel-warning": data[18],
-                "x-acc-warning": data[19],
-                "temp-warning": data[20],
-                "z-vel-alarm": data[21],
-                "z-acc-alarm": data[22],
-                "x-vel-alarm": data[23],
-                "x-acc-alarm": data[24],
-                "temp-alarm": data[25]
-            })
+        machine_data = db_instance.query_machine_data(compressor_ids, sensor_ids, start_date, end_date, resolution,
+                                                      max_points, downsample, fields)
+        
+        machine_data = sorted(machine_data, key = lambda x: x[6])
 
-        return jsonify(response)
+        return jsonify(grouped_response(machine_data, raw_reading))
     except:
-        return jsonify({'error': 'error404'})
+        return error_response('error404')
     
 @app.route('/cbmdata/compressorlist', methods = ['GET'])
-def get_compressor_table(db_instance):
+@cached('compressorlist', ['MachineTable'])
+def get_compressor_table():
     try:
         compressor_data = db_instance.query_compressor_data()
         response = {}
@@ -76,10 +381,11 @@ def get_compressor_table(db_instance):
                                    }
         return jsonify(response)
     except:
-        return jsonify({'error': 'error404'})
+        return error_response('error404')
     
 @app.route('/cbmdata/sensorlist', methods = ['GET'])
-def get_sensor_table(db_instance):
+@cached('sensorlist', ['SensorDataTable'])
+def get_sensor_table():
     try:
         sensor_data = db_instance.query_sensor_data()
         response = {}
@@ -94,10 +400,11 @@ def get_sensor_table(db_instance):
         return jsonify(response)
         
     except:
-        return jsonify({'error': 'error404'})
+        return error_response('error404')
     
 @app.route('/cbmdata/dailydata', methods = ['GET'])
-def get_daily_data(db_instance):
+@cached('dailydata', ['dailytable'])
+def get_daily_data():
     compressor_ids = request.args.get('compressor_ids')
     sensor_ids = request.args.get('sensor_ids')
     start_date = request.args.get('start_date')
@@ -132,91 +439,145 @@ def get_daily_data(db_instance):
 
         return jsonify(response)
     except Exception as e:
-        return jsonify({'error': str(e)})
+        return error_response(str(e))
     
-@app.route('/cbmdata/addvibdata', methods = ['GET'])
-def get_add_vib_data(db_instance):
+@app.route('/cbmdata/aggregate', methods = ['GET'])
+@cached('aggregate', RAW_DATA_TABLES)
+def get_aggregate_data():
     compressor_ids = request.args.get('compressor_ids')
     sensor_ids = request.args.get('sensor_ids')
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
-    
-    machine_data = db_instance.query_additional_vibration_data(compressor_ids, sensor_ids, start_date, end_date)
-    response = {}
+    bucket = request.args.get('bucket', '1h')
+    columns = request.args.get('columns')
+    statistics = request.args.get('stats')
+    try:
+        aggregate_data = db_instance.query_aggregate_data(compressor_ids, sensor_ids, start_date, end_date, bucket,
+                                                          columns and columns.split(','),
+                                                          statistics and statistics.split(','))
+        response = {}
 
+        for data in aggregate_data:
+            machine_id = data[0]
+            sensor_id = data[3]
 
-    for data in machine_data:
-        machine_id = data[1]
-        sensor_id = data[4]
+            if machine_id not in response:
+                response[machine_id] = {
+                                        'compressorname': data[1],
+                                        'loc': data[2],
+                                        'sensors': {}
+                                       }
+            if sensor_id not in response[machine_id]['sensors']:
+                response[machine_id]['sensors'][sensor_id] = {
+                                                                'asensorname': data[4],
+                                                                'data': []
+                                                            }
+            response[machine_id]['sensors'][sensor_id]["data"].append({
+                "timestamp": dt.strftime(data[5], "%Y-%m-%d %H:%M:%S"),
+                **data[6]
+            })
 
-        if machine_id not in response:
-            response[machine_id] = {
-                                    'compressorname': data[2],
-                                    'loc': data[3],
-                                    'sensors': {}
-                                   }
-        if sensor_id not in response[machine_id]['sensors']:
-            response[machine_id]['sensors'][sensor_id] = {
-                                                            'asensorname': data[5],
-                                                            'data': []
-                                                        }
-        response[machine_id]['sensors'][sensor_id]["data"].append({
-            "timestamp": dt.strftime(data[6], "%Y-%m-%d %H:%M:%S"),
-            "z-peak-acc": data[7],
-            "x-peak-acc": data[8],
-            "z-peak-vel": data[9],
-            "x-peak-vel": data[10],
-            "z-rms-low-acc": data[11],
-            "x-rms-low-acc": data[12],
-            "z-kurtosis": data[13],
-            "x-kurtosis": data[14],
-            "z-crest-factor": data[15],
-            "x-crest-factor": data[16]
-        })
-    return jsonify(response)
+        return jsonify(response)
+    except Exception as e:
+        return error_response(str(e))
 
-@app.route('/cbmdata/motorstatus', methods = ['GET'])
-def get_motor_run_data(db_instance):
+@app.route('/cbmdata/export', methods = ['GET'])
+def get_export():
+    compressor_ids = request.args.get('compressor_ids')
+    sensor_ids = request.args.get('sensor_ids')
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    columns = request.args.get('columns')
+    export_format = request.args.get('format', 'csv')
+    try:
+        columns, batches = db_instance.stream_export(compressor_ids, sensor_ids, start_date, end_date,
+                                                     columns and columns.split(','), API_EXPORT_BATCH_ROWS)
+        chunks = export_chunks(columns, batches, export_format)
+        # the query runs before the response starts, so a failing query still returns an error
+        first = next(chunks)
+    except Exception as e:
+        return error_response(str(e))
+
+    def generate():
+        yield first
+        yield from chunks
+
+    return Response(generate(), mimetype = EXPORT_MIMETYPES[export_format],
+                    headers = {'Content-Disposition': f'attachment; filename=cbmdata.{export_format}'})
+
+@app.route('/cbmdata/addvibdata', methods = ['GET'])
+@conditional('additional_vibration_data', 'addvibdata')
+@cached('addvibdata', RAW_DATA_TABLES)
+def get_add_vib_data():
     compressor_ids = request.args.get('compressor_ids')
     sensor_ids = request.args.get('sensor_ids')
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
+    resolution = request.args.get('resolution', 'auto')
+    limit = request.args.get('limit', type = int)
+    max_points = request.args.get('max_points', type = int)
+    downsample = request.args.get('downsample', 'lttb')
+    fields = request.args.get('fields')
+    add_vib_reading = field_reading(db_instance.resolve_fields('additional_vibration_data', fields))
+
+    if limit:
+        machine_data, next_cursor = db_instance.query_page('additional_vibration_data', compressor_ids, sensor_ids,
+                                                           start_date, end_date, resolution, request.args.get('after'),
+                                                           limit, fields)
+        return page_response(machine_data, next_cursor, add_vib_reading)
+
+    if request.args.get('format') == 'ndjson':
+        return ndjson_response(db_instance.stream_additional_vibration_data(compressor_ids, sensor_ids, start_date,
+                                                                            end_date, resolution, API_STREAM_BATCH_ROWS,
+                                                                            max_points, downsample, fields),
+                               add_vib_reading)
     
-    machine_data = db_instance.query_motor_run_data(compressor_ids, sensor_ids, start_date, end_date)
+    machine_data = db_instance.query_additional_vibration_data(compressor_ids, sensor_ids, start_date, end_date,
+                                                               resolution, max_points, downsample, fields)
 
-    response = {}
+    return jsonify(grouped_response(machine_data, add_vib_reading))
 
-    for data in machine_data:
-        machine_id = data[1]
-        sensor_id = data[4]
+@app.route('/cbmdata/motorstatus', methods = ['GET'])
+@conditional('motor_run_data', 'motorstatus')
+@cached('motorstatus', RAW_DATA_TABLES)
+def get_motor_run_data():
+    compressor_ids = request.args.get('compressor_ids')
+    sensor_ids = request.args.get('sensor_ids')
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    resolution = request.args.get('resolution', 'auto')
+    limit = request.args.get('limit', type = int)
+    max_points = request.args.get('max_points', type = int)
+    downsample = request.args.get('downsample', 'lttb')
+    fields = request.args.get('fields')
+    motor_reading = field_reading(db_instance.resolve_fields('motor_run_data', fields))
 
-        if machine_id not in response:
-            response[machine_id] = {
-                                    'compressorname': data[2],
-                                    'loc': data[3],
-                                    'sensors': {}
-                                   }
-        if sensor_id not in response[machine_id]['sensors']:
-            response[machine_id]['sensors'][sensor_id] = {
-                                                            'asensorname': data[5],
-                                                            'data': []
-                                                        }
-        response[machine_id]['sensors'][sensor_id]["data"].append({
-            "timestamp": dt.strftime(data[6], "%Y-%m-%d %H:%M:%S"),
-            "motor-run-flag": data[7]
-        })
-    return jsonify(response)
+    if limit:
+        machine_data, next_cursor = db_instance.query_page('motor_run_data', compressor_ids, sensor_ids, start_date,
+                                                           end_date, resolution, request.args.get('after'), limit,
+                                                           fields)
+        return page_response(machine_data, next_cursor, motor_reading)
 
+    if request.args.get('format') == 'ndjson':
+        return ndjson_response(db_instance.stream_motor_run_data(compressor_ids, sensor_ids, start_date, end_date,
+                                                                 resolution, API_STREAM_BATCH_ROWS, max_points,
+                                                                 downsample, fields), motor_reading)
+    
+    machine_data = db_instance.query_motor_run_data(compressor_ids, sensor_ids, start_date, end_date, resolution,
+                                                    max_points, downsample, fields)
+
+    return jsonify(grouped_response(machine_data, motor_reading))
 
 @app.route('/cbmdata/dailydata/latest', methods = ['GET'])
-def get_latest_median_data(db_instance):
+@cached('dailydata/latest', ['dailytable'])
+def get_latest_median_data():
     
     sensor_ids = request.args.get('sensor_ids')
 
     try:
         machine_data = db_instance.query_latest_median_data(sensor_ids)
     except:
-        return jsonify({'error': 'error404'})
+        return error_response('error404')
     
     if machine_data:
         response = {}
@@ -246,7 +607,90 @@ def get_latest_median_data(db_instance):
             
         return jsonify(response)
     else:
-        return jsonify({'error': 'error404'})
+        return error_response('error404')
+    
+@app.route('/cbmdata/live/recent', methods = ['GET'])
+@live_only
+def get_live_recent_data():
+    # the readings of the last minutes (the whole live window by default) from memory, grouped as the raw data
+    compressor_ids = request.args.get('compressor_ids')
+    sensor_ids = request.args.get('sensor_ids')
+    minutes = request.args.get('minutes', type = float)
+    kind = request.args.get('kind', 'machine_data')
+    fields = request.args.get('fields')
+    try:
+        fields = db_instance.resolve_fields(kind, fields)
+        since = None
+        if minutes and live_buffer.latest() is not None:
+            since = live_buffer.latest() - np.timedelta64(int(minutes*60e6), 'us')
+        machine_data = live_rows(live_buffer.recent(parse_ids(sensor_ids), since), fields, parse_ids(compressor_ids))
+
+        if request.args.get('format') == 'ndjson':
+            return ndjson_response(iter([machine_data]), field_reading(fields))
+        return jsonify(grouped_response(machine_data, field_reading(fields)))
+    except:
+        return error_response('error404')
+
+@app.route('/cbmdata/live', methods = ['GET'])
+@live_only
+def get_live_data():
+    """
+    Push the live readings as server-sent events, one event per cycle with the readings of the selected sensors (as the
+    NDJSON readings of the raw data) and the time of the cycle as its id. A client that reconnects with Last-Event-ID
+    gets the readings it missed that are still in the live window, a new client starts with the latest cycle
+    """
+    compressor_ids = request.args.get('compressor_ids')
+    sensor_ids = request.args.get('sensor_ids')
+    kind = request.args.get('kind', 'machine_data')
+    fields = request.args.get('fields')
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('after')
+    try:
+        fields = db_instance.resolve_fields(kind, fields)
+        reading = field_reading(fields)
+        compressor_ids, sensor_ids = parse_ids(compressor_ids), parse_ids(sensor_ids)
+        if last_event_id:
+            since = np.datetime64(dt.fromisoformat(last_event_id), 'us')
+        elif live_buffer.latest() is not None:
+            since = live_buffer.latest() - np.timedelta64(1, 'us')
+        else:
+            since = None
+    except:
+        return error_response('error404')
+
+    def generate():
+        _since = since
+        while True:
+            if not live_buffer.wait(_since, LIVE_KEEPALIVE):
+                # keeps the connection open through proxies, and notices clients that are gone
+                yield ': keepalive\n\n'
+                continue
+            _latest = live_buffer.latest()
+            _frame = live_buffer.recent(sensor_ids, _since)
+            _frame = _frame[_frame['time_log'] <= _latest]
+            _since = _latest
+            for _time_log, _rows in groupby(live_rows(_frame, fields, compressor_ids), key = lambda x: x[6]):
+                yield (f'id: {_time_log.isoformat()}\n'
+                       f'data: {json.dumps([flat_reading(data, reading) for data in _rows])}\n\n')
+
+    _response = Response(generate(), mimetype = 'text/event-stream')
+    _response.headers['Cache-Control'] = 'no-cache'
+    _response.headers['X-Accel-Buffering'] = 'no'
+    return _response
+
+@app.route('/cbmdata/cache/invalidate', methods = ['POST'])
+def invalidate_cache():
+    # the ETL posts the tables it changed (see CacheInvalidator in cache.py), without tables all responses are dropped.
+    # Every worker process of the API has its own cache, served by a single process the ETL reaches all of it. Only the
+    # ETL knows the token, without a token configured no notification is accepted
+    _token = request.headers.get('X-Cache-Token', '')
+    if not API_CACHE_INVALIDATE_TOKEN or not hmac.compare_digest(_token.encode(), API_CACHE_INVALIDATE_TOKEN.encode()):
+        return jsonify({'error': 'error403'}), 403
+
+    tables = request.values.get('tables')
+    tables = [x.strip() for x in tables.split(',')] if tables else None
+    dropped = response_cache.invalidate(tables)
+    validator_cache.invalidate(tables)
+    return jsonify({'dropped': dropped})
     
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,329 @@
+import logging
+import threading
+import queue
+import numpy as np
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from time import monotonic
+from transform import CYCLE_DTYPE
+
+
+class LiveBuffer:
+    """
+    The latest readings of each sensor in memory, a ring of cycle frame rows (see CYCLE_DTYPE) per sensor that holds the
+    last window of hours, at most max_rows rows. Readers can wait for the next cycle
+    """
+
+    def __init__(self):
+        self._window = np.timedelta64(6*3600, 's')
+        self._max_rows = 4096
+        self._changed = threading.Condition()
+        # {sensorID: [rows, position of the next row, number of rows]}
+        self._rings = {}
+        self._latest = None
+
+    def set_window(self, hours, max_rows):
+        """
+        Set the hours of readings kept of each sensor, and the rows kept at most of a sensor
+        """
+        self._window = np.timedelta64(int(hours*3600), 's')
+        self._max_rows = max_rows
+        return None
+
+    def latest(self):
+        """
+        Return the time_log (numpy datetime64) of the latest reading, None while the buffer is empty
+        """
+        return self._latest
+
+    def append_cycle(self, cycle_frame):
+        """
+        Add the rows of a cycle frame and wake the waiting readers. Rows that are not newer than the latest reading of
+        their sensor are skipped, so a cycle that is received twice is only kept once
+        """
+        # the rows of each sensor, oldest first
+        _frame = cycle_frame[np.lexsort((cycle_frame['time_log'], cycle_frame['sensorID']))]
+        _starts = np.flatnonzero(np.concatenate([[True], _frame['sensorID'][1:] != _frame['sensorID'][:-1]]))
+        with self._changed:
+            for _rows in np.split(_frame, _starts[1:]) if len(_frame) else []:
+                _sensor_id = int(_rows['sensorID'][0])
+                if _sensor_id not in self._rings:
+                    self._rings[_sensor_id] = [np.empty(self._max_rows, dtype = CYCLE_DTYPE), 0, 0]
+                _ring = self._rings[_sensor_id]
+                if _ring[2]:
+                    _rows = _rows[_rows['time_log'] > _ring[0][_ring[1] - 1]['time_log']]
+                if not len(_rows):
+                    continue
+                _newer = np.concatenate([[True], _rows['time_log'][1:] > _rows['time_log'][:-1]])
+                _rows = _rows[_newer][-self._max_rows:]
+                _ring[0][(_ring[1] + np.arange(len(_rows))) % self._max_rows] = _rows
+                _ring[1] = (_ring[1] + len(_rows)) % self._max_rows
+                _ring[2] = min(_ring[2] + len(_rows), self._max_rows)
+                if self._latest is None or _rows['time_log'][-1] > self._latest:
+                    self._latest = _rows['time_log'][-1]
+            self._changed.notify_all()
+
+        return None
+
+    def _ordered(self, ring):
+        # the rows of a ring, oldest first
+        _rows, _position, _count = ring
+        if _count < self._max_rows:
+            return _rows[:_count]
+        return np.concatenate([_rows[_position:], _rows[:_position]])
+
+    def recent(self, sensor_ids = None, since = None):
+        """
+        Return the readings of the window of the given sensors (all when None) after since (numpy datetime64, the whole
+        window when None) as one cycle frame, ordered by time_log and sensorID
+        """
+        with self._changed:
+            if self._latest is None:
+                return np.empty(0, dtype = CYCLE_DTYPE)
+            _since = self._latest - self._window
+            if since is not None and since > _since:
+                _since = since
+            _parts = []
+            for _sensor_id, _ring in self._rings.items():
+                if sensor_ids is None or _sensor_id in sensor_ids:
+                    _rows = self._ordered(_ring)
+                    _parts.append(_rows[np.searchsorted(_rows['time_log'], _since, side = 'right'):])
+
+        if not _parts:
+            return np.empty(0, dtype = CYCLE_DTYPE)
+        _frame = np.concatenate(_parts)
+        return _frame[np.lexsort((_frame['sensorID'], _frame['time_log']))]
+
+    def wait(self, since, timeout):
+        """
+        Wait until there is a reading newer than since (numpy datetime64, None for any reading), at most timeout
+        seconds. Return whether there is
+        """
+        with self._changed:
+            return self._changed.wait_for(lambda: self._latest is not None and (since is None or self._latest > since),
+                                          timeout)
+
+
+class LivePublisher:
+    """
+    Publish the cycles of the ETL to the live buffers of the API processes over a local socket (multiprocessing
+    connection, authenticated with a shared key). A subscriber first gets the readings of the window and then every
+    cycle, as the raw bytes of cycle frames. Every subscriber is sent to on its own thread from a bounded queue, a
+    subscriber that falls behind is disconnected and catches up from the window when it reconnects
+    """
+
+    def __init__(self, live_buffer, address, authkey):
+        self._buffer = live_buffer
+        self._address = address
+        self._authkey = authkey
+        self._queue_size = 100
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._listener = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set_queue_size(self, queue_size):
+        """
+        Set the cycles queued for a subscriber before it is disconnected
+        """
+        self._queue_size = queue_size
+        return None
+
+    def start(self):
+        """
+        Listen for subscribers on a background thread. Raise ValueError without an authkey
+        """
+        if not self._authkey:
+            raise ValueError('The live readings are not published without an authkey')
+        self._listener = Listener(self._address, authkey = self._authkey)
+        self._thread = threading.Thread(target = self._accept, name = 'live-publisher', daemon = True)
+        self._thread.start()
+        return None
+
+    def stop(self, timeout = None):
+        """
+        Disconnect the subscribers and stop listening
+        """
+        self._stop.set()
+        with self._lock:
+            for _queue in self._subscribers:
+                _queue.put(None)
+            self._subscribers = []
+        # the socket keeps listening while the accepting thread waits in accept, so it is woken by a connection (on
+        # its own thread, the accepting thread may take a subscriber that reconnects instead)
+        threading.Thread(target = self._wake, name = 'live-publisher-wake', daemon = True).start()
+        self._thread.join(timeout)
+        self._listener.close()
+        return None
+
+    def _wake(self):
+        try:
+            Client(self._address, authkey = self._authkey).close()
+        except AuthenticationError as e:
+            logging.warning(f'Failed to authenticate with the live publisher due to {str(e)}',
+                            extra = {'event': 'live_authentication_failed'})
+        except (OSError, EOFError):
+            # the listener is closed already
+            pass
+        return None
+
+    def publish(self, cycle_frame):
+        """
+        Add the rows of a cycle frame to the live buffer and send them to the subscribers
+        """
+        self._buffer.append_cycle(cycle_frame)
+        if not len(cycle_frame):
+            return None
+
+        _data = np.ascontiguousarray(cycle_frame, dtype = CYCLE_DTYPE).tobytes()
+        with self._lock:
+            for _queue in list(self._subscribers):
+                if _queue.qsize() >= self._queue_size:
+                    logging.warning('Disconnected a live subscriber that fell behind',
+                                    extra = {'event': 'live_subscriber_dropped'})
+                    self._subscribers.remove(_queue)
+                    # the sender disconnects when it reaches the end of the queue
+                    _queue.put(None)
+                else:
+                    _queue.put(_data)
+
+        return None
+
+    def _accept(self):
+        while not self._stop.is_set():
+            try:
+                _conn = self._listener.accept()
+            except AuthenticationError as e:
+                if not self._stop.is_set():
+                    logging.warning(f'Rejected a live subscriber due to {str(e)}, check that the ETL and the API share '
+                                    f'the authkey', extra = {'event': 'live_authentication_failed'})
+                continue
+            except Exception as e:
+                if not self._stop.is_set():
+                    logging.warning(f'Failed to accept a live subscriber due to {str(e)}',
+                                    extra = {'event': 'live_accept_failed'})
+                continue
+            if self._stop.is_set():
+                _conn.close()
+                break
+
+            _queue = queue.SimpleQueue()
+            with self._lock:
+                # the window is queued before the next cycle, so the subscriber misses none
+                _queue.put(self._buffer.recent().tobytes())
+                self._subscribers.append(_queue)
+            threading.Thread(target = self._send, args = (_conn, _queue), name = 'live-sender', daemon = True).start()
+            logging.info('Live subscriber connected', extra = {'event': 'live_subscriber_connected'})
+
+        return None
+
+    def _send(self, conn, subscriber_queue):
+        try:
+            while True:
+                _data = subscriber_queue.get()
+                if _data is None:
+                    break
+                conn.send_bytes(_data)
+        except Exception as e:
+            logging.info(f'Live subscriber disconnected due to {str(e)}',
+                         extra = {'event': 'live_subscriber_disconnected'})
+            with self._lock:
+                if subscriber_queue in self._subscribers:
+                    self._subscribers.remove(subscriber_queue)
+        finally:
+            conn.close()
+
+        return None
+
+
+class LiveSubscriber:
+    """
+    Keep a live buffer of the API in step with the live buffer of the ETL (see LivePublisher), reconnecting while the
+    ETL is not running
+    """
+
+    def __init__(self, live_buffer, address, authkey):
+        self._buffer = live_buffer
+        self._address = address
+        self._authkey = authkey
+        self._retry_interval = 5.0
+        self._stop = threading.Event()
+        self._conn = None
+
+    def set_retry_interval(self, retry_interval):
+        """
+        Set the time (seconds) to wait before connecting to the ETL again
+        """
+        self._retry_interval = retry_interval
+        return None
+
+    def start(self):
+        """
+        Connect to the ETL on a background thread. Raise ValueError without an authkey
+        """
+        if not self._authkey:
+            raise ValueError('The live readings are not subscribed to without an authkey')
+        threading.Thread(target = self._run, name = 'live-subscriber', daemon = True).start()
+        return None
+
+    def stop(self):
+        self._stop.set()
+        if self._conn is not None:
+            self._conn.close()
+        return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            _connected = monotonic()
+            try:
+                self._conn = Client(self._address, authkey = self._authkey)
+                logging.info('Connected to the live readings of the ETL', extra = {'event': 'live_connected'})
+                while not self._stop.is_set():
+                    self._buffer.append_cycle(np.frombuffer(self._conn.recv_bytes(), dtype = CYCLE_DTYPE))
+            except AuthenticationError as e:
+                if not self._stop.is_set():
+                    logging.warning(f'Failed to authenticate with the ETL due to {str(e)}, check that the ETL and the '
+                                    f'API share the authkey', extra = {'event': 'live_authentication_failed'})
+            except Exception as e:
+                if not self._stop.is_set():
+                    logging.debug(f'Lost the live readings of the ETL due to {str(e)}',
+                                  extra = {'event': 'live_disconnected'})
+            finally:
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+            # the ETL is not running, try again later
+            self._stop.wait(max(0.0, self._retry_interval - (monotonic() - _connected)))
+
+        return None
+
+
+class SensorNames:
+    """
+    The names of the sensors of the live readings {sensorID: (machineID, machineName, machineLoc, sensorName)}, loaded
+    with load() and loaded again when a sensor is unknown, at most once per refresh interval
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._refresh_interval = 60.0
+        self._lock = threading.Lock()
+        self._names = {}
+        self._loaded = None
+
+    def set_refresh_interval(self, refresh_interval):
+        self._refresh_interval = refresh_interval
+        return None
+
+    def get(self, sensor_ids):
+        """
+        Return the names of the sensors, None for the sensors that are not in the SensorDataTable
+        """
+        with self._lock:
+            if (any(x not in self._names for x in sensor_ids)
+                    and (self._loaded is None or monotonic() - self._loaded >= self._refresh_interval)):
+                self._loaded = monotonic()
+                self._names = self._load()
+            _names = self._names
+        return {x: _names.get(x) for x in sensor_ids}
@@ -1,24 +1,45 @@
-import pyodbc
 import logging
+from storage import SQLServerStorage
+import numpy as np
+from datetime import datetime as dt, timedelta
+from transform import MACHINE_DATA_COLUMNS
+from aggregate import DAILY_SIGNALS, DAILY_STATISTIC_COLUMNS
+
+
+# vibration thresholds and temperature setpoints of a sensor, in the order returned by the extractor
+SETPOINT_COLUMNS = ['Zvelbase', 'Zaccbase', 'Xvelbase', 'Xaccbase',
+                    'Zvelwarn', 'Zaccwarn', 'Xvelwarn', 'Xaccwarn',
+                    'Zvelalarm', 'Zaccalarm', 'Xvelalarm', 'Xaccalarm',
+                    'Tempwarn', 'Tempalarm']
+
+MACHINE_DATA_INSERT_QUERY = f'''
+INSERT INTO machinedatatable ({', '.join(MACHINE_DATA_COLUMNS)})
+VALUES ({','.join(['?']*len(MACHINE_DATA_COLUMNS))});
+'''
+
 
 class LoadSensorData:
     def __init__(self):
-        self._server = None
-        self._database = None
+        self._storage = None
         self._conn = None
         self._cursor = None
         self._connected = False
     
     def set_database_credentials(self, server, database):
-        self._server = server
-        self._database = database
+        self._storage = SQLServerStorage(server, database)
         
         return None
+
+    def set_storage(self, storage):
+        """
+        Set the storage backend (see storage.py) to load the data to
+        """
+        self._storage = storage
+        return None
         
     def connect_to_database(self):
-        if self._server is not None and self._database is not None:
-            _conn_str = 'DRIVER={SQL Server};SERVER='+self._server+';DATABASE='+self._database+';Trusted_Connection=True'
-            self._conn = pyodbc.connect(_conn_str)
+        if self._storage is not None:
+            self._conn = self._storage.connect()
             self._cursor = self._conn.cursor()
             self._connected = True
         else:
@@ -40,39 +61,223 @@ class LoadSensorData:
     def load_sensor_data(self, sensor_data):
         # perform data validation check before proceeding
         if len(sensor_data) == 32 and type(sensor_data) == list:              # make sure that sensor_data contains 32 data points
-            query = '''
-            INSERT INTO machinedatatable (sensorID, time_log, Zvel, Zacc, Xvel, Xacc, Temp, 
-            Zvelbase, Zaccbase, Xvelbase, Xaccbase, 
-            Zvelwarn, Zaccwarn, Xvelwarn, Xaccwarn,
-            Zvelalarm, Zaccalarm, Xvelalarm, Xaccalarm, 
-            Tempwarn, Tempalarm, MotorRunFlag, ZpeakAcc, XpeakAcc, ZpeakVel,
-            XpeakVel, ZRMSlowAcc, XRMSlowAcc, Zkurtosis, Xkurtosis, Zcrestfac,
-            Xcrestfac)
-            VALUES (?,?,?,?,?,?,?,?,?,?,
-                    ?,?,?,?,?,?,?,?,?,?,
-                    ?,?,?,?,?,?,?,?,?,?,
-                    ?,?);
-            
-            '''
+            query = MACHINE_DATA_INSERT_QUERY
             # try-except block to ensure pipeline will not fail, if connection is lost in the middle of operation, just
             # close the connection
             try:
                 
                 self._cursor.execute(query, tuple(sensor_data))
                 self._conn.commit()
-                logging.info(f'Successfully loaded sensor {sensor_data[0]} to database with data: {sensor_data}')
+                # formatted lazily on the logging thread, and sampled (see logconfig.py)
+                logging.info('Successfully loaded sensor %s to database', sensor_data[0],
+                             extra = {'event': 'row_loaded', 'time_log': sensor_data[1]})
                 
             except Exception as e:
                 
-                logging.info(f'Failed to insert data to database due to {str(e)}')
+                logging.warning(f'Failed to insert data to database due to {str(e)}', exc_info = True,
+                                extra = {'event': 'insert_failed', 'sensorID': sensor_data[0], 'row': sensor_data})
                 self._connected = False
                 
         else:
             # failed the data validation test!
-            print("Data doesn't contain 32 data points")
+            logging.warning("Data doesn't contain 32 data points", extra = {'event': 'row_rejected', 'row': sensor_data})
             
         return None
             
+    def _validate_rows(self, batch):
+        # split a batch (cycle frame, list of cycle frames or list of 32-value rows) into the valid rows, and the
+        # rejected ones as (position in the batch, row, reason)
+        if isinstance(batch, np.ndarray):
+            batch = [batch]
+
+        _rows = []
+        _rejected = []
+        _position = 0
+        for _part in batch:
+            if isinstance(_part, np.ndarray):
+                # the fields of a cycle frame are in the column order of the machinedatatable, so its rows are used
+                # as the query parameters, with the NaN of the fields that were not sampled as NULL
+                if _part.dtype.names == tuple(MACHINE_DATA_COLUMNS):
+                    _rows.extend(tuple(None if x != x else x for x in _row) for _row in _part.tolist())
+                else:
+                    _rejected.extend((_position + i, x, "cycle frame doesn't contain the 32 machinedatatable columns")
+                                     for i, x in enumerate(_part.tolist()))
+                _position += len(_part)
+                continue
+
+            if len(_part) != len(MACHINE_DATA_COLUMNS):
+                _rejected.append((_position, _part, "data doesn't contain 32 data points"))
+            elif _part[0] is None or _part[1] is None:
+                _rejected.append((_position, _part, 'data has no sensorID or time_log'))
+            else:
+                _rows.append(tuple(_part))
+            _position += 1
+
+        return _rows, _rejected
+
+    def _drop_existing_rows(self, rows):
+        # drop the rows whose (sensorID, time_log) is already in the machinedatatable, with one query over the time
+        # range of the batch
+        _query = '''
+        SELECT sensorID, time_log FROM machinedatatable WHERE time_log BETWEEN ? AND ?
+        '''
+        self._cursor.execute(_query, (min(x[1] for x in rows), max(x[1] for x in rows)))
+        _existing = set((x[0], x[1]) for x in self._cursor.fetchall())
+        return [x for x in rows if (x[0], x[1]) not in _existing]
+
+    def load_sensor_batch(self, batch, skip_existing = False):
+        """
+        Load a batch of rows to the machinedatatable in a single transaction: a cycle frame (see transform.py), a list of
+        buffered cycle frames, or a list of 32-value rows. Rows that fail the data validation are not loaded and are
+        returned as a list of (position in the batch, row, reason). If the insert fails, nothing of the batch is loaded
+        and the connection is marked as lost.
+
+        With skip_existing, rows with a (sensorID, time_log) that is already in the machinedatatable are not loaded
+        again, so a batch can be replayed safely
+        """
+        _rows, _rejected = self._validate_rows(batch)
+        for _index, _row, _reason in _rejected:
+            logging.warning(f'Rejected row {_index} of the batch: {_reason}',
+                            extra = {'event': 'row_rejected', 'position': _index, 'row': _row})
+
+        if _rows:
+            # try-except block to ensure pipeline will not fail, roll back the batch if the connection is lost in the
+            # middle of the operation
+            try:
+
+                if skip_existing:
+                    _rows = self._drop_existing_rows(_rows)
+                    if not _rows:
+                        return _rejected
+
+                # send the parameters of all rows in one round trip instead of one per row where the backend allows it
+                self._storage.prepare_bulk_cursor(self._cursor)
+                self._cursor.executemany(MACHINE_DATA_INSERT_QUERY, _rows)
+                self._conn.commit()
+                logging.info('Successfully loaded %d rows to database', len(_rows), extra = {'event': 'batch_loaded'})
+
+            except Exception as e:
+
+                logging.warning(f'Failed to insert batch of {len(_rows)} rows to database due to {str(e)}',
+                                exc_info = True,
+                                extra = {'event': 'batch_failed', 'rows': len(_rows),
+                                         'sensorIDs': sorted(set(x[0] for x in _rows)),
+                                         'first_time_log': min(x[1] for x in _rows),
+                                         'last_time_log': max(x[1] for x in _rows)})
+                try:
+                    self._conn.rollback()
+                except:
+                    pass
+                self._connected = False
+
+        return _rejected
+
+    def load_cycle_frame(self, cycle_frame):
+        """
+        Load all rows of a cycle frame (see transform.py) to the machinedatatable, see load_sensor_batch
+        """
+        return self.load_sensor_batch(cycle_frame)
+
+    def load_setpoints(self, sensor_id, time_log, setpoints):
+        """
+        Store a new version of the setpoints of a sensor in the SetpointTable, unless they are equal to the latest version
+        stored for that sensor (e.g. when the ETL is restarted)
+        """
+        if len(setpoints) == len(SETPOINT_COLUMNS):
+            _columns = ', '.join(SETPOINT_COLUMNS)
+            latest_query = f'''
+            SELECT {_columns} FROM SetpointTable
+            WHERE setpointID = (SELECT MAX(setpointID) FROM SetpointTable WHERE sensorID = ?);
+            '''
+            insert_query = f'''
+            INSERT INTO SetpointTable (sensorID, valid_from, {_columns})
+            VALUES (?,?,{','.join(['?']*len(SETPOINT_COLUMNS))});
+            '''
+            try:
+                self._cursor.execute(latest_query, (sensor_id,))
+                _latest = self._cursor.fetchone()
+                if _latest is None or list(_latest) != list(setpoints):
+                    self._cursor.execute(insert_query, (sensor_id, time_log, *setpoints))
+                    self._conn.commit()
+                    logging.info(f'Stored new setpoints of sensor {sensor_id} valid from {time_log}: {setpoints}')
+
+            except Exception as e:
+
+                logging.warning(f'Failed to insert setpoints to database due to {str(e)}', exc_info = True,
+                                extra = {'event': 'setpoints_failed', 'sensorID': sensor_id, 'valid_from': time_log,
+                                         'setpoints': setpoints})
+                self._connected = False
+
+        else:
+            logging.warning(f"Setpoints don't contain {len(SETPOINT_COLUMNS)} data points",
+                            extra = {'event': 'setpoints_rejected', 'sensorID': sensor_id, 'setpoints': setpoints})
+
+        return None
+
+    def fetch_daily_readings(self, day):
+        """
+        Return the (sensorID, time_log, Temp, Zvel, Zacc, Xvel, Xacc) readings of a day from the machinedatatable
+        """
+        _start = dt.combine(day, dt.min.time())
+        query = f'''
+        SELECT sensorID, time_log, {', '.join(DAILY_SIGNALS)} FROM machinedatatable
+        WHERE time_log >= ? AND time_log < ?
+        '''
+        self._cursor.execute(query, (_start, _start + timedelta(days = 1)))
+        return self._cursor.fetchall()
+
+    def upsert_daily_aggregates(self, rows):
+        """
+        Insert or update the dailytable rows of the given (sensorID, date, medians, statistics, samples) in a single
+        transaction, see aggregate.py for the order of the medians and statistics. New rows take the sensor and machine
+        names from the SensorDataTable and MachineTable
+        """
+        _columns = DAILY_SIGNALS + DAILY_STATISTIC_COLUMNS + ['samples']
+        update_query = f'''
+        UPDATE dailytable SET {', '.join(x + ' = ?' for x in _columns)} WHERE sensorID = ? AND date = ?;
+        '''
+        names_query = '''
+        SELECT s.sensorName, m.machineID, m.machineName FROM SensorDataTable s
+        JOIN MachineTable m ON m.machineID = s.machineID WHERE s.sensorID = ?;
+        '''
+        insert_query = f'''
+        INSERT INTO dailytable (sensorID, sensorName, machineID, machineName, date, {', '.join(_columns)})
+        VALUES ({','.join(['?']*(5 + len(_columns)))});
+        '''
+        # the update and insert statements are the same on all backends, unlike their upsert (MERGE / ON CONFLICT)
+        try:
+            for _sensor_id, _date, _medians, _statistics, _samples in rows:
+                _values = (*_medians, *_statistics, _samples)
+                self._cursor.execute(update_query, (*_values, _sensor_id, _date))
+                if self._cursor.rowcount == 0:
+                    self._cursor.execute(names_query, (_sensor_id,))
+                    _names = self._cursor.fetchone()
+                    if _names is None:
+                        logging.warning(f'Skipped the daily aggregates of sensor {_sensor_id}, it is not in the '
+                                        f'SensorDataTable')
+                        continue
+                    self._cursor.execute(insert_query, (_sensor_id, *_names, _date, *_values))
+            self._conn.commit()
+
+        except Exception as e:
+
+            logging.warning(f'Failed to upsert {len(rows)} daily aggregates to database due to {str(e)}', exc_info = True,
+                            extra = {'event': 'daily_upsert_failed', 'sensorIDs': sorted(set(x[0] for x in rows))})
+            try:
+                self._conn.rollback()
+            except:
+                pass
+            self._connected = False
+
+        return None
+
+    def create_schema(self):
+        """
+        Create all tables, indexes and views on a storage backend that maintains its own schema (see storage.py)
+        """
+        self._storage.create_schema(self._conn)
+        return None
+
     def create_machine_data(self):
         query = '''
             CREATE TABLE MachineDataTable (
@@ -89,6 +294,27 @@ class LoadSensorData:
         self._conn.commit()
         return None
     
+    def add_daily_statistics_columns(self):
+        """
+        Add the statistics the ETL maintains next to the medians (see aggregate.py) to a dailytable created without them
+        """
+        try:
+            for _column, _definition in [(x, 'FLOAT') for x in DAILY_STATISTIC_COLUMNS] + [('samples', 'INT')]:
+                self._storage.add_column_if_missing(self._cursor, 'dailytable', _column, _definition)
+            self._conn.commit()
+
+        except Exception as e:
+
+            logging.warning(f'Failed to add the daily statistics columns due to {str(e)}', exc_info = True,
+                            extra = {'event': 'daily_migration_failed'})
+            try:
+                self._conn.rollback()
+            except:
+                pass
+            self._connected = False
+
+        return None
+
     def create_machine_table(self):
         query = '''
             CREATE TABLE MachineTable (
@@ -113,4 +339,30 @@ class LoadSensorData:
         '''
         self._cursor.execute(query)
         self._conn.commit()
-        return None
\ No newline at end of file
+        return None
+
+    def create_setpoint_table(self):
+        query = '''
+            CREATE TABLE SetpointTable (
+            setpointID INT IDENTITY(1,1) PRIMARY KEY,
+            sensorID INT,
+            valid_from DATETIME,
+            Zvelbase FLOAT,
+            Zaccbase FLOAT,
+            Xvelbase FLOAT,
+            Xaccbase FLOAT,
+            Zvelwarn FLOAT,
+            Zaccwarn FLOAT,
+            Xvelwarn FLOAT,
+            Xaccwarn FLOAT,
+            Zvelalarm FLOAT,
+            Zaccalarm FLOAT,
+            Xvelalarm FLOAT,
+            Xaccalarm FLOAT,
+            Tempwarn FLOAT,
+            Tempalarm FLOAT);
+            CREATE INDEX IX_SetpointTable_sensorID ON SetpointTable (sensorID, valid_from);
+        '''
+        self._cursor.execute(query)
+        self._conn.commit()
+        return None
@@ -0,0 +1,105 @@
+import json
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from time import monotonic
+
+
+# attributes every LogRecord has, the other attributes of a record are the fields passed with extra = {...}
+_RECORD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format a record as one JSON object per line, with the fields passed with extra = {...} next to the message
+    """
+
+    def format(self, record):
+        _entry = {'time': self.formatTime(record), 'level': record.levelname, 'thread': record.threadName,
+                  'message': record.getMessage()}
+        _entry.update({_key: _value for _key, _value in record.__dict__.items() if _key not in _RECORD_ATTRIBUTES})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            _entry['exception'] = record.exc_text
+        return json.dumps(_entry, default = str)
+
+
+class EventFilter(logging.Filter):
+    """
+    Per-event rate limiting and sampling. The event of a record is its 'event' field, or else the line that logged it.
+    At most rate_limit records of an event pass per rate_interval seconds, the number of records dropped is reported
+    on the next record that passes. Events in sample_every {event: n} only pass every n-th record
+    """
+
+    def __init__(self, rate_limit, rate_interval, sample_every):
+        super().__init__()
+        self._rate_limit = rate_limit
+        self._rate_interval = rate_interval
+        self._sample_every = sample_every
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._samples = {}
+
+    def filter(self, record):
+        _event = getattr(record, 'event', None) or f'{record.module}:{record.lineno}'
+        with self._lock:
+            if _event in self._sample_every:
+                _count = self._samples.get(_event, 0)
+                self._samples[_event] = _count + 1
+                if _count % self._sample_every[_event]:
+                    return False
+                record.sampled = self._sample_every[_event]
+
+            _now = monotonic()
+            _window = self._windows.get(_event)
+            if _window is None or _now - _window[0] >= self._rate_interval:
+                _window = self._windows[_event] = [_now, 0, _window[2] if _window is not None else 0]
+            _window[1] += 1
+            if _window[1] > self._rate_limit:
+                _window[2] += 1
+                return False
+            if _window[2]:
+                record.suppressed = _window[2]
+                _window[2] = 0
+
+        return True
+
+
+class _DeferredQueueHandler(QueueHandler):
+    # pass the record to the listener thread as it is, the message is formatted there instead of on the calling thread.
+    # Only the traceback is rendered here, while the frames are still available
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        return record
+
+
+def setup_logging(path, max_bytes, backup_count, rotate_when = None, rate_limit = 20, rate_interval = 60.0,
+                  sample_every = None, level = logging.INFO):
+    """
+    Log the records of the root logger as JSON lines to a rotating file (by size, or by time if rotate_when is set,
+    e.g. 'midnight'). The records are filtered (see EventFilter) and queued on the calling thread, and formatted and
+    written on a listener thread, so logging never waits for the disk. Return the listener, stop() it on shutdown to
+    write the queued records
+    """
+    if rotate_when is not None:
+        _file_handler = TimedRotatingFileHandler(path, when = rotate_when, backupCount = backup_count)
+    else:
+        _file_handler = RotatingFileHandler(path, maxBytes = max_bytes, backupCount = backup_count)
+    _file_handler.setFormatter(JsonFormatter())
+
+    _queue = queue.SimpleQueue()
+    _queue_handler = _DeferredQueueHandler(_queue)
+    _queue_handler.addFilter(EventFilter(rate_limit, rate_interval, sample_every or {}))
+
+    _root = logging.getLogger()
+    for _handler in list(_root.handlers):
+        _root.removeHandler(_handler)
+    _root.addHandler(_queue_handler)
+    _root.setLevel(level)
+
+    _listener = QueueListener(_queue, _file_handler, respect_handler_level = True)
+    _listener.start()
+    return _listener
@@ -0,0 +1,186 @@
+import logging
+import queue
+import threading
+from time import monotonic
+
+
+# marker passed down the stages to shut the pipeline down after the items queued before it
+_SHUTDOWN = object()
+
+
+class PipelineStage:
+
+    def __init__(self, name, process, in_queue, out_queue = None):
+        self._name = name
+        self._process = process
+        self._in_queue = in_queue
+        self._out_queue = out_queue
+        self._thread = None
+        self._lock = threading.Lock()
+        self._processed = 0
+        self._rows = 0
+        self._failed = 0
+        self._busy_time = 0.0
+        self._started_at = None
+
+    def start(self):
+        self._started_at = monotonic()
+        self._thread = threading.Thread(target = self._run, name = f'stage-{self._name}', daemon = True)
+        self._thread.start()
+        return None
+
+    def join(self, timeout = None):
+        self._thread.join(timeout)
+        return None
+
+    def _run(self):
+        while True:
+            _item = self._in_queue.get()
+            if _item is _SHUTDOWN:
+                if self._out_queue is not None:
+                    self._out_queue.put(_SHUTDOWN)
+                break
+
+            _start = monotonic()
+            try:
+                _result = self._process(_item)
+            except Exception as e:
+                # a failing item must not stop the stage
+                logging.exception(f'Stage {self._name} failed to process an item due to {str(e)}')
+                _result = None
+                with self._lock:
+                    self._failed += 1
+
+            with self._lock:
+                self._processed += 1
+                self._rows += _item.num_rows() if hasattr(_item, 'num_rows') else 1
+                self._busy_time += monotonic() - _start
+
+            # a full output queue blocks this stage, and in turn the stages before it (backpressure)
+            if _result is not None and self._out_queue is not None:
+                self._out_queue.put(_result)
+
+        return None
+
+    def stats(self):
+        """
+        Return the queue depth and throughput counters of the stage
+        """
+        with self._lock:
+            _elapsed = max(monotonic() - self._started_at, 1e-9) if self._started_at is not None else 0.0
+            return {
+                'stage': self._name,
+                'queue_depth': self._in_queue.qsize(),
+                'queue_size': self._in_queue.maxsize,
+                'processed': self._processed,
+                'failed': self._failed,
+                'rows': self._rows,
+                'rows_per_s': self._rows/_elapsed if _elapsed else 0.0,
+                'utilization': self._busy_time/_elapsed if _elapsed else 0.0,
+            }
+
+
+class CycleItem:
+
+    def __init__(self, time_log, cycle_frame, setpoint_changes):
+        self.time_log = time_log
+        self.cycle_frame = cycle_frame
+        self.setpoint_changes = setpoint_changes
+
+    def num_rows(self):
+        return len(self.cycle_frame)
+
+
+class ETLPipeline:
+
+    def __init__(self):
+        self._queue_size = 16
+        self._stages = []
+        self._gauges = {}
+        self._stop_reporting = threading.Event()
+        self._reporter = None
+
+    def set_queue_size(self, queue_size):
+        """
+        Set the number of items each stage queue holds before the stage feeding it blocks
+        """
+        self._queue_size = queue_size
+        return None
+
+    def add_stage(self, name, process):
+        """
+        Add a stage to the end of the pipeline. process(item) runs on the worker thread of the stage, and its result
+        (unless None) is passed on to the next stage
+        """
+        _in_queue = queue.Queue(maxsize = self._queue_size)
+        if self._stages:
+            self._stages[-1]._out_queue = _in_queue
+        self._stages.append(PipelineStage(name, process, _in_queue))
+        return None
+
+    def add_gauge(self, name, gauge):
+        """
+        Report the value of gauge() together with the stage statistics (e.g. the backlog of a sink)
+        """
+        self._gauges[name] = gauge
+        return None
+
+    def start(self, report_interval = None):
+        """
+        Start the worker threads of all stages, and log the statistics of the pipeline every report_interval seconds
+        """
+        for _stage in self._stages:
+            _stage.start()
+
+        if report_interval:
+            self._reporter = threading.Thread(target = self._report, args = (report_interval,), name = 'stage-stats',
+                                              daemon = True)
+            self._reporter.start()
+
+        return None
+
+    def submit(self, item):
+        """
+        Pass an item to the first stage, blocks while its queue is full
+        """
+        self._stages[0]._in_queue.put(item)
+        return None
+
+    def shutdown(self, timeout = None):
+        """
+        Let every stage finish the items queued so far, then stop the worker threads
+        """
+        self._stages[0]._in_queue.put(_SHUTDOWN)
+        for _stage in self._stages:
+            _stage.join(timeout)
+
+        self._stop_reporting.set()
+        if self._reporter is not None:
+            self._reporter.join(timeout)
+
+        return None
+
+    def stats(self):
+        """
+        Return the statistics of all stages, and the values of the gauges
+        """
+        _stats = [_stage.stats() for _stage in self._stages]
+        _gauges = {}
+        for _name, _gauge in self._gauges.items():
+            try:
+                _gauges[_name] = _gauge()
+            except Exception as e:
+                _gauges[_name] = f'unavailable ({str(e)})'
+        return _stats, _gauges
+
+    def _report(self, interval):
+        while not self._stop_reporting.wait(interval):
+            _stats, _gauges = self.stats()
+            for _stage in _stats:
+                logging.info(f"Stage {_stage['stage']}: queue {_stage['queue_depth']}/{_stage['queue_size']}, "
+                             f"{_stage['processed']} items ({_stage['failed']} failed), "
+                             f"{_stage['rows_per_s']:.1f} rows/s, {100*_stage['utilization']:.0f}% busy")
+            for _name, _value in _gauges.items():
+                logging.info(f'Gauge {_name}: {_value}')
+
+        return None
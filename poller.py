@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+import numpy as np
+from transform import empty_cycle_frame
+
+
+class MultiPLCPoller:
+
+    def __init__(self):
+        self._plcs = []
+        self._timeout = 30.0
+        self._executor = None
+        self._pending = {}
+
+    def set_poll_timeout(self, timeout):
+        """
+        Set the time (seconds) a PLC gets to deliver its data in a polling cycle
+        """
+        self._timeout = timeout
+        return None
+
+    def add_plc(self, name, extractor, sensor_count):
+        """
+        Add a PLC to the poller with its (configured) CBMDataExtractor and number of sensors
+        """
+        self._plcs.append((name, extractor, range(sensor_count)))
+        return None
+
+    def _poll_plc(self, extractor, sensor_numbers, time_log, signal_groups):
+        # runs on a worker thread, the Modbus client of the extractor is blocking
+        extractor.ensure_connection()
+        return extractor.extract_cycle(sensor_numbers, time_log, signal_groups)
+
+    async def _poll_plc_async(self, name, extractor, sensor_numbers, time_log, signal_groups):
+        # a PLC whose previous poll is still stuck in the worker thread is left out of this cycle, so the extractor is
+        # never used by two threads at the same time
+        if name in self._pending and not self._pending[name].done():
+            logging.warning(f'Skipped PLC {name} in this cycle, its previous poll is still running')
+            return None
+
+        _start = monotonic()
+        self._pending[name] = self._executor.submit(self._poll_plc, extractor, sensor_numbers, time_log,
+                                                     signal_groups)
+        try:
+            # shield the poll, a timeout must not cancel the future of a worker thread that is still running
+            _cycle_frame = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(self._pending[name])),
+                                                  self._timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f'PLC {name} did not deliver its data within {self._timeout} s')
+            return None
+        except Exception as e:
+            logging.warning(f'Failed to poll PLC {name} due to {str(e)}', exc_info = True,
+                            extra = {'event': 'poll_failed', 'plc': name})
+            return None
+
+        if not extractor.check_connection():
+            logging.warning(f'Lost connection to PLC {name}')
+        logging.debug('Polled %d sensors of PLC %s in %.3f s', len(_cycle_frame), name, monotonic() - _start)
+
+        # the setpoint changes are only taken once the worker thread is done with the extractor, so changes found by a
+        # poll that timed out are delivered with the next cycle
+        return _cycle_frame, extractor.pop_setpoint_changes()
+
+    async def poll_cycle_async(self, time_log = None, signal_groups = None):
+        """
+        Poll the signal groups (see CBMDataExtractor.extract_cycle) of all PLCs in parallel, each with its own timeout,
+        and return the combined cycle frame of all PLCs together with the setpoint changes
+        {sensorID: (time of the change, setpoints)} of all PLCs
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers = max(1, len(self._plcs)), thread_name_prefix = 'plc')
+
+        _results = await asyncio.gather(*[self._poll_plc_async(_name, _extractor, _sensor_numbers, time_log,
+                                                               signal_groups)
+                                          for _name, _extractor, _sensor_numbers in self._plcs])
+
+        # a slow or failed PLC only loses its own sensors for this cycle
+        _frames = [empty_cycle_frame()]
+        _setpoint_changes = {}
+        for _result in _results:
+            if _result is not None:
+                _frames.append(_result[0])
+                _setpoint_changes.update(_result[1])
+
+        return np.concatenate(_frames), _setpoint_changes
+
+    def poll_cycle(self, time_log = None, signal_groups = None):
+        """
+        Poll all PLCs in parallel, see poll_cycle_async
+        """
+        return asyncio.run(self.poll_cycle_async(time_log, signal_groups))
+
+    def close_connections(self):
+        """
+        Close the connections to all PLCs and stop the worker threads
+        """
+        for _name, _extractor, _sensor_numbers in self._plcs:
+            if _extractor._client is not None:
+                _extractor.close_connection()
+
+        if self._executor is not None:
+            self._executor.shutdown(wait = False)
+            self._executor = None
+
+        return None
@@ -1,8 +1,59 @@
 from pyModbusTCP.client import ModbusClient
 import pandas as pd
 from datetime import datetime as dt
-from time import sleep
+from time import sleep, monotonic
+import random
 import logging
+import numpy as np
+from transform import decode_cycle, decode_fields, empty_cycle_frame
+
+
+# Modbus TCP allows at most 125 holding registers per read request
+MODBUS_MAX_REGISTERS = 125
+
+# holding register layout of the Banner PLC: block name -> (base address, number of registers per sensor)
+# the block of sensor i starts at base address + i*(number of registers per sensor)
+REGISTER_MAP = {
+    'sensor': (0, 5),
+    'threshold': (5180, 12),
+    'temp_warning': (7680, 1),
+    'temp_alarm': (7720, 1),
+    'motor_status': (240, 1),
+    'additional': (6140, 10),
+}
+
+# register blocks holding the rarely changing vibration thresholds and temperature setpoints of a sensor
+SETPOINT_BLOCKS = ('threshold', 'temp_warning', 'temp_alarm')
+
+# signal groups that can be sampled at their own rate: group name -> register blocks
+# the setpoints are cached and served from the cache when they are not read, the fields of the other groups are NULL in
+# the rows of the cycles that did not read them (see SAMPLED_FIELDS in transform.py)
+SIGNAL_GROUPS = {
+    'live': ('sensor', 'motor_status'),
+    'additional': ('additional',),
+    'setpoints': SETPOINT_BLOCKS,
+}
+
+
+def plan_register_reads(spans, max_registers = MODBUS_MAX_REGISTERS, max_gap = 0):
+    """
+    Merge a list of (address, number of registers) spans into the fewest holding register reads allowed by the
+    Modbus register limit. Spans that overlap, touch or lie at most max_gap registers apart are read together.
+    """
+    _merged = []
+    for _address, _count in sorted(spans):
+        if _merged and _address <= _merged[-1][1] + max_gap:
+            _merged[-1][1] = max(_merged[-1][1], _address + _count)
+        else:
+            _merged.append([_address, _address + _count])
+
+    # split the merged ranges into reads of at most max_registers registers
+    _reads = []
+    for _start, _end in _merged:
+        for _address in range(_start, _end, max_registers):
+            _reads.append((_address, min(max_registers, _end - _address)))
+
+    return _reads
 
 
 # NEW SCRIPT
@@ -13,6 +64,21 @@ class CBMDataExtractor:
         self._server_port = 502
         self._client = None
         self._connected = False
+        self._max_register_gap = 0
+        self._timeout = 5.0
+        self._keepalive_interval = 60.0
+        self._reconnect_base_delay = 1.0
+        self._reconnect_max_delay = 120.0
+        self._reconnect_attempts = 0
+        self._next_reconnect = 0.0
+        self._last_read = 0.0
+        self._block_cache = {}
+        self._setpoint_changes = {}
+        self._setpoints_read_at = None
+        self._setpoint_refresh_interval = 3600.0
+        self._setpoint_checksum_address = None
+        self._setpoint_checksum = None
+        self._sensor_id_offset = 0
         
     def set_server_ip(self, server_ip):
         """
@@ -20,21 +86,106 @@ class CBMDataExtractor:
         """
         self._server_ip = server_ip
         return None
+
+    def set_max_register_gap(self, max_gap):
+        """
+        Set the number of unused registers that may be read in between two register blocks to merge them into one read
+        """
+        self._max_register_gap = max_gap
+        return None
+
+    def set_reconnect_policy(self, base_delay, max_delay, timeout = 5.0, keepalive_interval = 60.0):
+        """
+        Set the exponential backoff delays (seconds) between reconnect attempts, the socket timeout, and the idle time
+        after which the connection is probed for a half-open socket before it is used again
+        """
+        self._reconnect_base_delay = base_delay
+        self._reconnect_max_delay = max_delay
+        self._timeout = timeout
+        self._keepalive_interval = keepalive_interval
+        return None
+
+    def set_sensor_id_offset(self, sensor_id_offset):
+        """
+        Set the sensorID of the first sensor of the PLC, so the sensors of several PLCs get distinct sensorIDs
+        """
+        self._sensor_id_offset = sensor_id_offset
+        return None
+
+    def set_setpoint_refresh(self, refresh_interval, checksum_address = None):
+        """
+        Set the interval (seconds) at which the cached thresholds and setpoints are re-read from the PLC. If a checksum
+        register address is given, the setpoints are also re-read as soon as the value of that register changes
+        """
+        self._setpoint_refresh_interval = refresh_interval
+        self._setpoint_checksum_address = checksum_address
+        return None
         
     def connect_plc(self):
         """
         Connect to the PLC via the ModbusClient python package
         """
         if self._server_ip is not None:
-            self._client = ModbusClient(host = self._server_ip, port = self._server_port)
+            if self._client is not None:
+                self._client.close()
+
+            # the session state is managed here, so the client must not re-open the socket on its own
+            self._client = ModbusClient(host = self._server_ip, port = self._server_port, timeout = self._timeout,
+                                        auto_open = False)
             self._client.open()
             if self._client.is_open:
                 self._connected = True
+                self._reconnect_attempts = 0
+                self._last_read = monotonic()
             else:
-                print(f'Failed to connect to PLC at {dt.now()}')
                 self._connected = False
+                self._schedule_reconnect()
+                logging.warning(f'Failed to connect to PLC at {self._server_ip}',
+                                extra = {'event': 'plc_connect_failed', 'server_ip': self._server_ip,
+                                         'attempts': self._reconnect_attempts,
+                                         'retry_in_s': round(self._next_reconnect - monotonic(), 1)})
             
         return None
+
+    def _schedule_reconnect(self):
+        # jittered exponential backoff, so a PLC that is down is not hammered with connection attempts
+        _delay = min(self._reconnect_max_delay, self._reconnect_base_delay * 2**self._reconnect_attempts)
+        self._next_reconnect = monotonic() + random.uniform(_delay/2, _delay)
+        self._reconnect_attempts += 1
+        return None
+
+    def ensure_connection(self):
+        """
+        Keep the PLC session alive across polling cycles: probe a connection that has been idle for longer than the
+        keepalive interval to detect half-open sockets, and reconnect once the backoff delay has passed
+        """
+        if self._connected and monotonic() - self._last_read > self._keepalive_interval:
+            if self._client.read_holding_registers(0, 1) is None:
+                logging.warning(f'PLC at {self._server_ip} did not answer the keepalive probe, reconnecting')
+                self._client.close()
+                self._connected = False
+            else:
+                self._last_read = monotonic()
+
+        if not self._connected and monotonic() >= self._next_reconnect:
+            self.connect_plc()
+
+        return self._connected
+
+    def _read_registers(self, address, count):
+        # read a register block, and retry it once (over a new connection if the socket was dropped) before giving up
+        for _attempt in range(2):
+            if not self._client.is_open:
+                self._client.open()
+            _data = self._client.read_holding_registers(address, count)
+            if _data is not None and len(_data) == count:
+                self._last_read = monotonic()
+                return _data
+
+        if not self._client.is_open:
+            self._connected = False
+            self._schedule_reconnect()
+        raise IOError(f'Failed to read {count} registers at address {address} from PLC at {self._server_ip}')
     
     def check_connection(self):
         """
@@ -212,4 +363,191 @@ class CBMDataExtractor:
                 # if failed to request data, close the connection to the PLC and return an empty list
                 self._connected = False
         
-        return []
\ No newline at end of file
+        return []
+
+    def read_register_blocks(self, block_names, sensor_numbers):
+        """
+        Read the register blocks (see REGISTER_MAP) of the given sensors with the fewest holding register reads, and
+        slice the results back into {block name: array of shape (sensors, registers per sensor)}. Registers that could
+        not be read are set to -1
+        """
+        _sensor_numbers = np.asarray(sensor_numbers, dtype = np.int64)
+        _spans = []
+        _addresses = {}
+        for _name in block_names:
+            _base_address, _num_registers = REGISTER_MAP[_name]
+            _start_addresses = _base_address + _num_registers*_sensor_numbers
+            _spans.extend((_address, _num_registers) for _address in _start_addresses.tolist())
+            _addresses[_name] = _start_addresses[:, None] + np.arange(_num_registers)
+
+        # query all planned reads into one array indexed by register address, a failed read only loses the sensors
+        # whose registers it covers as long as the connection to the PLC survives
+        _reads = plan_register_reads(_spans, max_gap = self._max_register_gap)
+        _registers = np.full(max([_address + _count for _address, _count in _reads], default = 0), -1, dtype = np.int32)
+        for _address, _count in _reads:
+            if not self._connected:
+                break
+            try:
+                _registers[_address:_address + _count] = self._read_registers(_address, _count)
+            except IOError as e:
+                logging.warning(str(e), extra = {'event': 'plc_read_failed', 'server_ip': self._server_ip,
+                                                 'address': _address, 'count': _count,
+                                                 'connected': self._connected})
+
+        return {_name: _registers[_index] for _name, _index in _addresses.items()}
+
+    def _cached_blocks(self, block_names, sensor_numbers):
+        # raw registers of the given sensors from the cache, -1 for sensors without cached registers
+        _blocks = {}
+        for _name in block_names:
+            _blocks[_name] = np.full((len(sensor_numbers), REGISTER_MAP[_name][1]), -1, dtype = np.int32)
+            if _name in self._block_cache:
+                _cache = self._block_cache[_name]
+                _cached = sensor_numbers < len(_cache)
+                _blocks[_name][_cached] = _cache[sensor_numbers[_cached]]
+
+        return _blocks
+
+    def _missing_from_cache(self, block_names, sensor_numbers):
+        return any((x < 0).any() for x in self._cached_blocks(block_names, sensor_numbers).values())
+
+    def _setpoints_due(self, sensor_numbers, scheduled):
+        # the cached setpoints are re-read when they are scheduled (or have expired if there is no schedule), when the
+        # checksum register changed, or when a sensor has no cached setpoints yet
+        _checksum_changed = False
+        if self._setpoint_checksum_address is not None:
+            # the checksum is only a hint, a failed read leaves the setpoints to their schedule instead of failing the
+            # cycle
+            try:
+                _checksum = self._read_registers(self._setpoint_checksum_address, 1)[0]
+                _checksum_changed = _checksum != self._setpoint_checksum
+                self._setpoint_checksum = _checksum
+            except Exception as e:
+                logging.warning(f'Failed to read the setpoint checksum due to {str(e)}, the setpoints are refreshed '
+                                f'on their schedule', extra = {'event': 'setpoint_checksum_failed',
+                                                               'server_ip': self._server_ip})
+
+        if scheduled is None:
+            scheduled = self._setpoints_read_at is None \
+                or monotonic() - self._setpoints_read_at >= self._setpoint_refresh_interval
+
+        return scheduled or _checksum_changed or self._missing_from_cache(SETPOINT_BLOCKS, sensor_numbers)
+
+    def _update_block_cache(self, blocks, sensor_numbers):
+        # cache the registers of every sensor whose block was read completely, and return the sensor numbers whose
+        # cached registers changed
+        _changed = set()
+        _size = sensor_numbers.max(initial = -1) + 1
+        for _name, _raw in blocks.items():
+            _cache = self._block_cache.get(_name, np.full((0, _raw.shape[1]), -1, dtype = np.int32))
+            if len(_cache) < _size:
+                _cache = np.vstack([_cache, np.full((_size - len(_cache), _cache.shape[1]), -1, dtype = np.int32)])
+
+            _complete = (_raw >= 0).all(axis = 1)
+            _updated = sensor_numbers[_complete]
+            _changed.update(_updated[(_cache[_updated] != _raw[_complete]).any(axis = 1)].tolist())
+            _cache[_updated] = _raw[_complete]
+            self._block_cache[_name] = _cache
+
+        return _changed
+
+    def _track_setpoint_changes(self, changed, time_log):
+        # keep track of the changed setpoints of the sensors whose setpoints are cached completely
+        _sensor_numbers = np.array(sorted(changed), dtype = np.int64)
+        _cached = self._cached_blocks(SETPOINT_BLOCKS, _sensor_numbers)
+        _complete = np.all([(x >= 0).all(axis = 1) for x in _cached.values()], axis = 0)
+        if _complete.any():
+            _columns = decode_fields({_name: x[_complete] for _name, x in _cached.items()}, SETPOINT_BLOCKS)
+            _setpoints = np.column_stack(list(_columns.values())).tolist()
+            for _sensor_number, _values in zip(_sensor_numbers[_complete].tolist(), _setpoints):
+                self._setpoint_changes[self._sensor_id_offset + _sensor_number] = (time_log, _values)
+
+        return None
+
+    def pop_setpoint_changes(self):
+        """
+        Return the setpoints that changed (or were read for the first time) since the last call as
+        {sensorID: (time of the change, 12 vibration thresholds + temp warning + temp alarm)}
+        """
+        _changes = self._setpoint_changes
+        self._setpoint_changes = {}
+        return _changes
+
+    def extract_cycle(self, sensor_numbers, time_log = None, signal_groups = None):
+        """
+        Extract the data of every given sensor in one polling cycle, using coalesced register reads instead of the six
+        extract_* requests per sensor, and decode it into a cycle frame with one row of the 32 machinedatatable values
+        per sensor (see transform.py). Sensors whose registers could not be read are left out of the cycle.
+
+        Only the registers of the given signal groups (see SIGNAL_GROUPS) are read. The setpoints that are not read are
+        served from the cache of their last read, the additional statistics that are not read (or failed to read) are
+        NaN, so a value is never stored twice as a new measurement. A cycle without the 'live' group only refreshes
+        the cache and returns no rows. Without signal groups, all groups but 'setpoints' are read, and the setpoints
+        are refreshed on their own (slower) schedule, see set_setpoint_refresh
+        """
+        if self._connected:
+            try:
+                _time_log = dt.now() if time_log is None else time_log
+                _sensor_numbers = np.asarray(sensor_numbers, dtype = np.int64)
+
+                _groups = ['live', 'additional'] if signal_groups is None else list(signal_groups)
+                for _group, _group_blocks in SIGNAL_GROUPS.items():
+                    if _group == 'setpoints':
+                        _due = self._setpoints_due(_sensor_numbers, None if signal_groups is None else
+                                                   _group in _groups)
+                    else:
+                        _due = _group in _groups
+                    if _due and _group not in _groups:
+                        _groups.append(_group)
+
+                _blocks = self.read_register_blocks([x for _group in _groups for x in SIGNAL_GROUPS[_group]],
+                                                    _sensor_numbers)
+                if 'setpoints' in _groups:
+                    self._setpoints_read_at = monotonic()
+
+                # the setpoints go through the cache, so a failed read falls back to the last values read
+                _live_blocks = {x: _blocks.pop(x) for x in SIGNAL_GROUPS['live'] if x in _blocks}
+                _setpoint_blocks = {x: _blocks.pop(x) for x in SETPOINT_BLOCKS if x in _blocks}
+                _sampled_blocks = _blocks
+                _setpoints_changed = self._update_block_cache(_setpoint_blocks, _sensor_numbers)
+                if _setpoints_changed:
+                    self._track_setpoint_changes(_setpoints_changed, _time_log)
+
+                if 'live' not in _groups:
+                    return empty_cycle_frame()
+
+                _blocks = self._cached_blocks(SETPOINT_BLOCKS, _sensor_numbers)
+                _blocks.update(_live_blocks)
+
+                _complete = np.all([(x >= 0).all(axis = 1) for x in _blocks.values()], axis = 0)
+                if not _complete.all():
+                    logging.warning(f'Skipped sensors {_sensor_numbers[~_complete].tolist()} in this cycle due to '
+                                    f'failed register reads',
+                                    extra = {'event': 'sensors_skipped', 'server_ip': self._server_ip,
+                                             'time_log': _time_log})
+
+                _blocks.update(_sampled_blocks)
+                _cycle_frame = decode_cycle({_name: x[_complete] for _name, x in _blocks.items()},
+                                            self._sensor_id_offset + _sensor_numbers[_complete], _time_log)
+                # the additional statistics of the sensors whose read failed are not sampled in this cycle
+                for _name, _raw in _sampled_blocks.items():
+                    _failed = ~(_raw[_complete] >= 0).all(axis = 1)
+                    if _failed.any():
+                        logging.warning(f'Stored no {_name} registers of sensors '
+                                        f'{_sensor_numbers[_complete][_failed].tolist()} in this cycle due to failed '
+                                        f'register reads', extra = {'event': 'sampled_fields_missing',
+                                                                     'server_ip': self._server_ip,
+                                                                     'time_log': _time_log})
+                        for _field in decode_fields({_name: _raw[:1]}, [_name]):
+                            _cycle_frame[_field][_failed] = np.nan
+
+                return _cycle_frame
+
+            except:
+                # if failed to request data, close the connection to the PLC, and return an empty cycle frame
+                logging.warning(f'Failed to extract the cycle from PLC at {self._server_ip}', exc_info = True,
+                                extra = {'event': 'cycle_failed', 'server_ip': self._server_ip,
+                                         'sensors': len(sensor_numbers), 'signal_groups': signal_groups})
+                self._connected = False
+
+        return empty_cycle_frame()
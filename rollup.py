@@ -0,0 +1,299 @@
+import logging
+import threading
+from time import monotonic
+from datetime import datetime as dt, timedelta
+from transform import FIELD_SPEC, SAMPLED_FIELDS
+from aggregate import DAILY_SIGNALS
+
+
+# rollup tiers of the machinedatatable: (name, bucket length in minutes), finest first
+ROLLUP_TIERS = [('1m', 1), ('1h', 60), ('1d', 1440)]
+
+# the tiers keep the mean of every field per sensor and bucket, the maximum of the MotorRunFlag (the motor ran
+# during the bucket), and the minimum and maximum of the main signals as <signal>min and <signal>max. The means of the
+# SAMPLED_FIELDS are over the rows that sampled them (not NULL), counted in the column sampled
+ROLLUP_MEAN_COLUMNS = [_name for _name, _block, _offset, _scale, _dtype in FIELD_SPEC if _name != 'MotorRunFlag']
+ROLLUP_EXTREMA_COLUMNS = [_signal + _extremum for _signal in DAILY_SIGNALS for _extremum in ('min', 'max')]
+
+# columns of the denormalizedview and additional_vibration_data views, the views of the tiers have the same columns
+DENORMALIZED_COLUMNS = ['Zvel', 'Zacc', 'Xvel', 'Xacc', 'Temp',
+                        'Zvelbase', 'Zaccbase', 'Xvelbase', 'Xaccbase',
+                        'Zvelwarn', 'Zaccwarn', 'Xvelwarn', 'Xaccwarn', 'Tempwarn',
+                        'Zvelalarm', 'Zaccalarm', 'Xvelalarm', 'Xaccalarm', 'Tempalarm',
+                        'MotorRunFlag']
+ADDITIONAL_VIBRATION_COLUMNS = ['ZpeakAcc', 'XpeakAcc', 'ZpeakVel', 'XpeakVel', 'ZRMSlowAcc', 'XRMSlowAcc',
+                                'Zkurtosis', 'Xkurtosis', 'Zcrestfac', 'Xcrestfac', 'MotorRunFlag']
+
+
+def rollup_table(tier):
+    return f'MachineDataRollup{tier}'
+
+
+def rollup_view(view, tier):
+    """
+    Return the name of the view of a rollup tier with the columns of view (denormalizedview or
+    additional_vibration_data), tier 'raw' is the view itself
+    """
+    return view if tier == 'raw' else f'{view}_{tier}'
+
+
+class RollupManager:
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._conn = None
+        self._interval = 60.0
+        self._chunk_rows = 50000
+        self._retention_days = {}
+        self._visible_id = None
+        # the retention scans the time_log of the tiers, once an hour is often enough for retentions of days
+        self._purge_interval = 3600.0
+        self._purged_at = None
+        self._change_listener = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set_rollup_policy(self, interval, chunk_rows, retention_days):
+        """
+        Set the time (seconds) between two rollup runs, the number of raw rows rolled up or purged per transaction, and
+        the days the raw rows ('raw') and the rows of each tier are kept {tier: days, None to keep them forever}
+        """
+        self._interval = interval
+        self._chunk_rows = chunk_rows
+        self._retention_days = retention_days
+        return None
+
+    def set_change_listener(self, listener):
+        """
+        Call listener(tables) with the tables changed by every rollup and purge (see CacheInvalidator in cache.py)
+        """
+        self._change_listener = listener
+        return None
+
+    def connect(self):
+        self._conn = self._storage.connect()
+        return None
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except:
+                pass
+            self._conn = None
+        return None
+
+    def create_schema(self):
+        """
+        Create the tables of the rollup tiers, their views and the watermark table if they do not exist yet
+        """
+        _cursor = self._conn.cursor()
+        _columns = ', '.join(f'{x} FLOAT' for x in ROLLUP_MEAN_COLUMNS + ROLLUP_EXTREMA_COLUMNS)
+        for _tier, _minutes in ROLLUP_TIERS:
+            self._storage.create_if_missing(_cursor, 'TABLE', rollup_table(_tier), f'''(
+                rollupID {self._storage.identity_column},
+                sensorID INT,
+                time_log DATETIME,
+                samples INT,
+                sampled INT,
+                MotorRunFlag INT,
+                {_columns},
+                UNIQUE (sensorID, time_log))''')
+            # tiers created before the column was added, their rows count every row as sampled (see _merge_chunk)
+            self._storage.add_column_if_missing(_cursor, rollup_table(_tier), 'sampled', 'INT')
+
+            for _view, _view_columns in [('denormalizedview', DENORMALIZED_COLUMNS),
+                                         ('additional_vibration_data', ADDITIONAL_VIBRATION_COLUMNS)]:
+                self._storage.create_if_missing(_cursor, 'VIEW', rollup_view(_view, _tier), f'''AS
+                    SELECT r.rollupID AS measurementID, m.machineID, m.machineName, m.machineLoc, s.sensorID,
+                    s.sensorName, r.time_log, {', '.join('r.' + x for x in _view_columns)}
+                    FROM {rollup_table(_tier)} r
+                    JOIN SensorDataTable s ON s.sensorID = r.sensorID
+                    JOIN MachineTable m ON m.machineID = s.machineID''')
+
+        self._storage.create_if_missing(_cursor, 'TABLE', 'RollupWatermark', '''(
+            name VARCHAR(20) PRIMARY KEY,
+            measurementID INT)''')
+        self._conn.commit()
+        return None
+
+    def start(self):
+        """
+        Run the rollup and the retention every interval on a background thread, the tables of the tiers are created
+        when they are missing
+        """
+        self._thread = threading.Thread(target = self._run, name = 'rollup', daemon = True)
+        self._thread.start()
+        return None
+
+    def stop(self, timeout = None):
+        """
+        Stop the rollup after the running chunk and close its database connection
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.close()
+        return None
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                if self._conn is None:
+                    self.connect()
+                    self.create_schema()
+                self.roll_up()
+                if self._purged_at is None or monotonic() - self._purged_at >= self._purge_interval:
+                    self.purge()
+            except Exception as e:
+                logging.warning(f'Failed to roll up the machinedatatable due to {str(e)}, retrying in {self._interval}s')
+                self.close()
+
+        return None
+
+    def _watermark(self, cursor):
+        cursor.execute("SELECT measurementID FROM RollupWatermark WHERE name = 'machinedata'")
+        _row = cursor.fetchone()
+        if _row is None:
+            cursor.execute("INSERT INTO RollupWatermark (name, measurementID) VALUES ('machinedata', 0)")
+            return 0
+        return _row[0]
+
+    def roll_up(self):
+        """
+        Merge the raw rows loaded since the last run into all tiers, in chunks of raw rows by measurementID. The
+        watermark (the last measurementID rolled up) is committed together with the tiers, so every raw row is rolled up
+        exactly once, also the rows of a spool backlog that are loaded late into buckets that were rolled up already
+        """
+        _cursor = self._conn.cursor()
+        _cursor.execute('SELECT MAX(measurementID) FROM machinedatatable')
+        _max_id = _cursor.fetchone()[0] or 0
+        # only roll up to the highest measurementID seen by the previous run, so rows of an insert transaction that
+        # was still running at that time (identity values are assigned before the commit) are not skipped
+        _visible_id = self._visible_id if self._visible_id is not None else 0
+        self._visible_id = _max_id
+
+        _watermark = self._watermark(_cursor)
+        _rows = 0
+        while _watermark < _visible_id and not self._stop.is_set():
+            _chunk_end = min(_watermark + self._chunk_rows, _visible_id)
+            for _tier, _minutes in ROLLUP_TIERS:
+                self._merge_chunk(_cursor, _tier, _minutes, _watermark, _chunk_end)
+            _cursor.execute("UPDATE RollupWatermark SET measurementID = ? WHERE name = 'machinedata'", (_chunk_end,))
+            self._conn.commit()
+            _rows += _chunk_end - _watermark
+            _watermark = _chunk_end
+
+        if _rows:
+            logging.info(f'Rolled up measurementIDs up to {_watermark} into the tiers')
+            self._notify([rollup_table(_tier) for _tier, _minutes in ROLLUP_TIERS])
+        return None
+
+    def _notify(self, tables):
+        if self._change_listener is not None:
+            self._change_listener(tables)
+        return None
+
+    def _merge_chunk(self, cursor, tier, minutes, first_id, last_id):
+        # aggregate the raw rows first_id < measurementID <= last_id per sensor and bucket, and merge the partial
+        # aggregates into the rows of the tier: the means weighted by the samples, the extrema by comparison
+        _bucket = self._storage.bucket_expr('time_log', minutes)
+        _aggregates = ', '.join([f'SUM({x})' for x in ROLLUP_MEAN_COLUMNS] + [f'COUNT({SAMPLED_FIELDS[0]})',
+                                                                              'MAX(MotorRunFlag)'] +
+                                [f'{x[-3:].upper()}({x[:-3]})' for x in ROLLUP_EXTREMA_COLUMNS])
+        cursor.execute(f'''
+        SELECT sensorID, {_bucket}, COUNT(*), {_aggregates} FROM machinedatatable
+        WHERE measurementID > ? AND measurementID <= ? GROUP BY sensorID, {_bucket}
+        ''', (first_id, last_id))
+        _partials = [(x[0], dt.fromisoformat(x[1]) if isinstance(x[1], str) else x[1], *x[2:])
+                     for x in cursor.fetchall()]
+        if not _partials:
+            return None
+
+        cursor.execute(f'SELECT sensorID, time_log FROM {rollup_table(tier)} WHERE time_log BETWEEN ? AND ?',
+                       (min(x[1] for x in _partials), max(x[1] for x in _partials)))
+        _existing = set((x[0], x[1]) for x in cursor.fetchall())
+
+        _num_means = len(ROLLUP_MEAN_COLUMNS)
+        _updates = []
+        _inserts = []
+        for _sensor_id, _time_log, _samples, *_values in _partials:
+            _sums, _sampled = _values[:_num_means], _values[_num_means]
+            _motor_run, _extrema = _values[_num_means + 1], _values[_num_means + 2:]
+            _counts = [_sampled if x in SAMPLED_FIELDS else _samples for x in ROLLUP_MEAN_COLUMNS]
+            if (_sensor_id, _time_log) in _existing:
+                _updates.append((*[_parameter for _sum, _count, _column in zip(_sums, _counts, ROLLUP_MEAN_COLUMNS)
+                                   for _parameter in ((_count, _sum, _count, _sum, _count) if _column in SAMPLED_FIELDS
+                                                      else (_sum, _count))],
+                                 _motor_run, _motor_run,
+                                 *[_parameter for _extremum in _extrema for _parameter in (_extremum, _extremum)],
+                                 _samples, _sampled, _sensor_id, _time_log))
+            else:
+                _means = [None if _sum is None or not _count else _sum/_count for _sum, _count in zip(_sums, _counts)]
+                _inserts.append((_sensor_id, _time_log, _samples, _sampled, _motor_run, *_means, *_extrema))
+
+        if _updates:
+            # all expressions of the SET clause see the values before the update, including samples and sampled (NULL
+            # in the rows rolled up before it was added, which counted every row)
+            _set = [f'{x} = CASE WHEN ? = 0 THEN {x} WHEN {x} IS NULL THEN ? / ? '
+                    f'ELSE ({x} * COALESCE(sampled, samples) + ?) / (COALESCE(sampled, samples) + ?) END'
+                    if x in SAMPLED_FIELDS else f'{x} = ({x} * samples + ?) / (samples + ?)'
+                    for x in ROLLUP_MEAN_COLUMNS]
+            _set += ['MotorRunFlag = CASE WHEN MotorRunFlag > ? THEN MotorRunFlag ELSE ? END']
+            _set += [f"{x} = CASE WHEN {x} {'<' if x.endswith('min') else '>'} ? THEN {x} ELSE ? END"
+                     for x in ROLLUP_EXTREMA_COLUMNS]
+            cursor.executemany(f'''
+            UPDATE {rollup_table(tier)} SET {', '.join(_set)}, samples = samples + ?,
+            sampled = COALESCE(sampled, samples) + ?
+            WHERE sensorID = ? AND time_log = ?
+            ''', _updates)
+
+        if _inserts:
+            _columns = (['sensorID', 'time_log', 'samples', 'sampled', 'MotorRunFlag'] + ROLLUP_MEAN_COLUMNS +
+                        ROLLUP_EXTREMA_COLUMNS)
+            cursor.executemany(f'''
+            INSERT INTO {rollup_table(tier)} ({', '.join(_columns)}) VALUES ({','.join(['?']*len(_columns))})
+            ''', _inserts)
+
+        return None
+
+    def purge(self):
+        """
+        Delete the raw rows and the tier rows older than their retention, in chunks by id. Raw rows are only deleted once
+        they are rolled up. With the parquet archive enabled (see archive.py) the raw rows remain in the archive
+        """
+        self._purged_at = monotonic()
+        _cursor = self._conn.cursor()
+        _now = dt.now()
+        _watermark = self._watermark(_cursor)
+        _tables = [('raw', 'machinedatatable', 'measurementID', _watermark)]
+        _tables += [(_tier, rollup_table(_tier), 'rollupID', None) for _tier, _minutes in ROLLUP_TIERS]
+        _purged = []
+        for _tier, _table, _id_column, _max_id in _tables:
+            if self._retention_days.get(_tier) is None:
+                continue
+
+            _cutoff = _now - timedelta(days = self._retention_days[_tier])
+            _cursor.execute(f'SELECT MIN({_id_column}), MAX({_id_column}) FROM {_table} WHERE time_log < ?', (_cutoff,))
+            _first_id, _last_id = _cursor.fetchone()
+            if _first_id is None:
+                continue
+            if _max_id is not None:
+                _last_id = min(_last_id, _max_id)
+
+            _deleted = 0
+            for _chunk_start in range(_first_id, _last_id + 1, self._chunk_rows):
+                if self._stop.is_set():
+                    break
+                _cursor.execute(f'DELETE FROM {_table} WHERE {_id_column} >= ? AND {_id_column} < ? AND time_log < ?',
+                                (_chunk_start, min(_chunk_start + self._chunk_rows, _last_id + 1), _cutoff))
+                _deleted += _cursor.rowcount
+                self._conn.commit()
+
+            logging.info(f'Purged {_deleted} rows older than {_cutoff} from {_table}')
+            if _deleted:
+                _purged.append(_table)
+
+        if _purged:
+            self._notify(_purged)
+        return None
@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+from datetime import datetime as dt
+from math import gcd
+
+
+class CycleScheduler:
+
+    def __init__(self):
+        self._periods = {}
+        self._stop = threading.Event()
+        self._overruns = 0
+
+    def add_signal_group(self, name, period):
+        """
+        Sample the signal group every period seconds (whole seconds), on ticks aligned to the local wall clock
+        (e.g. a 60 s group fires at every full minute)
+        """
+        if int(period) != period or period <= 0:
+            raise ValueError(f'Sampling period of signal group {name} must be a positive number of whole seconds')
+        self._periods[name] = int(period)
+        return None
+
+    def tick_period(self):
+        """
+        Return the period (seconds) of the scheduler ticks, the greatest common divisor of all group periods
+        """
+        _tick = 0
+        for _period in self._periods.values():
+            _tick = gcd(_tick, _period)
+        return _tick
+
+    def next_tick(self, now):
+        """
+        Return the first wall-clock aligned tick (epoch seconds) after now
+        """
+        _tick = self.tick_period()
+        _utc_offset = time.localtime(now).tm_gmtoff
+        return ((now + _utc_offset) // _tick + 1) * _tick - _utc_offset
+
+    def due_groups(self, tick):
+        """
+        Return the signal groups due at the given tick (epoch seconds)
+        """
+        _local_tick = round(tick) + time.localtime(tick).tm_gmtoff
+        return [_name for _name, _period in self._periods.items() if _local_tick % _period == 0]
+
+    def overrun_count(self):
+        """
+        Return the number of cycles that took longer than the scheduler tick period
+        """
+        return self._overruns
+
+    def stop(self):
+        """
+        Stop the scheduler, the running cycle is finished first
+        """
+        self._stop.set()
+        return None
+
+    def run(self, cycle):
+        """
+        Call cycle(time_log, signal_groups) at every tick with the scheduled tick time and the signal groups due at that
+        tick, until stop is called. The ticks are computed from the wall clock instead of sleeping a fixed time after
+        each cycle, so the cycle duration does not make the schedule drift. Ticks missed by a cycle that overran are
+        reported and skipped
+        """
+        if not self._periods:
+            raise ValueError('No signal groups to schedule')
+
+        _tick = self.next_tick(time.time())
+        while not self._stop.wait(max(0.0, _tick - time.time())):
+            cycle(dt.fromtimestamp(_tick), self.due_groups(_tick))
+
+            _now = time.time()
+            _next_tick = self.next_tick(_tick)
+            if _now > _next_tick:
+                _missed = int((_now - _next_tick) // self.tick_period()) + 1
+                self._overruns += 1
+                logging.warning(f'Cycle of {dt.fromtimestamp(_tick)} overran by {_now - _next_tick:.1f} s, skipped '
+                                f'{_missed} tick(s)')
+                _next_tick = self.next_tick(_now)
+            _tick = _next_tick
+
+        return None
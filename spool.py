@@ -0,0 +1,222 @@
+import sqlite3
+import threading
+import logging
+import json
+from io import BytesIO
+from datetime import datetime as dt
+import numpy as np
+
+
+class CycleSpool:
+
+    def __init__(self):
+        self._path = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def set_spool_path(self, path):
+        """
+        Set the path of the SQLite file that holds the spooled cycles
+        """
+        self._path = path
+        return None
+
+    def open(self):
+        """
+        Open (or create) the spool. The spool is an append-only SQLite table in WAL mode with full synchronous commits,
+        so every appended cycle survives a crash of the ETL or of the machine
+        """
+        self._conn = sqlite3.connect(self._path, check_same_thread = False, isolation_level = None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS spool (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            num_rows INTEGER NOT NULL,
+            payload BLOB NOT NULL);
+        ''')
+        return None
+
+    def close(self):
+        """
+        Close the spool, the spooled records are kept for the next start
+        """
+        with self._lock:
+            self._conn.close()
+        return None
+
+    def append_cycle(self, cycle_frame, setpoint_changes):
+        """
+        Append the cycle frame and the setpoint changes {sensorID: (time of the change, setpoints)} of a cycle to the
+        spool in one transaction
+        """
+        _records = []
+        if setpoint_changes:
+            _payload = {_sensor_id: [_time_log.isoformat(), _setpoints]
+                        for _sensor_id, (_time_log, _setpoints) in setpoint_changes.items()}
+            _records.append(('setpoints', len(_payload), json.dumps(_payload).encode()))
+        if len(cycle_frame):
+            _buffer = BytesIO()
+            np.save(_buffer, cycle_frame, allow_pickle = False)
+            _records.append(('cycle', len(cycle_frame), _buffer.getvalue()))
+
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT INTO spool (kind, num_rows, payload) VALUES (?,?,?)', _records)
+            self._conn.execute('COMMIT')
+
+        return None
+
+    def pending_rows(self):
+        """
+        Return the number of spooled rows that were not loaded to the database yet
+        """
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(SUM(num_rows), 0) FROM spool').fetchone()[0]
+
+    def peek(self, max_rows):
+        """
+        Return the oldest spooled records, in the order they were appended, as a list of (seq, kind, data) with about
+        max_rows rows in total (at least one record). data is a cycle frame for kind 'cycle', and the setpoint changes
+        {sensorID: (time of the change, setpoints)} for kind 'setpoints'
+        """
+        with self._lock:
+            _cursor = self._conn.execute('SELECT seq, kind, num_rows, payload FROM spool ORDER BY seq')
+            _records = []
+            _num_rows = 0
+            for _seq, _kind, _rows, _payload in _cursor:
+                if _records and _num_rows + _rows > max_rows:
+                    break
+                _records.append((_seq, _kind, _payload))
+                _num_rows += _rows
+            _cursor.close()
+
+        _decoded = []
+        for _seq, _kind, _payload in _records:
+            if _kind == 'cycle':
+                _data = np.load(BytesIO(_payload), allow_pickle = False)
+            else:
+                _data = {int(_sensor_id): (dt.fromisoformat(_time_log), _setpoints)
+                         for _sensor_id, (_time_log, _setpoints) in json.loads(_payload).items()}
+            _decoded.append((_seq, _kind, _data))
+
+        return _decoded
+
+    def acknowledge(self, last_seq):
+        """
+        Remove all records up to and including last_seq from the spool, once they are loaded to the database
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM spool WHERE seq <= ?', (last_seq,))
+        return None
+
+
+class SpoolDrainer:
+
+    def __init__(self, spool, database_load):
+        self._spool = spool
+        self._database_load = database_load
+        self._batch_rows = 5000
+        self._retry_interval = 30.0
+        self._change_listener = None
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set_drain_policy(self, batch_rows, retry_interval):
+        """
+        Set the number of rows replayed per database transaction, and the time (seconds) to wait before the database is
+        tried again after a failure
+        """
+        self._batch_rows = batch_rows
+        self._retry_interval = retry_interval
+        return None
+
+    def set_change_listener(self, listener):
+        """
+        Call listener(tables) with the tables changed after every committed batch (see CacheInvalidator in cache.py)
+        """
+        self._change_listener = listener
+        return None
+
+    def start(self):
+        """
+        Start replaying the spool to the database on a background thread
+        """
+        self._thread = threading.Thread(target = self._run, name = 'spool-drainer', daemon = True)
+        self._thread.start()
+        return None
+
+    def wake(self):
+        """
+        Tell the drainer that new cycles were appended to the spool
+        """
+        self._wakeup.set()
+        return None
+
+    def stop(self, timeout = None):
+        """
+        Stop the drainer after the running batch and close its database connection
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._database_load.close_connection()
+        return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.drain():
+                # the spool is empty, wait for the next cycle
+                self._wakeup.wait()
+                self._wakeup.clear()
+            else:
+                # the database is unavailable, keep the backlog and try again later
+                self._stop.wait(self._retry_interval)
+
+        return None
+
+    def drain(self):
+        """
+        Replay the spool to the database in large batches, oldest records first, until it is empty. A record is only
+        removed from the spool after its batch is committed, and rows that are already in the machinedatatable are
+        skipped, so a batch that is replayed again after a crash is not loaded twice. Return whether the spool was
+        drained completely
+        """
+        while not self._stop.is_set():
+            _records = self._spool.peek(self._batch_rows)
+            if not _records:
+                return True
+
+            try:
+                if not self._database_load._connected:
+                    self._database_load.connect_to_database()
+            except Exception as e:
+                logging.warning(f'Failed to connect to database due to {str(e)}, {self._spool.pending_rows()} rows '
+                                f'remain spooled')
+                return False
+            if not self._database_load._connected:
+                return False
+
+            _frames = []
+            _tables = set()
+            for _seq, _kind, _data in _records:
+                if _kind == 'setpoints':
+                    _tables.add('SetpointTable')
+                    for _sensor_id, (_time_log, _setpoints) in _data.items():
+                        self._database_load.load_setpoints(_sensor_id, _time_log, _setpoints)
+                else:
+                    _frames.append(_data)
+            if _frames:
+                self._database_load.load_sensor_batch(_frames, skip_existing = True)
+                _tables.add('machinedatatable')
+
+            if not self._database_load._connected:
+                return False
+            self._spool.acknowledge(_records[-1][0])
+            if self._change_listener is not None:
+                self._change_listener(_tables)
+
+        return False
@@ -0,0 +1,377 @@
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+from time import monotonic
+from datetime import datetime as dt, date
+
+
+def _sqlite_params(params):
+    # the DATETIME columns are ISO text, as is the date of the dailytable
+    if isinstance(params, dict):
+        return params
+    return tuple(x.isoformat(' ') if isinstance(x, dt) else x.isoformat() if isinstance(x, date) else x for x in params)
+
+
+class _SQLiteCursor(sqlite3.Cursor):
+    # binds the datetimes and dates of the parameters as ISO text, without the process-wide adapters of sqlite3 (the
+    # spool has its own connection)
+
+    def execute(self, sql, parameters = ()):
+        return super().execute(sql, _sqlite_params(parameters))
+
+    def executemany(self, sql, seq_of_parameters):
+        return super().executemany(sql, (_sqlite_params(x) for x in seq_of_parameters))
+
+
+class _SQLiteConnection(sqlite3.Connection):
+    # the connections of SQLiteStorage, every statement runs on a _SQLiteCursor
+
+    def cursor(self, factory = _SQLiteCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters = ()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class SQLServerStorage:
+    """
+    The production SQL Server database, connected with a trusted connection
+    """
+
+    name = 'sqlserver'
+    identity_column = 'INT IDENTITY(1,1) PRIMARY KEY'
+
+    def __init__(self, server, database):
+        self._server = server
+        self._database = database
+
+    def connect(self):
+        # pyodbc (and the ODBC driver) are only needed for the SQL Server backend
+        import pyodbc
+        _conn_str = 'DRIVER={SQL Server};SERVER='+self._server+';DATABASE='+self._database+';Trusted_Connection=True'
+        return pyodbc.connect(_conn_str)
+
+    def prepare_bulk_cursor(self, cursor):
+        # send the parameters of all rows of an executemany in one round trip instead of one per row
+        cursor.fast_executemany = True
+        return cursor
+
+    def bucket_expr(self, column, minutes):
+        # start of the bucket of a datetime column, the buckets are aligned to 1900-01-01 (a Monday)
+        return f'DATEADD(minute, DATEDIFF(minute, 0, {column}) / {minutes} * {minutes}, 0)'
+
+    def limit_clause(self, limit):
+        # first rows of a query with an ORDER BY clause
+        return f'OFFSET 0 ROWS FETCH NEXT {int(limit)} ROWS ONLY'
+
+    def create_if_missing(self, conn, kind, name, definition):
+        # CREATE VIEW has to be the only statement of its batch, so the statements run through EXEC
+        _statement = f'CREATE {kind} {name} {definition}'.replace("'", "''")
+        conn.execute(f"IF OBJECT_ID('{name}') IS NULL EXEC('{_statement}')")
+        return None
+
+    def add_column_if_missing(self, conn, table, column, definition):
+        conn.execute(f"IF COL_LENGTH('{table}', '{column}') IS NULL ALTER TABLE {table} ADD {column} {definition}")
+        return None
+
+
+class SQLiteStorage:
+    """
+    Embedded SQLite database in WAL mode with the same tables and views as the SQL Server database, for small edge
+    deployments and for running and benchmarking the ETL and the API locally
+    """
+
+    name = 'sqlite'
+    identity_column = 'INTEGER PRIMARY KEY AUTOINCREMENT'
+
+    def __init__(self, path):
+        self._path = path
+
+    def connect(self):
+        # the DATETIME columns are read back as datetime objects, the converter only applies to connections that
+        # detect the declared types
+        sqlite3.register_converter('DATETIME', lambda x: dt.fromisoformat(x.decode()))
+        _conn = sqlite3.connect(self._path, detect_types = sqlite3.PARSE_DECLTYPES, check_same_thread = False,
+                                timeout = 30.0, factory = _SQLiteConnection)
+        _conn.execute('PRAGMA journal_mode=WAL')
+        _conn.execute('PRAGMA synchronous=NORMAL')
+        _conn.execute('PRAGMA foreign_keys=ON')
+        return _conn
+
+    def prepare_bulk_cursor(self, cursor):
+        return cursor
+
+    def create_schema(self, conn):
+        """
+        Create the tables, indexes and views of the database if they do not exist yet
+        """
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS MachineTable (
+            machineID INTEGER PRIMARY KEY,
+            machineName VARCHAR(50),
+            machineLoc VARCHAR(50));
+
+            CREATE TABLE IF NOT EXISTS SensorDataTable (
+            sensorID INTEGER PRIMARY KEY,
+            machineID INTEGER,
+            sensorName VARCHAR(20),
+            sensorType VARCHAR(20),
+            FOREIGN KEY (machineID) REFERENCES MachineTable(machineID));
+
+            CREATE TABLE IF NOT EXISTS MachineDataTable (
+            measurementID INTEGER PRIMARY KEY AUTOINCREMENT,
+            sensorID INTEGER,
+            time_log DATETIME,
+            Zvel FLOAT, Zacc FLOAT, Xvel FLOAT, Xacc FLOAT, Temp FLOAT,
+            Zvelbase FLOAT, Zaccbase FLOAT, Xvelbase FLOAT, Xaccbase FLOAT,
+            Zvelwarn FLOAT, Zaccwarn FLOAT, Xvelwarn FLOAT, Xaccwarn FLOAT,
+            Zvelalarm FLOAT, Zaccalarm FLOAT, Xvelalarm FLOAT, Xaccalarm FLOAT,
+            Tempwarn FLOAT, Tempalarm FLOAT, MotorRunFlag INTEGER,
+            ZpeakAcc FLOAT, XpeakAcc FLOAT, ZpeakVel FLOAT, XpeakVel FLOAT,
+            ZRMSlowAcc FLOAT, XRMSlowAcc FLOAT, Zkurtosis FLOAT, Xkurtosis FLOAT,
+            Zcrestfac FLOAT, Xcrestfac FLOAT);
+            CREATE INDEX IF NOT EXISTS IX_MachineDataTable_sensorID_time_log ON MachineDataTable (sensorID, time_log);
+            CREATE INDEX IF NOT EXISTS IX_MachineDataTable_time_log ON MachineDataTable (time_log);
+
+            CREATE TABLE IF NOT EXISTS SetpointTable (
+            setpointID INTEGER PRIMARY KEY AUTOINCREMENT,
+            sensorID INTEGER,
+            valid_from DATETIME,
+            Zvelbase FLOAT, Zaccbase FLOAT, Xvelbase FLOAT, Xaccbase FLOAT,
+            Zvelwarn FLOAT, Zaccwarn FLOAT, Xvelwarn FLOAT, Xaccwarn FLOAT,
+            Zvelalarm FLOAT, Zaccalarm FLOAT, Xvelalarm FLOAT, Xaccalarm FLOAT,
+            Tempwarn FLOAT, Tempalarm FLOAT);
+            CREATE INDEX IF NOT EXISTS IX_SetpointTable_sensorID ON SetpointTable (sensorID, valid_from);
+
+            -- daily medians per sensor, in the column order the API reads them, followed by the statistics the ETL
+            -- maintains (see aggregate.py)
+            CREATE TABLE IF NOT EXISTS dailytable (
+            sensorID INTEGER,
+            sensorName VARCHAR(20),
+            machineID INTEGER,
+            machineName VARCHAR(50),
+            date VARCHAR(10),
+            Temp FLOAT, Zvel FLOAT, Zacc FLOAT, Xvel FLOAT, Xacc FLOAT,
+            Tempmin FLOAT, Tempmax FLOAT, Tempmean FLOAT, Tempp05 FLOAT, Tempp95 FLOAT,
+            Zvelmin FLOAT, Zvelmax FLOAT, Zvelmean FLOAT, Zvelp05 FLOAT, Zvelp95 FLOAT,
+            Zaccmin FLOAT, Zaccmax FLOAT, Zaccmean FLOAT, Zaccp05 FLOAT, Zaccp95 FLOAT,
+            Xvelmin FLOAT, Xvelmax FLOAT, Xvelmean FLOAT, Xvelp05 FLOAT, Xvelp95 FLOAT,
+            Xaccmin FLOAT, Xaccmax FLOAT, Xaccmean FLOAT, Xaccp05 FLOAT, Xaccp95 FLOAT,
+            samples INTEGER,
+            PRIMARY KEY (sensorID, date));
+            CREATE INDEX IF NOT EXISTS IX_dailytable_date ON dailytable (date);
+
+            CREATE VIEW IF NOT EXISTS denormalizedview AS
+            SELECT d.measurementID, m.machineID, m.machineName, m.machineLoc, s.sensorID, s.sensorName, d.time_log,
+            d.Zvel, d.Zacc, d.Xvel, d.Xacc, d.Temp,
+            d.Zvelbase, d.Zaccbase, d.Xvelbase, d.Xaccbase,
+            d.Zvelwarn, d.Zaccwarn, d.Xvelwarn, d.Xaccwarn, d.Tempwarn,
+            d.Zvelalarm, d.Zaccalarm, d.Xvelalarm, d.Xaccalarm, d.Tempalarm,
+            d.MotorRunFlag
+            FROM MachineDataTable d
+            JOIN SensorDataTable s ON s.sensorID = d.sensorID
+            JOIN MachineTable m ON m.machineID = s.machineID;
+
+            CREATE VIEW IF NOT EXISTS additional_vibration_data AS
+            SELECT d.measurementID, m.machineID, m.machineName, m.machineLoc, s.sensorID, s.sensorName, d.time_log,
+            d.ZpeakAcc, d.XpeakAcc, d.ZpeakVel, d.XpeakVel, d.ZRMSlowAcc, d.XRMSlowAcc,
+            d.Zkurtosis, d.Xkurtosis, d.Zcrestfac, d.Xcrestfac, d.MotorRunFlag
+            FROM MachineDataTable d
+            JOIN SensorDataTable s ON s.sensorID = d.sensorID
+            JOIN MachineTable m ON m.machineID = s.machineID;
+        ''')
+        conn.commit()
+        return None
+
+    def bucket_expr(self, column, minutes):
+        # start of the bucket of a datetime column, the buckets are aligned to 1970-01-05 (a Monday)
+        return (f"datetime((CAST(strftime('%s', {column}) AS INTEGER) - 345600) / {60*minutes} * {60*minutes} + 345600, "
+                f"'unixepoch')")
+
+    def limit_clause(self, limit):
+        return f'LIMIT {int(limit)}'
+
+    def create_if_missing(self, conn, kind, name, definition):
+        conn.execute(f'CREATE {kind} IF NOT EXISTS {name} {definition}')
+        return None
+
+    def add_column_if_missing(self, conn, table, column, definition):
+        if column not in [x[1] for x in conn.execute(f'PRAGMA table_info({table})').fetchall()]:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        return None
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of connections to a storage backend. Connections are checked for health when they were idle for a
+    while, closed when they stay idle above the minimum size, and lent out one request at a time with a new cursor
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._min_size = 1
+        self._max_size = 8
+        self._checkout_timeout = 30.0
+        self._health_check_after = 30.0
+        self._idle_timeout = 600.0
+        self._idle = []
+        self._size = 0
+        self._available = threading.Condition()
+
+    def set_pool_size(self, min_size, max_size, checkout_timeout = 30.0):
+        """
+        Set the number of connections kept open when idle, the most connections open at once, and the time (seconds) a
+        checkout waits for a connection when all are in use
+        """
+        self._min_size = min_size
+        self._max_size = max_size
+        self._checkout_timeout = checkout_timeout
+        return None
+
+    def set_idle_policy(self, health_check_after, idle_timeout):
+        """
+        Set the idle time (seconds) after which a connection is checked with a probe query before it is lent out, and
+        the idle time after which connections above the minimum size are closed
+        """
+        self._health_check_after = health_check_after
+        self._idle_timeout = idle_timeout
+        return None
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except:
+            pass
+        return None
+
+    def _healthy(self, conn):
+        try:
+            _cursor = conn.cursor()
+            _cursor.execute('SELECT 1')
+            _cursor.fetchall()
+            _cursor.close()
+            return True
+        except:
+            return False
+
+    def _evict_idle(self):
+        # close the connections idle for longer than the idle timeout, the idle list is ordered by checkin time
+        _now = monotonic()
+        _evicted = []
+        while self._size > self._min_size and self._idle and _now - self._idle[0][1] > self._idle_timeout:
+            _evicted.append(self._idle.pop(0)[0])
+            self._size -= 1
+        return _evicted
+
+    def checkout(self):
+        """
+        Return an open connection of the pool, or a new one while the pool is below its maximum size. Raises
+        TimeoutError when no connection became available within the checkout timeout
+        """
+        _deadline = monotonic() + self._checkout_timeout
+        while True:
+            with self._available:
+                _evicted = self._evict_idle()
+                while not self._idle and self._size >= self._max_size:
+                    if not self._available.wait(_deadline - monotonic()):
+                        raise TimeoutError(f'No database connection available within {self._checkout_timeout} s')
+                if self._idle:
+                    # the most recently used connection first, so the others can become idle and be evicted
+                    _conn, _idle_since = self._idle.pop()
+                else:
+                    _conn, _idle_since = None, None
+                    self._size += 1
+
+            for _connection in _evicted:
+                self._close(_connection)
+
+            if _conn is None:
+                try:
+                    return self._storage.connect()
+                except:
+                    self._discard()
+                    raise
+
+            if monotonic() - _idle_since < self._health_check_after or self._healthy(_conn):
+                return _conn
+
+            logging.warning('Discarded a pooled database connection that failed the health check')
+            self._close(_conn)
+            self._discard()
+
+    def _discard(self):
+        with self._available:
+            self._size -= 1
+            self._available.notify()
+        return None
+
+    def checkin(self, conn, broken = False):
+        """
+        Return a connection to the pool, a broken connection is closed instead
+        """
+        if broken:
+            self._close(conn)
+            self._discard()
+            return None
+
+        # end the transaction a query may have opened, so a pooled connection holds no locks or stale snapshot
+        try:
+            conn.rollback()
+        except:
+            return self.checkin(conn, broken = True)
+
+        with self._available:
+            self._idle.append((conn, monotonic()))
+            self._available.notify()
+        return None
+
+    @contextmanager
+    def cursor(self):
+        """
+        Lend a connection of the pool for the duration of a with block, as a new cursor that is closed at its end. The
+        connection is discarded when the block raises a database error
+        """
+        _conn = self.checkout()
+        _broken = False
+        try:
+            _cursor = _conn.cursor()
+            try:
+                yield _cursor
+            finally:
+                try:
+                    _cursor.close()
+                except:
+                    pass
+        except Exception as e:
+            # a query that fails because of its parameters does not break the connection, a lost connection does
+            _broken = not self._healthy(_conn)
+            raise e
+        finally:
+            self.checkin(_conn, _broken)
+
+    def close(self):
+        """
+        Close the idle connections of the pool
+        """
+        with self._available:
+            _idle = self._idle
+            self._idle = []
+            self._size -= len(_idle)
+        for _conn, _idle_since in _idle:
+            self._close(_conn)
+        return None
+
+
+def create_storage(backend, server = None, database = None, path = None):
+    """
+    Return the storage backend 'sqlserver' (server and database) or 'sqlite' (path of the database file)
+    """
+    if backend == 'sqlserver':
+        return SQLServerStorage(server, database)
+    if backend == 'sqlite':
+        return SQLiteStorage(path)
+    raise ValueError(f'Unknown storage backend {backend}')
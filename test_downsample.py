@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from datetime import datetime, timedelta
+from downsample import minmax_indices, lttb_indices, downsample_rows
+
+
+@pytest.mark.parametrize('signals', [1, 2, 5])
+@pytest.mark.parametrize('max_points', [3, 4, 5, 10, 12, 50])
+def test_minmax_keeps_at_most_max_points(signals, max_points):
+    _y = np.random.default_rng(0).normal(size = (1000, signals))
+    _y[::7, 0] = np.nan
+    _indices = minmax_indices(_y, max_points)
+    assert len(_indices) <= max_points
+    assert _indices[0] == 0 and _indices[-1] == len(_y) - 1
+
+
+def test_minmax_keeps_the_peaks_of_every_signal():
+    _y = np.zeros((1000, 2))
+    _y[100, 0], _y[900, 1] = 5.0, -5.0
+    _indices = minmax_indices(_y, 6)
+    assert 100 in _indices and 900 in _indices
+
+
+def test_minmax_keeps_the_peaks_with_few_points():
+    # 5 signals and 10 points leave no room for the extremes of every signal
+    _y = np.zeros((1000, 5))
+    _y[300, 3] = 100.0
+    _indices = minmax_indices(_y, 10)
+    assert len(_indices) <= 10
+    assert 300 in _indices
+
+
+def test_lttb_keeps_max_points():
+    _x = np.arange(1000, dtype = np.float64)
+    _y = np.random.default_rng(1).normal(size = (1000, 3))
+    assert len(lttb_indices(_x, _y, 20)) == 20
+
+
+def test_lttb_skips_the_rows_without_signals():
+    # the additional vibration data are NaN in the rows of the cycles that did not sample them
+    _start = datetime(2026, 1, 1)
+    _rows = [(x, 1, 'm', 'l', 1, 's', _start + timedelta(seconds = 10*x), float(x % 7) if x % 6 == 0 else np.nan)
+             for x in range(600)]
+    _kept = downsample_rows(_rows, [7], 20, 'lttb')
+    assert len(_kept) == 20
+    assert not any(np.isnan(x[7]) for x in _kept)
@@ -0,0 +1,205 @@
+import logging
+import numpy as np
+
+
+# declarative decoding of the PLC register blocks (see REGISTER_MAP in read.py) into the machinedatatable columns:
+# (column name, register block, register offset within the block of a sensor, scale factor, dtype)
+FIELD_SPEC = [
+    ('Zvel', 'sensor', 0, 1000, 'f8'),                  # mm/s
+    ('Zacc', 'sensor', 1, 1000, 'f8'),                  # g
+    ('Xvel', 'sensor', 2, 1000, 'f8'),                  # mm/s
+    ('Xacc', 'sensor', 3, 1000, 'f8'),                  # g
+    ('Temp', 'sensor', 4, 100, 'f8'),                   # Celsius
+    # the threshold registers are ordered x-vel, z-vel, x-acc, z-acc with (baseline, warning, alarm) each
+    ('Zvelbase', 'threshold', 3, 1000, 'f8'),           # mm/s
+    ('Zaccbase', 'threshold', 9, 1000, 'f8'),           # g
+    ('Xvelbase', 'threshold', 0, 1000, 'f8'),           # mm/s
+    ('Xaccbase', 'threshold', 6, 1000, 'f8'),           # g
+    ('Zvelwarn', 'threshold', 4, 1000, 'f8'),           # mm/s
+    ('Zaccwarn', 'threshold', 10, 1000, 'f8'),          # g
+    ('Xvelwarn', 'threshold', 1, 1000, 'f8'),           # mm/s
+    ('Xaccwarn', 'threshold', 7, 1000, 'f8'),           # g
+    ('Zvelalarm', 'threshold', 5, 1000, 'f8'),          # mm/s
+    ('Zaccalarm', 'threshold', 11, 1000, 'f8'),         # g
+    ('Xvelalarm', 'threshold', 2, 1000, 'f8'),          # mm/s
+    ('Xaccalarm', 'threshold', 8, 1000, 'f8'),          # g
+    ('Tempwarn', 'temp_warning', 0, 1, 'f8'),           # Celsius
+    ('Tempalarm', 'temp_alarm', 0, 1, 'f8'),            # Celsius
+    ('MotorRunFlag', 'motor_status', 0, 1, 'i4'),
+    ('ZpeakAcc', 'additional', 0, 1000, 'f8'),
+    ('XpeakAcc', 'additional', 1, 1000, 'f8'),
+    ('ZpeakVel', 'additional', 2, 1000, 'f8'),
+    ('XpeakVel', 'additional', 3, 1000, 'f8'),
+    ('ZRMSlowAcc', 'additional', 4, 1000, 'f8'),
+    ('XRMSlowAcc', 'additional', 5, 1000, 'f8'),
+    ('Zkurtosis', 'additional', 6, 1000, 'f8'),
+    ('Xkurtosis', 'additional', 7, 1000, 'f8'),
+    ('Zcrestfac', 'additional', 8, 1000, 'f8'),
+    ('Xcrestfac', 'additional', 9, 1000, 'f8'),
+]
+
+# one row per sensor and cycle, the fields are in the column order of the machinedatatable
+CYCLE_DTYPE = np.dtype([('sensorID', 'i4'), ('time_log', 'M8[us]')] +
+                       [(_name, _dtype) for _name, _block, _offset, _scale, _dtype in FIELD_SPEC])
+
+MACHINE_DATA_COLUMNS = list(CYCLE_DTYPE.names)
+
+# the additional vibration statistics among the fields, sampled at their own (slower) rate. They are NULL (NaN in a
+# cycle frame) in the rows of the cycles that did not read them
+SAMPLED_FIELDS = [_name for _name, _block, _offset, _scale, _dtype in FIELD_SPEC if _block == 'additional']
+
+# the vibration thresholds and temperature setpoints among the fields
+SETPOINT_FIELDS = [_name for _name, _block, _offset, _scale, _dtype in FIELD_SPEC
+                   if _block in ('threshold', 'temp_warning', 'temp_alarm')]
+
+
+def empty_cycle_frame():
+    """
+    Return a cycle frame without rows
+    """
+    return np.empty(0, dtype = CYCLE_DTYPE)
+
+
+def decode_fields(blocks, block_names):
+    """
+    Decode the raw register blocks {block name: array of shape (sensors, registers per sensor)} into
+    {column name: array with one value per sensor} for all fields of FIELD_SPEC stored in the given blocks
+    """
+    _columns = {}
+    for _name, _block, _offset, _scale, _dtype in FIELD_SPEC:
+        if _block in block_names:
+            _raw = blocks[_block][:, _offset]
+            _columns[_name] = _raw / _scale if _scale != 1 else _raw
+
+    return _columns
+
+
+def decode_cycle(blocks, sensor_numbers, time_log):
+    """
+    Decode the raw register blocks of all sensors of a cycle into a cycle frame, a NumPy structured array with one row
+    per sensor (see CYCLE_DTYPE). All sensors share the time log of the cycle. The SAMPLED_FIELDS of blocks that are
+    not given are NaN
+    """
+    _frame = np.empty(len(sensor_numbers), dtype = CYCLE_DTYPE)
+    _frame['sensorID'] = sensor_numbers
+    _frame['time_log'] = np.datetime64(time_log, 'us')
+    for _name in SAMPLED_FIELDS:
+        _frame[_name] = np.nan
+    for _name, _values in decode_fields(blocks, blocks.keys()).items():
+        _frame[_name] = _values
+
+    return _frame
+
+
+def validate_cycle_frame(cycle_frame):
+    """
+    Return the rows of a cycle frame that pass the data validation, the rows with values that are not finite (but for
+    the NaN of SAMPLED_FIELDS that were not sampled) and the rows of sensorIDs that appear more than once in the cycle
+    (e.g. overlapping sensor_id_offset of two PLCs) are logged and dropped
+    """
+    if cycle_frame.dtype != CYCLE_DTYPE:
+        logging.warning(f"Rejected cycle of {len(cycle_frame)} rows, it doesn't contain the 32 machinedatatable columns")
+        return empty_cycle_frame()
+
+    _valid = np.ones(len(cycle_frame), dtype = bool)
+    for _name, _block, _offset, _scale, _dtype in FIELD_SPEC:
+        if _name in SAMPLED_FIELDS:
+            _valid &= ~np.isinf(cycle_frame[_name])
+        elif _dtype == 'f8':
+            _valid &= np.isfinite(cycle_frame[_name])
+
+    _sensor_ids, _counts = np.unique(cycle_frame['sensorID'], return_counts = True)
+    _valid &= ~np.isin(cycle_frame['sensorID'], _sensor_ids[_counts > 1])
+
+    if not _valid.all():
+        logging.warning(f"Rejected rows of sensors {cycle_frame['sensorID'][~_valid].tolist()} in the cycle, they have "
+                        f"values that are not finite or a repeated sensorID")
+
+    return cycle_frame[_valid]
+
+
+class DeadbandFilter:
+    """
+    Change-based write suppression: a row of a sensor is only passed on when a signal moved past its band since the
+    last row passed on for that sensor, the MotorRunFlag or a setpoint changed, or the heartbeat interval passed. The readers
+    reconstruct the suppressed rows as a step-wise series, every value holds until the next row of the sensor. The
+    SAMPLED_FIELDS are compared to the last row passed on with them, so a row that sampled them is also passed on when
+    one of them moved past its band or the heartbeat passed since that row
+    """
+
+    def __init__(self):
+        self._bands = {}
+        self._heartbeat = np.timedelta64(300, 's')
+        self._idle_only = True
+        self._last_rows = empty_cycle_frame()
+        self._last_sampled = empty_cycle_frame()
+
+    def set_bands(self, bands):
+        """
+        Set the bands {column: (absolute band, relative band)}, a row is passed on when |value - last value| exceeds
+        the larger of the absolute band and the relative band times |last value| for any of the columns
+        """
+        self._bands = bands
+        return None
+
+    def set_heartbeat(self, heartbeat):
+        """
+        Set the longest time (seconds) between two rows of a sensor that are passed on
+        """
+        self._heartbeat = np.timedelta64(int(heartbeat), 's')
+        return None
+
+    def set_idle_only(self, idle_only):
+        """
+        Only suppress rows of sensors whose motor is stopped (MotorRunFlag 0), all rows of running motors are passed on
+        """
+        self._idle_only = idle_only
+        return None
+
+    def filter_cycle_frame(self, cycle_frame):
+        """
+        Return the rows of a cycle frame that are passed on, and remember them as the last rows of their sensors
+        """
+        if not len(cycle_frame):
+            return cycle_frame
+
+        _last, _write = self._changed(cycle_frame, self._last_rows,
+                                      [x for x in self._bands if x not in SAMPLED_FIELDS])
+        _write |= _last['MotorRunFlag'] != cycle_frame['MotorRunFlag']
+        for _name in SETPOINT_FIELDS:
+            _write |= _last[_name] != cycle_frame[_name]
+        if self._idle_only:
+            _write |= cycle_frame['MotorRunFlag'] != 0
+        # the additional statistics are only in the rows of the cycles that sampled them
+        _sampled = ~np.isnan(cycle_frame[SAMPLED_FIELDS[0]])
+        _write |= _sampled & self._changed(cycle_frame, self._last_sampled,
+                                           [x for x in self._bands if x in SAMPLED_FIELDS])[1]
+
+        _written = cycle_frame[_write]
+        self._last_rows = self._remember(self._last_rows, _written)
+        self._last_sampled = self._remember(self._last_sampled, _written[_sampled[_write]])
+        return _written
+
+    def _changed(self, cycle_frame, last_rows, bands):
+        # the last rows passed on of the rows of the cycle, matched by sensorID (the last rows are sorted by sensorID),
+        # and whether a row has none, its heartbeat passed or one of the columns of bands moved past its band
+        _index = np.minimum(np.searchsorted(last_rows['sensorID'], cycle_frame['sensorID']), max(len(last_rows) - 1, 0))
+        if len(last_rows):
+            _last = last_rows[_index]
+            _write = _last['sensorID'] != cycle_frame['sensorID']
+        else:
+            _last = cycle_frame
+            _write = np.ones(len(cycle_frame), dtype = bool)
+
+        _write |= cycle_frame['time_log'] - _last['time_log'] >= self._heartbeat
+        for _name in bands:
+            _absolute, _relative = self._bands[_name]
+            _write |= np.abs(cycle_frame[_name] - _last[_name]) > np.maximum(_absolute, _relative*np.abs(_last[_name]))
+        return _last, _write
+
+    def _remember(self, last_rows, written):
+        # the last rows with the written rows in place of the earlier rows of their sensors, sorted by sensorID
+        if not len(written):
+            return last_rows
+        _last_rows = np.concatenate([last_rows[~np.isin(last_rows['sensorID'], written['sensorID'])], written])
+        return _last_rows[np.argsort(_last_rows['sensorID'], kind = 'stable')]